@@ -128,13 +128,13 @@ async def update_prompt(prompt: PromptModel):
 async def improve_prompt(data: ImprovePromptModel):
     """Usa IA para mejorar una sección del prompt"""
     import os
-    from openai import OpenAI
+    from openai_clients import obtener_cliente
     
     api_key = get_config("openai_api_key", "") or os.getenv("OPENAI_API_KEY", "")
     if not api_key:
         return {"error": "No hay API key de OpenAI configurada"}
     
-    client = OpenAI(api_key=api_key)
+    client = obtener_cliente(api_key)
     
     section_names = {
         "role": "Rol (quién es el agente)",
@@ -6,7 +6,8 @@ Multi-tenant: todas las funciones reciben usuario_id
 import os
 import json
 import logging
-from openai import OpenAI
+import time
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 from database import get_config, is_tool_enabled
 from models import SessionLocal
@@ -15,13 +16,27 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
-def get_openai_client(usuario_id: int = None):
+def _get_api_key(usuario_id: int = None) -> str:
     api_key = get_config("openai_api_key", "", usuario_id=usuario_id) or os.getenv(
         "OPENAI_API_KEY", ""
     )
     if not api_key:
         raise ValueError("No OpenAI API key configured")
-    return OpenAI(api_key=api_key)
+    return api_key
+
+
+def get_openai_client(usuario_id: int = None):
+    """Cliente OpenAI síncrono del tenant (reutilizado, ver openai_clients)."""
+    from openai_clients import obtener_cliente
+
+    return obtener_cliente(_get_api_key(usuario_id))
+
+
+def get_async_openai_client(usuario_id: int = None):
+    """Cliente AsyncOpenAI del tenant para el event loop actual."""
+    from openai_clients import obtener_cliente_async
+
+    return obtener_cliente_async(_get_api_key(usuario_id))
 
 
 # ─── Tool Definitions ───────────────────────────────────────────────────
@@ -152,10 +167,9 @@ def execute_tool(name: str, args: dict, telefono: str, db, usuario_id: int = 1)
         MessageService.add_system_event(
             db, telefono, "datos_guardados", evento_text, metadata=datos, usuario_id=usuario_id
         )
-        from lead_scoring import update_lead_score, update_lead_state
+        from lead_scoring import actualizar_lead
 
-        update_lead_score(db, telefono, usuario_id)
-        update_lead_state(db, telefono, usuario_id)
+        actualizar_lead(db, telefono, usuario_id)
         _check_funnel_advance(db, telefono, usuario_id)
         return {
             "resultado": f"Datos guardados correctamente: {', '.join(parts)}",
@@ -214,7 +228,7 @@ def execute_tool(name: str, args: dict, telefono: str, db, usuario_id: int = 1)
         from message_service import MessageService
 
         razon = args.get("razon", "Solicitud de atencion humana")
-        result = transferir_a_humano(telefono, razon, usuario_id=usuario_id)
+        result = transferir_a_humano(telefono, razon, usuario_id=usuario_id, db=db)
         MessageService.add_system_event(
             db,
             telefono,
@@ -230,14 +244,18 @@ def execute_tool(name: str, args: dict, telefono: str, db, usuario_id: int = 1)
 
 
 def transferir_a_humano(
-    telefono: str, razon: str = "Solicitud de atencion humana", usuario_id: int = None
+    telefono: str, razon: str = "Solicitud de atencion humana", usuario_id: int = None, db=None
 ) -> str:
-    """Transferir la conversacion a atencion humana activando modo humano para el contacto."""
+    """Transferir la conversacion a atencion humana activando modo humano para el contacto.
+
+    Dentro de un turno hay que pasar `db`: la transacción del turno puede tener
+    ya bloqueada la fila del contacto, y una sesión aparte esperaría ese lock.
+    """
     from api.routers.contactos import activar_modo_humano_por_telefono
 
     try:
         resultado = activar_modo_humano_por_telefono(
-            telefono, razon, usuario_id=usuario_id
+            telefono, razon, db=db, usuario_id=usuario_id
         )
         if resultado:
             return "Conversacion transferida a atencion humana. Un asesor atendera al cliente pronto."
@@ -421,65 +439,10 @@ def build_system_prompt(db, telefono: str, usuario_id: int = 1, perfil_id: int =
     return "\n\n".join(prompt_parts)
 
 
-def _send_typing(telefono: str):
-    """Enviar indicador 'escribiendo...' al contacto via WhatsApp"""
-    import httpx as _httpx
-
-    wa_url = os.getenv("WHATSAPP_API_URL", "http://whatsapp-bridge:3080")
-    wa_key = os.getenv("WHATSAPP_API_KEY", "")
-    phone_clean = telefono.replace("+", "").replace("@lid", "")
-    if not phone_clean.endswith("@c.us"):
-        phone_clean = f"{phone_clean}@c.us"
-    try:
-        with _httpx.Client(timeout=5.0) as c:
-            c.post(
-                f"{wa_url}/api/sendTyping",
-                json={"chatId": phone_clean, "duration": 4},
-                headers={"X-Api-Key": wa_key, "Content-Type": "application/json"},
-            )
-    except Exception:
-        pass
-
-
 def _get_tools_availability_info(usuario_id: int = None, perfil_id: int = None) -> str:
     return ""
 
 
-# ─── Main Responder ──────────────────────────────────────────────────────
-
-
-def _sync_to_legacy_memoria(db, telefono: str, usuario_id: int = 1, perfil_id: int = None):
-    """Sincronizar mensajes nuevos a la tabla Memoria para compatibilidad"""
-    from models import Memoria
-    from message_service import MessageService
-    from datetime import datetime
-
-    # Si no viene el perfil, resolver el activo del usuario (background sin header)
-    if perfil_id is None:
-        try:
-            from api.routers.perfiles import get_perfil_activo_id
-            perfil_id = get_perfil_activo_id(db, usuario_id)
-        except Exception:
-            perfil_id = None
-
-    msgs = MessageService.get_messages_for_ai(db, telefono, usuario_id=usuario_id, limit=20)
-    memoria = db.query(Memoria).filter(Memoria.telefono == telefono).first()
-    if memoria:
-        memoria.historial = json.dumps(msgs, ensure_ascii=False)
-        memoria.updated_at = datetime.utcnow()
-        if memoria.perfil_id is None and perfil_id is not None:
-            memoria.perfil_id = perfil_id
-    else:
-        memoria = Memoria(
-            telefono=telefono,
-            usuario_id=usuario_id,
-            perfil_id=perfil_id,
-            historial=json.dumps(msgs, ensure_ascii=False),
-        )
-        db.add(memoria)
-    db.commit()
-
-
 # ─── Skill Helpers ───────────────────────────────────────────────────────────
 
 
@@ -489,32 +452,35 @@ def _get_enabled_skill_names(usuario_id: int, perfil_id: int = None) -> list[str
     return ["human_handoff", "data_capture", "faq", "free_chat"]
 
 
-def _build_orchestrator_context(db, telefono: str, usuario_id: int, historial: list, perfil_id: int = None) -> dict:
-    """Build the full context dict needed by classifier, skills, and prompt builder."""
-    from capture_service import CaptureService
+def _build_orchestrator_context(db, snapshot) -> dict:
+    """Build the full context dict needed by classifier, skills, and prompt builder.
+
+    Todo lo de la conversación sale del snapshot (context_loader); aquí solo se
+    asigna el primer paso del funnel a contactos que aún no tienen uno. El
+    conocimiento y las instrucciones del tenant van en el prefijo estático
+    cacheado (prompt_builder.get_static_prefix). El historial es la ventana
+    acotada por tokens de history_window (resumen + mensajes más nuevos).
+    """
     from funnel_service import FunnelService
-    from knowledge_service import KnowledgeService
-    from models import Contacto
+    from history_window import armar_ventana, presupuesto_historial
 
-    contacto = (
-        db.query(Contacto)
-        .filter(Contacto.telefono == telefono, Contacto.usuario_id == usuario_id)
-        .first()
-    )
+    usuario_id = snapshot.usuario_id
+    perfil_id = snapshot.perfil_id
+    telefono = snapshot.telefono
 
-    datos_capturados = CaptureService.get_captured_data(db, usuario_id, telefono)
-    missing_fields = CaptureService.get_missing_fields(db, usuario_id, telefono)
-    pending_names = [f["etiqueta"] for f in missing_fields]
+    datos_capturados = dict(snapshot.datos_capturados)
+    pending_names = [f["etiqueta"] for f in snapshot.campos_faltantes()]
+    recientes = snapshot.historial_lista()
+    historial = armar_ventana(recientes, presupuesto_historial(usuario_id, perfil_id), snapshot.resumen)
+    verbatim = [m for m in historial if m["role"] != "system"]
 
     # Funnel step info
     funnel_step = None
     funnel_instruction = None
-    if contacto and contacto.paso_funnel:
-        step_info = FunnelService.get_contact_step_info(db, usuario_id, telefono)
-        funnel_step = contacto.paso_funnel
-        if step_info.get("instrucciones"):
-            funnel_instruction = step_info["instrucciones"]
-    elif contacto:
+    if snapshot.paso_funnel:
+        funnel_step = snapshot.paso_funnel
+        funnel_instruction = snapshot.instrucciones_paso
+    elif snapshot.existe_contacto:
         first_step = FunnelService.get_first_step(db, usuario_id)
         if first_step:
             FunnelService.assign_contact_to_step(db, usuario_id, telefono, first_step["nombre"])
@@ -522,13 +488,8 @@ def _build_orchestrator_context(db, telefono: str, usuario_id: int, historial: l
             if first_step.get("instrucciones_agente"):
                 funnel_instruction = first_step["instrucciones_agente"]
 
-    # Knowledge context
-    knowledge_context = KnowledgeService.get_context_for_agent(db, usuario_id)
-
-    # Custom instructions
-    custom_instructions = get_config("custom_instructions", "", usuario_id=usuario_id, perfil_id=perfil_id)
-
     return {
+        "snapshot": snapshot,
         "telefono": telefono,
         "usuario_id": usuario_id,
         "perfil_id": perfil_id,
@@ -539,22 +500,57 @@ def _build_orchestrator_context(db, telefono: str, usuario_id: int, historial: l
         "paso_funnel": funnel_step,
         "funnel_step": funnel_step,
         "funnel_instruction": funnel_instruction,
-        "lead_score": contacto.lead_score if contacto else None,
-        "lead_state": contacto.estado_lead if contacto else None,
+        "lead_score": snapshot.lead_score,
+        "lead_state": snapshot.estado_lead,
         "captured_data": datos_capturados,
-        "message_count": len(historial),
+        "message_count": len(verbatim),
         "active_appointments": [],
-        "recent_messages": historial[-3:] if historial else [],
+        "recent_messages": verbatim[-3:],
         "historial": historial,
-        "knowledge_context": knowledge_context,
-        "custom_instructions": custom_instructions,
     }
 
 
 # ─── Main Responder ──────────────────────────────────────────────────────
 
 
-def responder(mensaje: str, telefono: str, usuario_id: int = 1, perfil_id: int = None) -> str:
+RESPUESTA_ERROR = "Disculpa, hubo un error procesando tu mensaje. Por favor intenta de nuevo."
+RESPUESTA_VACIA = "Disculpa, no pude procesar tu solicitud. ¿Podrías intentar de nuevo?"
+
+
+@dataclass
+class TurnoPreparado:
+    """Estado de un turno entre la preparación (DB + clasificación), la
+    completion del LLM y el cierre (lead score + guardar respuesta)."""
+
+    telefono: str
+    usuario_id: int
+    perfil_id: int
+    skill: str
+    messages: list = field(default_factory=list)
+    model: str = "gpt-4o-mini"
+    temperature: float = 0.7
+    max_tokens: int = 500
+    # Respuesta final ya resuelta sin LLM (p. ej. transferencia a humano)
+    respuesta: str = None
+    # Mensajes de WhatsApp ya enviados durante la completion en streaming
+    fragmentos: int = 0
+    # Hay suficientes mensajes sin resumir: actualizar el resumen al terminar
+    resumir: bool = False
+    # Modo inline: la completion responde JSON y decide también el handoff
+    # (intent_classifier.TriggersPendientes); sin streaming
+    triggers: object = None
+    # Motivo del handoff decidido por la completion (None = no transferir)
+    transferir: str = None
+
+
+def responder(
+    mensaje: str,
+    telefono: str,
+    usuario_id: int = 1,
+    perfil_id: int = None,
+    guardar_mensaje: bool = True,
+    cronometro=None,
+) -> str:
     """Orchestrated responder — classify intent, run skill, then GPT for text only.
 
     Flow:
@@ -565,61 +561,174 @@ def responder(mensaje: str, telefono: str, usuario_id: int = 1, perfil_id: int =
     5. Build focused prompt (no tools)
     6. GPT generates text only (1 call, no tool loops)
     7. Post-actions (lead score, funnel advance, save response)
+
+    guardar_mensaje=False cuando el caller ya persistió los mensajes entrantes
+    (el webhook, o una ráfaga agrupada donde `mensaje` es la concatenación).
+    cronometro: metrics.Cronometro del webhook para sumar las etapas del agente
+    a las del pipeline; los tiempos quedan en metadata_json de la respuesta.
+
+    Versión síncrona (scripts, tests). El webhook y el worker usan
+    responder_async, que no ocupa un thread durante la completion.
     """
+    from metrics import Cronometro, usar_cronometro
+
+    with usar_cronometro(cronometro or Cronometro(usuario_id)):
+        db = SessionLocal()
+        try:
+            turno = _preparar_turno(db, mensaje, telefono, usuario_id, perfil_id, guardar_mensaje)
+            if turno.respuesta is not None:
+                return turno.respuesta
+            respuesta = _completar(turno)
+            return _finalizar_turno(db, turno, respuesta)
+        except Exception as e:
+            logger.error(f"Error en responder: {e}", exc_info=True)
+            return RESPUESTA_ERROR
+        finally:
+            db.close()
+
+
+async def responder_async(
+    mensaje: str,
+    telefono: str,
+    usuario_id: int = 1,
+    perfil_id: int = None,
+    guardar_mensaje: bool = True,
+    cronometro=None,
+    esperar: bool = None,
+    on_fragmento=None,
+) -> str:
+    """Mismo turno que `responder`, con la completion nativa en el event loop.
+
+    Solo la preparación y el cierre (DB, clasificación) pasan por el pool del
+    agente (agent_executor); mientras el LLM genera, el turno no ocupa thread.
+    Lanza agent_executor.AgenteSaturado si la preparación no es admitida
+    (esperar=True lo evita); el cierre siempre espera su turno.
+
+    on_fragmento: corrutina `(texto, final=False)`; si se pasa, la completion
+    se hace en streaming y se le entrega cada párrafo/oración apenas está lista
+    (ver streaming_delivery). Igual se retorna la respuesta completa.
+
+    Al terminar, si hay suficientes mensajes sin resumir, lanza en background
+    la actualización del resumen de la conversación (history_window).
+    """
+    from agent_executor import agent_executor, AgenteSaturado
+    from metrics import Cronometro, usar_cronometro
+
+    crono = cronometro or Cronometro(usuario_id)
+    try:
+        turno = await agent_executor.ejecutar(
+            usuario_id, _en_sesion, crono, _preparar_turno,
+            mensaje, telefono, usuario_id, perfil_id, guardar_mensaje,
+            esperar=esperar,
+        )
+        if turno.respuesta is not None:
+            return turno.respuesta
+        with usar_cronometro(crono):
+            # Salida JSON (modo inline con triggers pendientes): no se puede
+            # entregar en fragmentos, el webhook la envía completa
+            if on_fragmento is not None and turno.triggers is None:
+                respuesta = await _completar_streaming(turno, on_fragmento)
+            else:
+                respuesta = await _completar_async(turno)
+        respuesta = await agent_executor.ejecutar(
+            usuario_id, _en_sesion, crono, _finalizar_turno, turno, respuesta, esperar=True,
+        )
+        if turno.resumir:
+            from history_window import programar_resumen
+            programar_resumen(usuario_id, turno.perfil_id, telefono)
+        return respuesta
+    except AgenteSaturado:
+        raise
+    except Exception as e:
+        logger.error(f"Error en responder: {e}", exc_info=True)
+        return RESPUESTA_ERROR
+
+
+def _en_sesion(crono, fn, *args):
+    """Correr una etapa del turno en un thread: sesión propia + cronómetro activo."""
+    from metrics import usar_cronometro
+
+    with usar_cronometro(crono):
+        db = SessionLocal()
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+
+
+def _metadata_respuesta(skill: str) -> dict:
+    from metrics import cronometro_actual
+
+    metadata = {"source": "ai", "skill": skill}
+    crono = cronometro_actual()
+    if crono is not None and crono.tiempos_ms:
+        metadata["timings_ms"] = dict(crono.tiempos_ms)
+    return metadata
+
+
+def _preparar_turno(
+    db, mensaje: str, telefono: str, usuario_id: int, perfil_id: int, guardar_mensaje: bool
+) -> TurnoPreparado:
+    """Todo lo previo a la completion: historial, contexto, intención, skill y prompt."""
     from message_service import MessageService
-    from datetime import datetime
     from intent_classifier import classify_intent
     from skill_executor import execute_skill
     from prompt_builder import build_focused_prompt
+    from context_loader import cargar_snapshot
+    from metrics import etapa
+    from models import unit_of_work
 
-    db = SessionLocal()
-    try:
-        # Resolve the profile this conversation belongs to (defaults to active).
-        if perfil_id is None:
-            from api.routers.perfiles import get_perfil_activo_id
-            perfil_id = get_perfil_activo_id(db, usuario_id)
-
-        client = get_openai_client(usuario_id)
-
-        # Migrate legacy messages
-        MessageService.migrate_from_memoria(db, telefono, usuario_id)
-
-        # Dedup check + save incoming message
-        from models import MensajeConversacion
-        last = (
-            db.query(MensajeConversacion)
-            .filter(
-                MensajeConversacion.telefono == telefono,
-                MensajeConversacion.usuario_id == usuario_id,
-                MensajeConversacion.rol == "user",
-                MensajeConversacion.contenido == mensaje,
-            )
-            .order_by(MensajeConversacion.created_at.desc())
-            .first()
-        )
-        if not last or (datetime.utcnow() - last.created_at).total_seconds() > 5:
-            MessageService.add_message(db, telefono, "user", mensaje, usuario_id=usuario_id, perfil_id=perfil_id)
+    # Resolve the profile this conversation belongs to (defaults to active).
+    if perfil_id is None:
+        from api.routers.perfiles import get_perfil_activo_id
+        perfil_id = get_perfil_activo_id(db, usuario_id)
+
+    # Falla rápido si el tenant no tiene API key
+    _get_api_key(usuario_id)
 
-        # Load history
-        historial = MessageService.get_messages_for_ai(db, telefono, usuario_id=usuario_id, limit=20)
+    # Escrituras del turno en dos unit_of_work (un commit cada uno). El corte
+    # va antes de clasificar: la clasificación puede llamar al LLM y no debe
+    # hacerlo con la fila del contacto bloqueada.
+    with unit_of_work(db):
+        # Save incoming message (el webhook ya lo ingesta de forma idempotente por wa_id)
+        if guardar_mensaje:
+            with etapa("guardar_mensaje"):
+                MessageService.add_message(db, telefono, "user", mensaje, usuario_id=usuario_id, perfil_id=perfil_id)
+
+        # Snapshot de la conversación: contacto, funnel, captura e historial
+        with etapa("historial"):
+            snapshot = cargar_snapshot(db, usuario_id, perfil_id, telefono)
 
         # ── Build context ──
-        context = _build_orchestrator_context(db, telefono, usuario_id, historial, perfil_id=perfil_id)
-        enabled_skills = _get_enabled_skill_names(usuario_id, perfil_id=perfil_id)
+        with etapa("contexto"):
+            context = _build_orchestrator_context(db, snapshot)
+    enabled_skills = _get_enabled_skill_names(usuario_id, perfil_id=perfil_id)
 
-        # Track disabled skills so prompt builder can add restrictions
-        context["disabled_skills"] = []
+    # Track disabled skills so prompt builder can add restrictions
+    context["disabled_skills"] = []
 
-        # ── Classify intent ──
+    # ── Classify intent ──
+    with etapa("clasificacion"):
         intent = classify_intent(mensaje, context, enabled_skills, usuario_id)
-        logger.info(
-            f"Intent: {intent.primary} (secondary={intent.secondary}, "
-            f"confidence={intent.confidence}, keywords={intent.matched_keywords})"
-        )
+    logger.info(
+        f"Intent: {intent.primary} (secondary={intent.secondary}, "
+        f"confidence={intent.confidence}, keywords={intent.matched_keywords})"
+    )
+    if intent.primary == "human_handoff" and intent.matched_keywords:
+        context["razon"] = f"Trigger: {', '.join(intent.matched_keywords)}"
+
+    from history_window import necesita_resumen, resumir_cada
+
+    turno = TurnoPreparado(
+        telefono=telefono, usuario_id=usuario_id, perfil_id=perfil_id, skill=intent.primary,
+        resumir=necesita_resumen(len(snapshot.historial), resumir_cada(usuario_id, perfil_id)),
+    )
 
-        # ── Execute skill pre-actions ──
-        _send_typing(telefono)
-        skill_result = execute_skill(intent, mensaje, context, db)
+    # ── Execute skill pre-actions ──
+    # ("escribiendo..." lo mantiene el webhook desde el event loop)
+    with unit_of_work(db):
+        with etapa("skill"):
+            skill_result = execute_skill(intent, mensaje, context, db)
         logger.info(
             f"Skill result: {skill_result.get('skill')} "
             f"success={skill_result.get('success')}"
@@ -630,60 +739,221 @@ def responder(mensaje: str, telefono: str, usuario_id: int = 1, perfil_id: int =
             farewell = "Te voy a comunicar con un asesor que te va a ayudar. Un momento por favor."
             MessageService.add_message(
                 db, telefono, "assistant", farewell,
-                metadata={"source": "ai", "skill": "human_handoff"}, usuario_id=usuario_id, perfil_id=perfil_id,
+                metadata=_metadata_respuesta("human_handoff"), usuario_id=usuario_id, perfil_id=perfil_id,
             )
-            _sync_to_legacy_memoria(db, telefono, usuario_id, perfil_id)
-            return farewell
+            turno.respuesta = farewell
+            return turno
 
-        # ── Build focused prompt ──
+    # ── Build focused prompt ──
+    with etapa("prompt"):
         messages = build_focused_prompt(db, context, skill_result)
 
-        # Merge prompt_hint from skill into the last system message
-        prompt_hint = skill_result.get("prompt_hint", "")
-        secondary_hint = ""
-        if skill_result.get("secondary") and skill_result["secondary"].get("prompt_hint"):
-            secondary_hint = skill_result["secondary"]["prompt_hint"]
-
-        if prompt_hint or secondary_hint:
-            combined_hint = "\n".join(filter(None, [prompt_hint, secondary_hint]))
-            if messages and messages[0]["role"] == "system":
-                messages[0]["content"] += f"\n\n--- Resultado de acciones ---\n{combined_hint}"
-
-        # ── GPT generates text only ──
-        model = get_config("model", "gpt-4o-mini", usuario_id=usuario_id)
-        temperature = float(get_config("temperature", "0.7", usuario_id=usuario_id))
-        max_tokens = int(get_config("max_tokens", "500", usuario_id=usuario_id))
-
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
+    # Merge prompt_hint from skill into the last system message
+    prompt_hint = skill_result.get("prompt_hint", "")
+    secondary_hint = ""
+    if skill_result.get("secondary") and skill_result["secondary"].get("prompt_hint"):
+        secondary_hint = skill_result["secondary"]["prompt_hint"]
+
+    if prompt_hint or secondary_hint:
+        combined_hint = "\n".join(filter(None, [prompt_hint, secondary_hint]))
+        if messages and messages[0]["role"] == "system":
+            messages[0]["content"] += f"\n\n--- Resultado de acciones ---\n{combined_hint}"
+
+    if intent.triggers_pendientes is not None and messages and messages[0]["role"] == "system":
+        turno.triggers = intent.triggers_pendientes
+        messages[0]["content"] += "\n\n" + _instrucciones_salida_estructurada(turno.triggers)
+
+    turno.messages = messages
+    turno.model = get_config("model", "gpt-4o-mini", usuario_id=usuario_id)
+    turno.temperature = float(get_config("temperature", "0.7", usuario_id=usuario_id))
+    turno.max_tokens = int(get_config("max_tokens", "500", usuario_id=usuario_id))
+    return turno
+
+
+def _instrucciones_salida_estructurada(triggers) -> str:
+    return (
+        "--- Formato de salida ---\n"
+        + triggers.instrucciones()
+        + 'Responde SOLO un objeto JSON: {"respuesta": texto para el cliente, '
+        '"transferir_a_humano": true|false, "motivo": texto exacto de la intencion o null}. '
+        "Si transfieres, la respuesta solo avisa que un asesor tomara la conversacion."
+    )
+
+
+def _parametros_completion(turno: TurnoPreparado) -> dict:
+    params = dict(
+        model=turno.model,
+        messages=turno.messages,
+        temperature=turno.temperature,
+        max_tokens=turno.max_tokens,
+    )
+    if turno.triggers is not None:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+
+def _leer_respuesta(turno: TurnoPreparado, contenido: str) -> str:
+    """Texto de la respuesta; en modo inline además anota el handoff en el turno."""
+    if turno.triggers is None:
+        return contenido or RESPUESTA_VACIA
+    try:
+        data = json.loads(contenido or "{}")
+    except json.JSONDecodeError:
+        logger.warning("Salida estructurada inválida, se usa como texto")
+        return contenido or RESPUESTA_VACIA
+    if data.get("transferir_a_humano"):
+        # Motivo fuera de la lista: igual se respeta la decisión del modelo
+        turno.transferir = turno.triggers.resolver(data.get("motivo")) or str(data.get("motivo") or "IA")
+    return str(data.get("respuesta") or "").strip() or RESPUESTA_VACIA
+
+
+def _completar(turno: TurnoPreparado) -> str:
+    """GPT generates text only (cliente síncrono)."""
+    from metrics import etapa
+
+    from llm_resilience import completar
+
+    with etapa("completion"):
+        response = completar(
+            "respuesta", turno.usuario_id, perfil_id=turno.perfil_id, **_parametros_completion(turno)
         )
-        respuesta = response.choices[0].message.content or ""
+    return _leer_respuesta(turno, response.choices[0].message.content)
+
+
+async def _completar_async(turno: TurnoPreparado) -> str:
+    """GPT generates text only (AsyncOpenAI, sin ocupar un thread)."""
+    from metrics import etapa
 
-        if not respuesta:
-            respuesta = "Disculpa, no pude procesar tu solicitud. ¿Podrías intentar de nuevo?"
+    from llm_resilience import completar_async
 
-        # ── Post-actions ──
-        MessageService.add_message(
-            db, telefono, "assistant", respuesta,
-            metadata={"source": "ai", "skill": intent.primary}, usuario_id=usuario_id, perfil_id=perfil_id,
+    with etapa("completion"):
+        response = await completar_async(
+            "respuesta", turno.usuario_id, perfil_id=turno.perfil_id, **_parametros_completion(turno)
         )
+    return _leer_respuesta(turno, response.choices[0].message.content)
+
+
+async def _completar_streaming(turno: TurnoPreparado, on_fragmento) -> str:
+    """Completion en streaming: cada fragmento listo se entrega mientras el
+    resto se sigue generando. Si el stream se corta después de haber enviado
+    algo, se conserva lo generado (el contacto ya lo leyó). El `usage` llega
+    en el último chunk (include_usage) y se anota al terminar."""
+    import llm_usage
+    from llm_resilience import completar_async
+    from metrics import etapa
+    from streaming_delivery import DivisorFragmentos
+
+    divisor = DivisorFragmentos()
+    partes = []
+    usage = None
+    modelo = turno.model
+    inicio = time.perf_counter()
+    with etapa("completion"):
+        try:
+            stream = await completar_async(
+                "respuesta",
+                turno.usuario_id,
+                perfil_id=turno.perfil_id,
+                model=turno.model,
+                messages=turno.messages,
+                temperature=turno.temperature,
+                max_tokens=turno.max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                modelo = getattr(chunk, "model", None) or modelo
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if not delta:
+                    continue
+                partes.append(delta)
+                for fragmento in divisor.agregar(delta):
+                    if turno.fragmentos == 0:
+                        _observar_primer_fragmento(turno.usuario_id, time.perf_counter() - inicio)
+                    turno.fragmentos += 1
+                    await on_fragmento(fragmento)
+        except Exception as e:
+            if not turno.fragmentos:
+                raise
+            logger.error(f"Stream interrumpido tras {turno.fragmentos} fragmentos: {e}")
+        finally:
+            if partes or usage is not None:
+                llm_usage.registrar(
+                    "respuesta", modelo, usage, time.perf_counter() - inicio,
+                    usuario_id=turno.usuario_id, perfil_id=turno.perfil_id,
+                )
+
+    for fragmento in divisor.cerrar():
+        if turno.fragmentos == 0:
+            _observar_primer_fragmento(turno.usuario_id, time.perf_counter() - inicio)
+        turno.fragmentos += 1
+        await on_fragmento(fragmento, final=True)
+
+    respuesta = "".join(partes).strip()
+    if not respuesta:
+        respuesta = RESPUESTA_VACIA
+        turno.fragmentos = 0
+    return respuesta
+
+
+def _observar_primer_fragmento(usuario_id: int, segundos: float) -> None:
+    """Tiempo al primer mensaje enviado, como etapa propia del turno."""
+    from metrics import STAGE_SECONDS, cronometro_actual
+
+    STAGE_SECONDS.observe(segundos, stage="primer_fragmento", usuario_id=usuario_id)
+    crono = cronometro_actual()
+    if crono is not None:
+        crono.registrar("primer_fragmento", segundos)
+
+
+def _transferir_desde_completion(db, turno: TurnoPreparado) -> None:
+    """Handoff decidido por la completion en modo inline (como skill_human_handoff)."""
+    from message_service import MessageService
 
-        # Lead score update (only if not already done by skill)
-        if intent.primary != "data_capture":
-            from lead_scoring import update_lead_score, update_lead_state
-            update_lead_score(db, telefono, usuario_id)
-            update_lead_state(db, telefono, usuario_id)
+    razon = f"Trigger: {turno.transferir}"
+    logger.info(f"Human trigger (completion inline): '{turno.transferir}'")
+    transferir_a_humano(turno.telefono, razon, usuario_id=turno.usuario_id, db=db)
+    MessageService.add_system_event(
+        db,
+        turno.telefono,
+        "intervencion_humana",
+        f"Transferido a atencion humana. Razon: {razon}",
+        metadata={"razon": razon},
+        usuario_id=turno.usuario_id,
+    )
 
-        # Sync legacy
-        _sync_to_legacy_memoria(db, telefono, usuario_id, perfil_id)
 
-        return respuesta
+def _finalizar_turno(db, turno: TurnoPreparado, respuesta: str) -> str:
+    """Post-actions: lead score y guardar la respuesta, en un solo commit."""
+    from message_service import MessageService
+    from metrics import etapa
+    from models import unit_of_work
+
+    telefono, usuario_id, perfil_id = turno.telefono, turno.usuario_id, turno.perfil_id
+
+    with unit_of_work(db):
+        # Lead score update (only if not already done by skill). Solo cuenta
+        # mensajes del usuario, así que va antes de guardar la respuesta para
+        # que su tiempo quede en el metadata de la misma.
+        if turno.skill != "data_capture":
+            from lead_scoring import actualizar_lead
+            with etapa("lead_scoring"):
+                actualizar_lead(db, telefono, usuario_id)
+
+        if turno.transferir:
+            _transferir_desde_completion(db, turno)
+
+        metadata = _metadata_respuesta("human_handoff" if turno.transferir else turno.skill)
+        if turno.fragmentos:
+            metadata["fragmentos"] = turno.fragmentos
+        with etapa("guardar_respuesta"):
+            MessageService.add_message(
+                db, telefono, "assistant", respuesta,
+                metadata=metadata, usuario_id=usuario_id, perfil_id=perfil_id,
+            )
 
-    except Exception as e:
-        logger.error(f"Error en responder: {e}", exc_info=True)
-        return "Disculpa, hubo un error procesando tu mensaje. Por favor intenta de nuevo."
-    finally:
-        db.close()
+    return respuesta
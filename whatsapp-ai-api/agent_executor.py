@@ -0,0 +1,169 @@
+"""
+Agent Executor - Pool acotado y justo por tenant para los turnos del agente
+
+Las etapas síncronas del turno (DB + clasificación, ver agent.responder_async)
+corren en threads; la completion del LLM va en el event loop. En lugar del executor
+por defecto del event loop (tamaño fijo, cola invisible), los turnos pasan por
+un pool dedicado con:
+
+  - AGENT_MAX_WORKERS threads.
+  - Una cola acotada (AGENT_MAX_QUEUE turnos esperando en total).
+  - Admisión justa por tenant: a lo sumo AGENT_MAX_PER_TENANT turnos (en vuelo +
+    en cola) por usuario, y los slots libres se reparten round-robin entre los
+    tenants con trabajo pendiente. Un tenant ruidoso no acapara el pool.
+
+Si un turno no es admitido se lanza AgenteSaturado y el caller aplica el modo
+de sobrecarga (AGENT_OVERLOAD_MODE):
+  - defer:  se difiere a la cola durable (Redis Streams) para el worker.
+  - hold:   se manda un mensaje de espera al contacto y se difiere.
+  - reject: el webhook responde 429 para que el bridge reintente más tarde
+            (presupuesto propio de reintentos: WEBHOOK_OVERLOAD_RETRIES).
+  - wait:   se espera turno sin límite de cola (lo usa el worker, cuyos
+            consumidores ya son la contrapresión natural).
+
+Profundidad de cola, turnos en vuelo y rechazos se exportan en /metrics.
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from metrics import Contador, Gauge
+
+logger = logging.getLogger(__name__)
+
+AGENT_MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", "8"))
+AGENT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "32"))
+AGENT_MAX_PER_TENANT = int(os.getenv("AGENT_MAX_PER_TENANT", str(max(2, AGENT_MAX_WORKERS // 2))))
+AGENT_OVERLOAD_MODE = os.getenv("AGENT_OVERLOAD_MODE", "defer").lower()
+MODOS_SATURACION = ("defer", "hold", "reject", "wait")
+
+MENSAJE_ESPERA_DEFAULT = "¡Gracias por tu mensaje! Te respondo en un momento."
+
+COLA_AGENTE = Gauge("wtx_agent_queue_depth", "Turnos del agente esperando un thread libre")
+EN_VUELO_AGENTE = Gauge("wtx_agent_inflight", "Turnos del agente ejecutándose")
+RECHAZOS_AGENTE = Contador(
+    "wtx_agent_rejections_total",
+    "Turnos no admitidos por saturación, por modo aplicado",
+    ("mode", "usuario_id"),
+)
+
+
+class AgenteSaturado(Exception):
+    """El pool del agente no admite más turnos (global o para el tenant)."""
+
+    def __init__(self, usuario_id, motivo: str):
+        super().__init__(f"Agente saturado para usuario {usuario_id}: {motivo}")
+        self.usuario_id = usuario_id
+        self.motivo = motivo
+
+
+class AgentExecutor:
+    """ThreadPoolExecutor con cola acotada y despacho round-robin por tenant.
+
+    Todo el estado se toca solo desde el event loop (los callbacks de los
+    threads vuelven con call_soon_threadsafe), así que no necesita locks.
+    """
+
+    def __init__(self, max_workers: int, max_cola: int, max_por_tenant: int, modo: str):
+        self.max_workers = max_workers
+        self.max_cola = max_cola
+        self.max_por_tenant = max_por_tenant
+        self.modo = modo if modo in MODOS_SATURACION else "defer"
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agente")
+        self._colas: "OrderedDict[object, deque]" = OrderedDict()
+        self._por_tenant: dict = {}
+        self._en_vuelo = 0
+        self._en_cola = 0
+
+    # ── Estado / admisión ──
+
+    def saturado(self, usuario_id) -> Optional[str]:
+        """Motivo por el que un turno nuevo de este tenant no sería admitido."""
+        if self._por_tenant.get(usuario_id, 0) >= self.max_por_tenant:
+            return "tenant"
+        libres = self.max_workers - self._en_vuelo
+        if libres <= 0 and self._en_cola >= self.max_cola:
+            return "cola"
+        return None
+
+    def estado(self) -> dict:
+        return {
+            "en_vuelo": self._en_vuelo,
+            "en_cola": self._en_cola,
+            "max_workers": self.max_workers,
+            "max_cola": self.max_cola,
+            "max_por_tenant": self.max_por_tenant,
+            "modo": self.modo,
+        }
+
+    # ── Ejecución ──
+
+    async def ejecutar(self, usuario_id, fn: Callable, *args, esperar: bool = None):
+        """Correr fn(*args) en el pool respetando la admisión por tenant.
+
+        Lanza AgenteSaturado si no hay lugar, salvo que esperar=True (o el modo
+        del executor sea 'wait'), en cuyo caso el turno se encola igual.
+        """
+        if esperar is None:
+            esperar = self.modo == "wait"
+        motivo = self.saturado(usuario_id)
+        if motivo and not esperar:
+            raise AgenteSaturado(usuario_id, motivo)
+
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self._colas.setdefault(usuario_id, deque()).append((fn, args, futuro))
+        self._por_tenant[usuario_id] = self._por_tenant.get(usuario_id, 0) + 1
+        self._en_cola += 1
+        self._actualizar_gauges()
+        self._despachar(loop)
+        return await futuro
+
+    def _despachar(self, loop) -> None:
+        # Round-robin: se toma un turno del primer tenant y se lo manda al final
+        while self._en_vuelo < self.max_workers and self._colas:
+            usuario_id, cola = next(iter(self._colas.items()))
+            fn, args, futuro = cola.popleft()
+            if cola:
+                self._colas.move_to_end(usuario_id)
+            else:
+                del self._colas[usuario_id]
+            self._en_cola -= 1
+            if futuro.cancelled():
+                self._liberar(usuario_id)
+                continue
+            self._en_vuelo += 1
+            cf = self._pool.submit(fn, *args)
+            cf.add_done_callback(
+                lambda cf, u=usuario_id, f=futuro: loop.call_soon_threadsafe(self._terminar, loop, u, f, cf)
+            )
+        self._actualizar_gauges()
+
+    def _terminar(self, loop, usuario_id, futuro, cf) -> None:
+        self._en_vuelo -= 1
+        self._liberar(usuario_id)
+        if not futuro.cancelled():
+            exc = cf.exception()
+            if exc is not None:
+                futuro.set_exception(exc)
+            else:
+                futuro.set_result(cf.result())
+        self._despachar(loop)
+
+    def _liberar(self, usuario_id) -> None:
+        restantes = self._por_tenant.get(usuario_id, 1) - 1
+        if restantes <= 0:
+            self._por_tenant.pop(usuario_id, None)
+        else:
+            self._por_tenant[usuario_id] = restantes
+
+    def _actualizar_gauges(self) -> None:
+        COLA_AGENTE.set(self._en_cola)
+        EN_VUELO_AGENTE.set(self._en_vuelo)
+
+
+agent_executor = AgentExecutor(AGENT_MAX_WORKERS, AGENT_MAX_QUEUE, AGENT_MAX_PER_TENANT, AGENT_OVERLOAD_MODE)
@@ -0,0 +1,112 @@
+"""add wa_id to mensajes_conversacion (idempotent message ingestion)
+
+Adds a dedicated ``wa_id`` column (WhatsApp message id) to
+``mensajes_conversacion`` and a partial UNIQUE index on (usuario_id, wa_id),
+so redelivered webhook events become INSERT ... ON CONFLICT DO NOTHING no-ops
+instead of content-equality queries over the table.
+
+The column is backfilled from ``metadata_json->>'wa_id'`` (where the id was
+stored until now), normalized the same way the app writes it at runtime. The
+backfill parses the JSON in Python so a malformed legacy row is skipped
+instead of failing the migration. If historic duplicates share a wa_id, only
+the oldest row keeps it so the unique index can be built.
+
+Revision ID: b8c9d0e1f2a3
+Revises: a7b8c9d0e1f2
+Create Date: 2026-10-17
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b8c9d0e1f2a3"
+down_revision = "a7b8c9d0e1f2"
+branch_labels = None
+depends_on = None
+
+TABLE = "mensajes_conversacion"
+INDEX = "uq_msg_usuario_wa_id"
+LOTE = 5000
+
+
+def _has_column(inspector, table: str, column: str) -> bool:
+    try:
+        cols = [c["name"] for c in inspector.get_columns(table)]
+    except Exception:
+        return False
+    return column in cols
+
+
+def _normalizar_wa_id(raw):
+    """Copia congelada de message_service.normalizar_wa_id (las migraciones no
+    importan código de la app): "true_<chat>_<id>" -> "<id>"."""
+    if not raw:
+        return None
+    partes = str(raw).split("_")
+    if len(partes) >= 3 and partes[0] in ("true", "false"):
+        return partes[2] or None
+    return str(raw)[:128]
+
+
+def _backfill(bind):
+    """wa_id desde metadata_json, por lotes (keyset sobre id). Solo la fila más
+    antigua por (usuario_id, wa_id); JSON inválido se saltea."""
+    tomados = set(
+        bind.execute(sa.text(f"SELECT usuario_id, wa_id FROM {TABLE} WHERE wa_id IS NOT NULL")).fetchall()
+    )
+    seleccion = sa.text(
+        f"""
+        SELECT id, usuario_id, metadata_json FROM {TABLE}
+        WHERE id > :ultimo AND wa_id IS NULL AND metadata_json LIKE '%"wa_id"%'
+        ORDER BY id LIMIT {LOTE}
+        """
+    )
+    actualizar = sa.text(f"UPDATE {TABLE} SET wa_id = :wa WHERE id = :id")
+    ultimo = 0
+    while True:
+        filas = bind.execute(seleccion, {"ultimo": ultimo}).fetchall()
+        if not filas:
+            break
+        ultimo = filas[-1][0]
+        cambios = []
+        for id_, usuario_id, crudo in filas:
+            try:
+                metadata = json.loads(crudo)
+            except (TypeError, ValueError):
+                continue
+            wa = _normalizar_wa_id(metadata.get("wa_id")) if isinstance(metadata, dict) else None
+            if not wa or (usuario_id, wa) in tomados:
+                continue
+            tomados.add((usuario_id, wa))
+            cambios.append({"id": id_, "wa": wa})
+        if cambios:
+            bind.execute(actualizar, cambios)
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if TABLE not in set(inspector.get_table_names()):
+        return
+
+    if not _has_column(inspector, TABLE, "wa_id"):
+        op.add_column(TABLE, sa.Column("wa_id", sa.String(128), nullable=True))
+
+    _backfill(bind)
+
+    op.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {INDEX} "
+        f"ON {TABLE} (usuario_id, wa_id) WHERE wa_id IS NOT NULL"
+    )
+
+
+def downgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if TABLE not in set(inspector.get_table_names()):
+        return
+    op.execute(f"DROP INDEX IF EXISTS {INDEX}")
+    if _has_column(inspector, TABLE, "wa_id"):
+        op.drop_column(TABLE, "wa_id")
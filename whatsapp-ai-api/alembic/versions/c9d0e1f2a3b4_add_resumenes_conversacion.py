@@ -0,0 +1,53 @@
+"""add resumenes_conversacion (rolling summaries for the history window)
+
+One row per (usuario_id, telefono) with the accumulated summary of the older
+part of the conversation and the id of the last message it covers. The agent
+sends the summary plus the newest messages that fit the token budget
+(history_window.py); the summary is refreshed in the background every N
+messages.
+
+Revision ID: c9d0e1f2a3b4
+Revises: b8c9d0e1f2a3
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c9d0e1f2a3b4"
+down_revision = "b8c9d0e1f2a3"
+branch_labels = None
+depends_on = None
+
+TABLE = "resumenes_conversacion"
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if TABLE in inspector.get_table_names():
+        return  # already created by create_all on fresh DBs
+
+    op.create_table(
+        TABLE,
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("usuario_id", sa.Integer(), nullable=False),
+        sa.Column("perfil_id", sa.Integer(), nullable=True),
+        sa.Column("telefono", sa.String(length=20), nullable=False),
+        sa.Column("resumen", sa.Text(), nullable=False, server_default=""),
+        sa.Column("hasta_mensaje_id", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("mensajes_resumidos", sa.Integer(), server_default="0"),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now()),
+        sa.ForeignKeyConstraint(["usuario_id"], ["usuarios.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["perfil_id"], ["perfiles.id"], ondelete="CASCADE"),
+        sa.UniqueConstraint("usuario_id", "telefono", name="uq_resumen_usuario_telefono"),
+    )
+    op.create_index("ix_resumenes_conversacion_id", TABLE, ["id"])
+    op.create_index("ix_resumenes_conversacion_perfil_id", TABLE, ["perfil_id"])
+
+
+def downgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if TABLE in inspector.get_table_names():
+        op.drop_table(TABLE)
@@ -0,0 +1,61 @@
+"""add mensajes_usuario counter to contactos (incremental lead scoring)
+
+Lead scoring used to COUNT(*) the contact's user messages on every agent turn.
+The count now lives on the contact and is incremented when a message is
+inserted. This migration adds the column and backfills it from
+mensajes_conversacion in one set-based UPDATE.
+
+Revision ID: d0e1f2a3b4c5
+Revises: c9d0e1f2a3b4
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "d0e1f2a3b4c5"
+down_revision = "c9d0e1f2a3b4"
+branch_labels = None
+depends_on = None
+
+TABLE = "contactos"
+COLUMN = "mensajes_usuario"
+
+
+def _has_column(inspector, table: str, column: str) -> bool:
+    try:
+        cols = [c["name"] for c in inspector.get_columns(table)]
+    except Exception:
+        return False
+    return column in cols
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if TABLE not in set(inspector.get_table_names()):
+        return
+
+    if not _has_column(inspector, TABLE, COLUMN):
+        op.add_column(TABLE, sa.Column(COLUMN, sa.Integer(), nullable=True, server_default="0"))
+
+    op.execute(
+        f"""
+        UPDATE {TABLE} c
+        SET {COLUMN} = m.n
+        FROM (
+            SELECT usuario_id, telefono, COUNT(*) AS n
+            FROM mensajes_conversacion
+            WHERE rol = 'user' AND tipo_evento IS NULL
+            GROUP BY usuario_id, telefono
+        ) m
+        WHERE c.usuario_id = m.usuario_id AND c.telefono = m.telefono
+        """
+    )
+
+
+def downgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if _has_column(inspector, TABLE, COLUMN):
+        op.drop_column(TABLE, COLUMN)
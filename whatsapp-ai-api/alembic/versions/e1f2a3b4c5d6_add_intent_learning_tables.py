@@ -0,0 +1,65 @@
+"""add ejemplos_intencion and modelos_intencion (local intent model)
+
+ejemplos_intencion stores the AI classifier decisions (normalized message ->
+skill) as training data; modelos_intencion stores one trained model per
+profile, used as a level between keyword matching and the mini-AI call.
+
+Revision ID: e1f2a3b4c5d6
+Revises: d0e1f2a3b4c5
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e1f2a3b4c5d6"
+down_revision = "d0e1f2a3b4c5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    tablas = sa.inspect(bind).get_table_names()
+
+    # Pueden existir ya por create_all en DBs nuevas
+    if "ejemplos_intencion" not in tablas:
+        op.create_table(
+            "ejemplos_intencion",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("usuario_id", sa.Integer(), nullable=False),
+            sa.Column("perfil_id", sa.Integer(), nullable=True),
+            sa.Column("mensaje", sa.String(length=300), nullable=False),
+            sa.Column("skill", sa.String(length=50), nullable=False),
+            sa.Column("confianza", sa.Float(), server_default="0"),
+            sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+            sa.ForeignKeyConstraint(["usuario_id"], ["usuarios.id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(["perfil_id"], ["perfiles.id"], ondelete="CASCADE"),
+        )
+        op.create_index("ix_ejemplos_intencion_id", "ejemplos_intencion", ["id"])
+        op.create_index("ix_ejemplos_intencion_perfil", "ejemplos_intencion", ["usuario_id", "perfil_id", "id"])
+
+    if "modelos_intencion" not in tablas:
+        op.create_table(
+            "modelos_intencion",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("usuario_id", sa.Integer(), nullable=False),
+            sa.Column("perfil_id", sa.Integer(), nullable=True),
+            sa.Column("modelo", sa.Text(), nullable=False),
+            sa.Column("ejemplos", sa.Integer(), server_default="0"),
+            sa.Column("hasta_ejemplo_id", sa.Integer(), server_default="0"),
+            sa.Column("exactitud", sa.Float(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now()),
+            sa.ForeignKeyConstraint(["usuario_id"], ["usuarios.id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(["perfil_id"], ["perfiles.id"], ondelete="CASCADE"),
+            sa.UniqueConstraint("usuario_id", "perfil_id", name="uq_modelo_intencion_perfil"),
+        )
+        op.create_index("ix_modelos_intencion_id", "modelos_intencion", ["id"])
+
+
+def downgrade():
+    bind = op.get_bind()
+    tablas = sa.inspect(bind).get_table_names()
+    for tabla in ("modelos_intencion", "ejemplos_intencion"):
+        if tabla in tablas:
+            op.drop_table(tabla)
@@ -0,0 +1,73 @@
+"""add usos_llm ledger and usos_llm_diarios rollup
+
+usos_llm records every LLM call (tokens, model, latency, call site) per
+(usuario_id, perfil_id), written in batches by llm_usage. The worker folds
+it into usos_llm_diarios, which backs the dashboard usage endpoint.
+
+Revision ID: f2a3b4c5d6e7
+Revises: e1f2a3b4c5d6
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "f2a3b4c5d6e7"
+down_revision = "e1f2a3b4c5d6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    tablas = sa.inspect(bind).get_table_names()
+
+    # Pueden existir ya por create_all en DBs nuevas
+    if "usos_llm" not in tablas:
+        op.create_table(
+            "usos_llm",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("usuario_id", sa.Integer(), nullable=True),
+            sa.Column("perfil_id", sa.Integer(), nullable=True),
+            sa.Column("sitio", sa.String(length=30), nullable=False),
+            sa.Column("modelo", sa.String(length=50), nullable=False),
+            sa.Column("prompt_tokens", sa.Integer(), server_default="0"),
+            sa.Column("completion_tokens", sa.Integer(), server_default="0"),
+            sa.Column("cached_tokens", sa.Integer(), server_default="0"),
+            sa.Column("latencia_ms", sa.Integer(), server_default="0"),
+            sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+            sa.ForeignKeyConstraint(["usuario_id"], ["usuarios.id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(["perfil_id"], ["perfiles.id"], ondelete="CASCADE"),
+        )
+        op.create_index("ix_usos_llm_id", "usos_llm", ["id"])
+        op.create_index("ix_usos_llm_created_at", "usos_llm", ["created_at"])
+
+    if "usos_llm_diarios" not in tablas:
+        op.create_table(
+            "usos_llm_diarios",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("fecha", sa.Date(), nullable=False),
+            sa.Column("usuario_id", sa.Integer(), nullable=True),
+            sa.Column("perfil_id", sa.Integer(), nullable=True),
+            sa.Column("sitio", sa.String(length=30), nullable=False),
+            sa.Column("modelo", sa.String(length=50), nullable=False),
+            sa.Column("llamadas", sa.Integer(), server_default="0"),
+            sa.Column("prompt_tokens", sa.BigInteger(), server_default="0"),
+            sa.Column("completion_tokens", sa.BigInteger(), server_default="0"),
+            sa.Column("cached_tokens", sa.BigInteger(), server_default="0"),
+            sa.Column("latencia_ms_total", sa.BigInteger(), server_default="0"),
+            sa.Column("latencia_ms_max", sa.Integer(), server_default="0"),
+            sa.ForeignKeyConstraint(["usuario_id"], ["usuarios.id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(["perfil_id"], ["perfiles.id"], ondelete="CASCADE"),
+        )
+        op.create_index("ix_usos_llm_diarios_id", "usos_llm_diarios", ["id"])
+        op.create_index("ix_usos_llm_diarios_fecha", "usos_llm_diarios", ["fecha"])
+        op.create_index("ix_usos_llm_diarios_tenant", "usos_llm_diarios", ["usuario_id", "perfil_id", "fecha"])
+
+
+def downgrade():
+    bind = op.get_bind()
+    tablas = sa.inspect(bind).get_table_names()
+    for tabla in ("usos_llm_diarios", "usos_llm"):
+        if tabla in tablas:
+            op.drop_table(tabla)
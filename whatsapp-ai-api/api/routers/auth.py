@@ -181,6 +181,10 @@ async def delete_user(
         
         db.delete(user)
         db.commit()
+
+        # Sus perfiles desaparecen por cascade: sacarlos de la tabla de ruteo
+        from tenant import invalidar_tabla_ruteo
+        invalidar_tabla_ruteo()
         return {"status": "ok", "message": "User deleted"}
     finally:
         db.close()
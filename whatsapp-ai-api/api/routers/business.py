@@ -103,6 +103,16 @@ async def get_onboarding_status(
     return {"onboarding_completed": config.onboarding_completed}
 
 
+def _invalidar_config_cacheada(usuario_id: int) -> None:
+    """Tras escribir Configuracion sin pasar por set_config: descartar la config
+    cacheada y el prefijo estático del prompt (también en los demás procesos)."""
+    from database import invalidate_config_cache
+    from prompt_builder import invalidar_prefijo
+
+    invalidate_config_cache()
+    invalidar_prefijo(usuario_id)
+
+
 def init_all_default_data(db: Session, usuario_id: int = 0):
     """Inicializar todos los datos por defecto si no existen"""
     initialized = []
@@ -183,6 +193,8 @@ Siempre saluda al cliente y ofrece ayuda.""",
             initialized.append(f"config:{clave}")
 
     db.commit()
+    # Escrituras directas (sin set_config): invalidar caches a mano
+    _invalidar_config_cacheada(current_user.id)
 
     return {"status": "ok", "message": "Onboarding saltado, todo activado", "initialized": initialized}
 
@@ -209,13 +221,15 @@ class ChatMessage(BaseModel):
 async def setup_chat(
     data: ChatMessage,
     db: Session = Depends(get_db),
-    current_user: Usuario = Depends(get_current_user)
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
 ):
     import json
     from agent import get_openai_client
+    from llm_resilience import completar_async
 
     try:
-        client = get_openai_client()
+        get_openai_client(current_user.id)  # valida la API key
     except ValueError:
         return {
             "response": "La API key de OpenAI no esta configurada. Ve a Configuracion > API Keys para agregarla.",
@@ -288,7 +302,10 @@ CUANDO TENGAS TODO, responde con:
     messages.append({"role": "user", "content": data.message})
 
     try:
-        response = client.chat.completions.create(
+        response = await completar_async(
+            "setup_chat",
+            current_user.id,
+            perfil_id=perfil.id,
             model="gpt-4o-mini",
             messages=messages,
             temperature=0.7,
@@ -405,9 +422,10 @@ async def generate_prompts_from_config(config_data: dict, db, usuario_id: int =
     """Genera prompts personalizados basados en la configuracion"""
     import json
     from agent import get_openai_client
+    from llm_resilience import completar_async
 
     try:
-        client = get_openai_client()
+        get_openai_client(usuario_id or None)  # valida la API key
     except ValueError:
         return
 
@@ -430,7 +448,10 @@ Responde SOLO con JSON:
 }}"""
 
     try:
-        response = client.chat.completions.create(
+        response = await completar_async(
+            "setup_chat",
+            usuario_id or None,
+            perfil_id=perfil_id,
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.7,
@@ -556,6 +577,7 @@ async def factory_reset(
         if 'configuracion' in sections:
             initialized = init_all_default_data(db, usuario_id=uid)
             db.commit()
+            _invalidar_config_cacheada(uid)
 
         return {
             "status": "ok",
@@ -512,20 +512,22 @@ async def preview_mensaje(
 @router.post("/mejorar-mensaje")
 async def mejorar_mensaje_ia(
     data: dict,
-    current_user: Usuario = Depends(get_current_user)
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
 ):
     """
     Usar IA para generar o mejorar un mensaje de campaña.
     Body: { "mensaje": "texto actual", "objetivo": "promocion|reactivacion|informativo|personalizado", "instrucciones": "opcional" }
     """
     from agent import get_openai_client
+    from llm_resilience import completar_async
 
     mensaje_actual = data.get("mensaje", "").strip()
     objetivo = data.get("objetivo", "promocion")
     instrucciones = data.get("instrucciones", "").strip()
 
     try:
-        client = get_openai_client()
+        get_openai_client(current_user.id)  # valida la API key
     except ValueError:
         raise HTTPException(status_code=400, detail="API key de OpenAI no configurada. Ve a Configuración > API Keys.")
 
@@ -574,7 +576,10 @@ Requisitos:
 - Responde SOLO con el mensaje, sin explicaciones"""
 
     try:
-        response = client.chat.completions.create(
+        response = await completar_async(
+            "mejorar_mensaje",
+            current_user.id,
+            perfil_id=perfil.id,
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.8,
@@ -7,7 +7,7 @@ import os
 from datetime import datetime, timedelta
 from fastapi import APIRouter, HTTPException, Depends
 from sqlalchemy.orm import Session
-from openai import OpenAI
+from llm_resilience import completar_async
 
 from database import (
     get_config,
@@ -140,6 +140,12 @@ async def update_prompt(
             deleted_new = db.query(MensajeConversacion).filter(
                 MensajeConversacion.usuario_id == current_user.id
             ).delete()
+            from models import ResumenConversacion
+            db.query(ResumenConversacion).filter(
+                ResumenConversacion.usuario_id == current_user.id
+            ).delete()
+            from lead_scoring import recontar_mensajes_usuario
+            recontar_mensajes_usuario(db, current_user.id)
             db.commit()
             response["memoria_limpiada"] = deleted_legacy + deleted_new
         except Exception as e:
@@ -159,14 +165,14 @@ async def update_prompt(
     description="Use GPT to automatically improve and optimize prompt sections for better agent responses.",
 )
 async def improve_prompt(
-    data: ImprovePromptModel, current_user: Usuario = Depends(get_current_user)
+    data: ImprovePromptModel,
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
 ):
     api_key = get_config("openai_api_key", "", usuario_id=current_user.id) or os.getenv("OPENAI_API_KEY", "")
     if not api_key:
         raise HTTPException(status_code=400, detail="No OpenAI API key configured")
 
-    client = OpenAI(api_key=api_key)
-
     section_names = {
         "role": "Rol (quién es el agente)",
         "context": "Contexto (situación del negocio)",
@@ -196,7 +202,11 @@ Instrucciones:
 - Máximo 3-4 oraciones
 - Responde SOLO con el texto mejorado, sin explicaciones"""
 
-            response = client.chat.completions.create(
+            response = await completar_async(
+                "mejorar_prompt",
+                current_user.id,
+                api_key=api_key,
+                perfil_id=perfil.id,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.7,
@@ -238,7 +248,11 @@ Instrucciones:
 - Máximo 4-5 oraciones
 - Responde SOLO con el texto mejorado, sin explicaciones ni comillas"""
 
-        response = client.chat.completions.create(
+        response = await completar_async(
+            "mejorar_prompt",
+            current_user.id,
+            api_key=api_key,
+            perfil_id=perfil.id,
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.7,
@@ -393,9 +407,17 @@ async def get_agent_config(
         ),
         # Tab Config IA
         "model": get_config("model", "gpt-4o-mini", usuario_id=uid, perfil_id=pid),
+        "fallback_model": get_config("fallback_model", "gpt-4o-mini", usuario_id=uid, perfil_id=pid),
         "temperature": float(get_config("temperature", "0.7", usuario_id=uid, perfil_id=pid)),
         "max_tokens": int(get_config("max_tokens", "500", usuario_id=uid, perfil_id=pid)),
         "custom_instructions": get_config("custom_instructions", "", usuario_id=uid, perfil_id=pid),
+        "message_debounce_seconds": float(get_config("message_debounce_seconds", "0", usuario_id=uid, perfil_id=pid) or 0),
+        "streaming_enabled": get_config("streaming_enabled", "false", usuario_id=uid, perfil_id=pid).lower() == "true",
+        "history_token_budget": int(get_config("history_token_budget", "1500", usuario_id=uid, perfil_id=pid) or 1500),
+        "history_summary_every": int(get_config("history_summary_every", "10", usuario_id=uid, perfil_id=pid) or 10),
+        "intent_classification_mode": get_config("intent_classification_mode", "ai", usuario_id=uid, perfil_id=pid),
+        "local_intent_model": get_config("local_intent_model", "true", usuario_id=uid, perfil_id=pid).lower() == "true",
+        "local_intent_threshold": float(get_config("local_intent_threshold", "0.9", usuario_id=uid, perfil_id=pid) or 0.9),
         # API Key (masked) — vive a nivel USUARIO (la cascada cae a perfil_id=0)
         "openai_api_key": (
             lambda k: k[:8] + "..." if len(k) > 8 else ("Configurada" if k else "")
@@ -432,9 +454,17 @@ async def update_agent_config(
         "human_mode_expire_hours",
         "human_mode_reactivar_command",
         "model",
+        "fallback_model",
         "temperature",
         "max_tokens",
         "custom_instructions",
+        "message_debounce_seconds",
+        "streaming_enabled",
+        "history_token_budget",
+        "history_summary_every",
+        "intent_classification_mode",
+        "local_intent_model",
+        "local_intent_threshold",
     ]
 
     for key in allowed_keys:
@@ -552,6 +582,7 @@ async def test_chat(
             contacto.paso_funnel = None
             contacto.datos_capturados = None
             contacto.lead_score = 0
+            contacto.mensajes_usuario = 0
             contacto.modo_humano = False
             db.commit()
             return {"respuesta": "Conversación reiniciada", "tools_called": [], "reset": True}
@@ -560,7 +591,7 @@ async def test_chat(
 
     try:
         import re
-        from agent import responder, build_system_prompt
+        from agent import responder_async, build_system_prompt
 
         # Get prompt preview
         db2 = SessionLocal()
@@ -573,7 +604,7 @@ async def test_chat(
         before_call = datetime.utcnow()
 
         # Call the agent
-        respuesta = responder(mensaje, test_phone, uid, perfil_id=pid)
+        respuesta = await responder_async(mensaje, test_phone, uid, perfil_id=pid, esperar=True)
 
         # Clean markdown image syntax — doesn't render in WhatsApp
         respuesta = re.sub(r'!\[.*?\]\(.*?\)\s*', '', respuesta)
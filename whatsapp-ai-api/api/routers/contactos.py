@@ -10,7 +10,7 @@ import json
 import csv
 import io
 
-from models import get_db, Contacto, Perfil
+from models import get_db, Contacto, Perfil, commit_or_flush
 from api.routers.auth import get_current_user
 from api.routers.perfiles import get_current_perfil
 from auth import get_current_admin_user
@@ -670,6 +670,62 @@ def guardar_contacto_mensaje(telefono: str, nombre: str = None, db: Session = No
             db.close()
 
 
+def guardar_contactos_lote(db: Session, usuario_id: int, perfil_id: int, actividad: dict) -> None:
+    """
+    Versión en lote de guardar_contacto_mensaje para el webhook batch.
+    actividad: {telefono: {"nombre": str, "mensajes": int, "mensajes_usuario": int}}.
+    Una sola consulta para los contactos existentes del usuario; no hace commit
+    (lo hace el caller).
+    """
+    por_norm = {}
+    for telefono, info in actividad.items():
+        if not telefono or "@g.us" in telefono:
+            continue
+        norm = normalizar_telefono(telefono)
+        acumulado = por_norm.setdefault(norm, {"nombre": None, "mensajes": 0, "mensajes_usuario": 0})
+        acumulado["mensajes"] += info.get("mensajes", 0)
+        acumulado["mensajes_usuario"] += info.get("mensajes_usuario", 0)
+        if info.get("nombre"):
+            acumulado["nombre"] = info["nombre"].strip()
+    if not por_norm:
+        return
+
+    existentes = {
+        c.telefono: c
+        for c in db.query(Contacto).filter(
+            Contacto.usuario_id == usuario_id,
+            Contacto.telefono.in_(list(por_norm.keys())),
+        )
+    }
+    ahora = datetime.utcnow()
+    for telefono_norm, info in por_norm.items():
+        contacto = existentes.get(telefono_norm)
+        nombre_limpio = info["nombre"] or None
+        if contacto:
+            contacto.ultimo_mensaje = ahora
+            contacto.total_mensajes = (contacto.total_mensajes or 0) + info["mensajes"]
+            contacto.mensajes_usuario = (contacto.mensajes_usuario or 0) + info["mensajes_usuario"]
+            if nombre_limpio and (not contacto.nombre or contacto.nombre == "Sin nombre"):
+                contacto.nombre = nombre_limpio
+            if contacto.estado == "inactivo":
+                contacto.estado = "activo"
+            if contacto.perfil_id is None and perfil_id is not None:
+                contacto.perfil_id = perfil_id
+        else:
+            db.add(Contacto(
+                telefono=telefono_norm,
+                nombre=nombre_limpio,
+                primer_mensaje=ahora,
+                ultimo_mensaje=ahora,
+                total_mensajes=info["mensajes"],
+                mensajes_usuario=info["mensajes_usuario"],
+                estado="activo",
+                origen="mensaje",
+                usuario_id=usuario_id,
+                perfil_id=perfil_id,
+            ))
+
+
 # ==================== MODO HUMANO ====================
 
 @router.get("/modo-humano", summary="List human mode contacts", description="Get all contacts currently in human takeover mode where AI is paused.")
@@ -759,7 +815,7 @@ def activar_modo_humano_por_telefono(telefono: str, razon: str, db: Session = No
             contacto.modo_humano = True
             contacto.modo_humano_desde = datetime.utcnow()
             contacto.modo_humano_razon = razon
-            db.commit()
+            commit_or_flush(db)
             return True
         return False
     finally:
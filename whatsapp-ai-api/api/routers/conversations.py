@@ -13,7 +13,7 @@ from pydantic import BaseModel
 from models import SessionLocal, Memoria, Contacto, Usuario, MensajeConversacion, Perfil
 from auth import get_current_user
 from api.routers.perfiles import get_current_perfil
-from message_service import MessageService
+from message_service import MessageService, memoria_migrada
 
 logger = logging.getLogger(__name__)
 
@@ -75,8 +75,9 @@ async def get_conversations(
         total = result["total"]
         new_phones = {c["telefono"] for c in new_convs}
 
-        # Tambien buscar en tabla legacy Memoria (contactos no migrados) - limited
-        memorias = (
+        # Tambien buscar en tabla legacy Memoria (contactos no migrados) - limited.
+        # Tras la migración masiva (worker.py --migrar-memoria) ya no hace falta.
+        memorias = [] if memoria_migrada() else (
             db.query(Memoria)
             .filter(
                 Memoria.usuario_id == current_user.id,
@@ -300,30 +301,11 @@ async def send_message(
     # Guardar en nueva tabla de mensajes
     db = SessionLocal()
     try:
-        MessageService.add_message(
-            db, phone, "assistant", data.message, usuario_id=current_user.id, metadata=msg_metadata, perfil_id=perfil.id
+        # El eco del bridge puede haber llegado antes: insert-if-absent por wa_id
+        MessageService.add_message_if_absent(
+            db, phone, "assistant", data.message, sent_wa_id,
+            usuario_id=current_user.id, metadata=msg_metadata, perfil_id=perfil.id,
         )
-
-        # Tambien legacy
-        memoria = db.query(Memoria).filter(
-            Memoria.telefono == phone,
-            Memoria.usuario_id == current_user.id,
-            Memoria.perfil_id == perfil.id,
-        ).first()
-        if memoria:
-            try:
-                historial = json.loads(memoria.historial) if memoria.historial else []
-            except (json.JSONDecodeError, TypeError):
-                historial = []
-        else:
-            historial = []
-            memoria = Memoria(telefono=phone, historial="[]", usuario_id=current_user.id, perfil_id=perfil.id)
-            db.add(memoria)
-
-        historial.append({"role": "assistant", "content": data.message})
-        memoria.historial = json.dumps(historial)
-        memoria.updated_at = datetime.utcnow()
-        db.commit()
     except Exception as e:
         db.rollback()
         logger.error(f"Error saving sent message: {e}")
@@ -424,8 +406,9 @@ async def send_image(
     # Guardar en nueva tabla de mensajes
     db = SessionLocal()
     try:
-        MessageService.add_message(
-            db, phone, "assistant", contenido, usuario_id=current_user.id, metadata=msg_metadata, perfil_id=perfil.id
+        MessageService.add_message_if_absent(
+            db, phone, "assistant", contenido, sent_wa_id,
+            usuario_id=current_user.id, metadata=msg_metadata, perfil_id=perfil.id,
         )
     except Exception as e:
         db.rollback()
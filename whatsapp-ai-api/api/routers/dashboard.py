@@ -4,7 +4,7 @@ Dashboard Router - Metricas de negocio enfocadas en resultados del bot
 
 import json
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from sqlalchemy import func, desc, distinct
 from sqlalchemy.orm import Session
 from models import (
@@ -16,6 +16,7 @@ from models import (
     FunnelPaso,
     Campana,
     CampanaDestinatario,
+    UsoLLMDiario,
 )
 from database import get_config
 from auth import get_current_user
@@ -347,6 +348,69 @@ async def get_trend(
     return days
 
 
+@router.get("/llm-usage")
+async def get_llm_usage(
+    days: int = Query(30, ge=1, le=90),
+    db: Session = Depends(get_db),
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
+):
+    """Tokens y latencia del LLM del perfil (rollup diario de llm_usage;
+    el día en curso se actualiza cada hora).
+
+    `tenant_total` suma todo el usuario: sus perfiles y las llamadas sin perfil
+    (perfil_id NULL, p. ej. las que no vienen de un perfil activo)."""
+    desde = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows = (
+        db.query(UsoLLMDiario)
+        .filter(
+            UsoLLMDiario.usuario_id == current_user.id,
+            UsoLLMDiario.fecha >= desde,
+        )
+        .order_by(UsoLLMDiario.fecha)
+        .all()
+    )
+
+    def _vacio():
+        return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "_latencia": 0}
+
+    total, tenant_total, sin_perfil = _vacio(), _vacio(), _vacio()
+    por_dia, por_sitio, por_modelo = {}, {}, {}
+    for r in rows:
+        acumuladores = [tenant_total]
+        if r.perfil_id == perfil.id:
+            acumuladores += [
+                total,
+                por_dia.setdefault(r.fecha.isoformat(), _vacio()),
+                por_sitio.setdefault(r.sitio, _vacio()),
+                por_modelo.setdefault(r.modelo, _vacio()),
+            ]
+        elif r.perfil_id is None:
+            acumuladores.append(sin_perfil)
+        for acc in acumuladores:
+            acc["calls"] += r.llamadas
+            acc["prompt_tokens"] += r.prompt_tokens
+            acc["completion_tokens"] += r.completion_tokens
+            acc["cached_tokens"] += r.cached_tokens
+            acc["_latencia"] += r.latencia_ms_total
+
+    def _cerrar(acc: dict, **extra) -> dict:
+        latencia = acc.pop("_latencia")
+        acc["avg_latency_ms"] = round(latencia / acc["calls"]) if acc["calls"] else 0
+        acc["total_tokens"] = acc["prompt_tokens"] + acc["completion_tokens"]
+        return {**extra, **acc}
+
+    return {
+        "days": days,
+        "total": _cerrar(total),
+        "tenant_total": _cerrar(tenant_total),
+        "unassigned_total": _cerrar(sin_perfil),
+        "by_day": [_cerrar(acc, date=dia) for dia, acc in sorted(por_dia.items())],
+        "by_site": [_cerrar(acc, site=sitio) for sitio, acc in por_sitio.items()],
+        "by_model": [_cerrar(acc, model=modelo) for modelo, acc in por_modelo.items()],
+    }
+
+
 @router.get("/alerts")
 async def get_alerts(
     db: Session = Depends(get_db),
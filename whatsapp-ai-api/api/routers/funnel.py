@@ -197,3 +197,76 @@ async def funnel_stats(
         return {"steps": stats, "sin_paso": sin_paso}
     finally:
         db.close()
+
+
+# ─── Lead scoring ────────────────────────────────────────────────────────
+
+
+def _encolar_recalculo_leads(db, usuario_id: int, perfil_id: int) -> dict:
+    """Encolar el job de recalculo del perfil (o devolver el que ya está en cola)."""
+    from models import BackgroundJob
+    from redis_queue import encolar_job
+
+    job = db.query(BackgroundJob).filter(
+        BackgroundJob.tipo == "recalcular_leads",
+        BackgroundJob.usuario_id == usuario_id,
+        BackgroundJob.perfil_id == perfil_id,
+        BackgroundJob.estado == "pendiente",
+    ).first()
+    if job:
+        return job.to_dict()
+
+    job = BackgroundJob(
+        tipo="recalcular_leads",
+        estado="pendiente",
+        mensaje="En cola, esperando worker...",
+        usuario_id=usuario_id,
+        perfil_id=perfil_id,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    encolar_job(job.id, "recalcular_leads")
+    return job.to_dict()
+
+
+@router.get("/lead-scoring", summary="Get lead scoring weights")
+async def get_lead_scoring(
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
+):
+    from lead_scoring import PESOS_DEFAULT, pesos_scoring
+
+    return {"pesos": pesos_scoring(current_user.id, perfil.id), "default": PESOS_DEFAULT}
+
+
+@router.put("/lead-scoring", summary="Update lead scoring weights and rescore contacts")
+async def update_lead_scoring(
+    data: dict,
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
+):
+    """Guardar pesos del perfil y encolar el recalculo de todos sus contactos."""
+    from database import set_config
+    from lead_scoring import normalizar_pesos
+
+    pesos = normalizar_pesos(data.get("pesos", data))
+    set_config("lead_scoring_weights", json.dumps(pesos), usuario_id=current_user.id, perfil_id=perfil.id)
+    db = SessionLocal()
+    try:
+        job = _encolar_recalculo_leads(db, current_user.id, perfil.id)
+    finally:
+        db.close()
+    return {"status": "ok", "pesos": pesos, "job": job}
+
+
+@router.post("/lead-scoring/recalcular", summary="Rescore all contacts of the profile")
+async def recalcular_lead_scoring(
+    current_user: Usuario = Depends(get_current_user),
+    perfil: Perfil = Depends(get_current_perfil),
+):
+    db = SessionLocal()
+    try:
+        return {"status": "iniciado", "job": _encolar_recalculo_leads(db, current_user.id, perfil.id)}
+    finally:
+        db.close()
@@ -10,6 +10,7 @@ from datetime import datetime
 
 from models import get_db, Perfil, Usuario
 from api.routers.auth import get_current_user
+from tenant import invalidar_tabla_ruteo, perfil_activo_cacheado
 
 router = APIRouter(
     prefix="/perfiles",
@@ -51,6 +52,7 @@ def _ensure_default_perfil(db: Session, usuario_id: int) -> Perfil:
     db.add(perfil)
     db.commit()
     db.refresh(perfil)
+    invalidar_tabla_ruteo()
     return perfil
 
 
@@ -100,10 +102,14 @@ def get_perfil_activo_id(db, usuario_id) -> Optional[int]:
     """Plain helper for background (no HTTP request).
 
     Returns the id of the user's active profile (or first profile, or None).
-    Does NOT create a profile if none exists.
+    Does NOT create a profile if none exists. Se sirve desde la tabla de ruteo
+    en memoria (tenant.py); la DB solo se consulta si el usuario no está en ella.
     """
     if usuario_id is None:
         return None
+    cacheado = perfil_activo_cacheado(usuario_id)
+    if cacheado is not None:
+        return cacheado
     perfil = db.query(Perfil).filter(
         Perfil.usuario_id == usuario_id,
         Perfil.es_activo == True,  # noqa: E712
@@ -144,6 +150,7 @@ async def create_perfil(
     db.add(perfil)
     db.commit()
     db.refresh(perfil)
+    invalidar_tabla_ruteo()
     return perfil.to_dict()
 
 
@@ -192,6 +199,7 @@ async def delete_perfil(
         if next_perfil:
             next_perfil.es_activo = True
             db.commit()
+    invalidar_tabla_ruteo()
     return {"status": "ok"}
 
 
@@ -210,4 +218,5 @@ async def activar_perfil(
     perfil.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(perfil)
+    invalidar_tabla_ruteo()
     return perfil.to_dict()
@@ -1,9 +1,9 @@
 """
 Stats Router - Dashboard metrics and analytics
 """
-import json
 from fastapi import APIRouter, Depends
-from models import SessionLocal, Memoria, Usuario, Perfil
+from sqlalchemy import func
+from models import SessionLocal, MensajeConversacion, Usuario, Perfil
 from auth import get_current_user
 from api.routers.perfiles import get_current_perfil
 
@@ -24,23 +24,20 @@ async def get_stats(
     try:
         uid = current_user.id
         pid = perfil.id
-        conversations = db.query(Memoria).filter(
-            Memoria.usuario_id == uid, Memoria.perfil_id == pid,
-            ~Memoria.telefono.like("test%"),  # Excluir prueba (test-chat)
-        ).count()
-
-        memorias = db.query(Memoria).filter(
-            Memoria.usuario_id == uid, Memoria.perfil_id == pid,
-            ~Memoria.telefono.like("test%"),  # Excluir prueba (test-chat)
-        ).all()
-        total_messages = 0
-        for m in memorias:
-            if m.historial:
-                try:
-                    historial = json.loads(m.historial)
-                    total_messages += len(historial)
-                except:
-                    pass
+        # Desde mensajes_conversacion (la tabla legacy Memoria ya no se escribe)
+        conversations, total_messages = (
+            db.query(
+                func.count(func.distinct(MensajeConversacion.telefono)),
+                func.count(MensajeConversacion.id),
+            )
+            .filter(
+                MensajeConversacion.usuario_id == uid,
+                MensajeConversacion.perfil_id == pid,
+                MensajeConversacion.tipo_evento == None,
+                ~MensajeConversacion.telefono.like("test%"),  # Excluir prueba (test-chat)
+            )
+            .one()
+        )
 
         return {
             "totalConversations": conversations,
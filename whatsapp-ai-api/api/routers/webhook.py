@@ -10,13 +10,12 @@ from fastapi import APIRouter, Request, Response, HTTPException
 
 from whatsapp_service import parse_webhook_message, whatsapp_service
 from database import get_config
-from agent import responder
+from agent import responder_async
 from ws_manager import ws_manager
 from api.routers.contactos import (
     guardar_contacto_mensaje,
     desactivar_modo_humano_por_telefono,
     verificar_modo_humano,
-    activar_modo_humano_por_telefono,
 )
 from campaign_engine import marcar_respondido
 
@@ -44,260 +43,236 @@ def _verify_webhook_token(request: Request) -> None:
         raise HTTPException(status_code=401, detail="Invalid webhook token")
 
 
-def detectar_trigger_modo_humano(mensaje: str, respuesta: str, usuario_id: int = None, perfil_id: int = None) -> bool:
+def detectar_trigger_modo_humano(mensaje: str, respuesta: str = "", usuario_id: int = None, perfil_id: int = None) -> bool:
     """
-    Detectar si el mensaje o respuesta contiene triggers para activar modo humano.
-    Two-layer system:
-      Layer 1: Fast keyword pre-filter
-      Layer 2: AI intent classification to reduce false positives
+    Detectar si el mensaje del cliente contiene triggers para activar modo humano.
+
+    Delegado a intent_classifier.classify_by_human_triggers, la misma etapa que
+    corre `responder` ANTES de generar la respuesta (keywords por categoría +
+    custom triggers + a lo sumo una verificación con mini-AI). La respuesta del
+    agente no se evalúa: puede contener palabras trigger de forma natural.
     Retorna True si se debe activar modo humano.
     """
-    # Layer 1: Quick keyword pre-filter
-    keyword_match = _check_keyword_triggers(mensaje, respuesta, usuario_id, perfil_id)
-    if not keyword_match:
-        return False
+    from intent_classifier import classify_by_human_triggers
+
+    return classify_by_human_triggers(mensaje, usuario_id or 1, perfil_id=perfil_id) is not None
 
-    trigger_type, keyword = keyword_match
-    logger.info(f"Layer 1 keyword match: {trigger_type} (keyword: {keyword})")
 
-    # Check if AI classification is enabled
-    ai_enabled = get_config("human_mode_ai_classification", "true", usuario_id=usuario_id, perfil_id=perfil_id).lower() == "true"
-    if not ai_enabled:
-        logger.info("AI classification disabled, using keyword match only")
-        return True
+router = APIRouter(tags=["Webhook"])
 
-    # Layer 2: AI intent classification
-    return _classify_trigger_intent(mensaje, trigger_type, keyword, usuario_id)
+# Modo asíncrono: el webhook solo valida y persiste el evento en la cola durable
+# (Redis Streams) y responde de inmediato; los consumidores de worker.py corren
+# el pipeline del agente. Si la cola no está disponible se procesa inline.
+WEBHOOK_ASYNC_MODE = os.getenv("WEBHOOK_ASYNC_MODE", "false").lower() == "true"
+# Un mensaje reentregado sin respuesta y más nuevo que esto se da por duplicado
+# (su turno original sigue en vuelo: reintento del bridge). Más viejo, el turno
+# se perdió y se vuelve a correr. Debe ser menor que INBOUND_RECLAIM_IDLE_MS.
+TURNO_EN_VUELO_SECONDS = float(os.getenv("TURNO_EN_VUELO_SECONDS", "45"))
+
+
+def _json_response(payload: dict, status_code: int = 200) -> Response:
+    return Response(
+        content=json.dumps(payload),
+        media_type="application/json",
+        status_code=status_code,
+    )
 
 
-def _check_keyword_triggers(mensaje: str, respuesta: str, usuario_id: int = None, perfil_id: int = None):
-    """
-    Layer 1: Fast keyword pre-filter.
-    Returns (trigger_type, keyword) tuple if match found, None otherwise.
-    """
-    triggers_str = get_config(
-        "human_mode_triggers", '["frustration","complaint","human_request"]',
-        usuario_id=usuario_id, perfil_id=perfil_id,
+def _limpiar_telefono(raw: str) -> str:
+    phone = (
+        raw.replace("@c.us", "")
+        .replace("@s.whatsapp.net", "")
+        .replace("@lid", "")
     )
-    custom_triggers_str = get_config("human_mode_custom_triggers", "", usuario_id=usuario_id, perfil_id=perfil_id)
+    if phone and not phone.startswith("+"):
+        phone = f"+{phone}"
+    return phone
+
+
+async def _leer_payload(request: Request) -> dict:
+    """Parsear request segun content-type"""
+    content_type = request.headers.get("content-type", "")
+    if "application/json" in content_type:
+        return await request.json()
+    form_data = await request.form()
+    return dict(form_data)
+
+
+def _es_evento_encolable(data: dict) -> bool:
+    """Solo los mensajes pasan por la cola; typing/revoked son baratos y se
+    resuelven inline para no perder inmediatez en el dashboard."""
+    return data.get("event") == "message"
+
+
+async def _procesar_typing(data: dict) -> dict:
+    payload = data.get("payload", {})
+    phone = _limpiar_telefono(payload.get("from", ""))
+    if phone:
+        # Ruteo desde la tabla en memoria: typing no toca la DB
+        from tenant import resolver_perfil_por_session
+        uid, pid = resolver_perfil_por_session(data.get("session", ""))
+        if uid is not None:
+            await ws_manager.broadcast_to_perfil(uid, pid, "typing", {"telefono": phone})
+            try:
+                from message_coalescer import registrar_typing
+                await registrar_typing(uid, pid, phone)
+            except Exception as e:
+                logger.warning(f"Error registrando typing: {e}")
+    return {"status": "ok"}
 
-    try:
-        triggers = json.loads(triggers_str)
-    except (json.JSONDecodeError, TypeError):
-        triggers = ["frustration", "complaint", "human_request"]
-
-    # Only check the CLIENT's message for triggers, not the agent's response
-    # The agent's response could contain trigger words naturally (e.g., "una persona real te atenderá")
-    texto = mensaje.lower()
-
-    trigger_keywords = {
-        "frustration": ["molesto", "enojado", "frustrado", "harto", "cansado de", "no sirve", "pésimo", "horrible", "terrible", "indignado"],
-        "complaint": ["queja", "reclamo", "demanda", "problema grave", "inaceptable", "exijo", "reembolso", "devolución"],
-        "human_request": ["hablar con humano", "persona real", "agente humano", "hablar con alguien", "asesor", "ejecutivo", "representante", "operador", "supervisor"],
-        "urgency": ["urgente", "emergencia", "ahora mismo", "inmediatamente", "lo antes posible", "crítico"],
-        "complexity": ["no entiendes", "no me ayudas", "no puedes", "no sabes", "inútil", "no sirves"],
-        "negotiation": ["descuento", "rebaja", "precio especial", "promoción", "negociar", "oferta"],
-    }
-
-    for trigger in triggers:
-        if trigger in trigger_keywords:
-            for keyword in trigger_keywords[trigger]:
-                keyword_words = keyword.split()
-                if len(keyword_words) == 1:
-                    if keyword in texto:
-                        return (trigger, keyword)
-                else:
-                    if all(word in texto for word in keyword_words):
-                        return (trigger, keyword)
-
-    if custom_triggers_str:
-        mensaje_lower = mensaje.lower()
-        custom_keywords = [k.strip().lower() for k in custom_triggers_str.split(",") if k.strip()]
-        for keyword in custom_keywords:
-            keyword_words = keyword.split()
-            if len(keyword_words) == 1:
-                if keyword in mensaje_lower:
-                    return ("custom", keyword)
-            else:
-                if all(word in mensaje_lower for word in keyword_words):
-                    return ("custom", keyword)
 
-    return None
+async def _procesar_revocado(data: dict) -> dict:
+    payload = data.get("payload", {})
+    phone = _limpiar_telefono(payload.get("from", ""))
+    if phone:
+        original = payload.get("originalBody", "")
+        from_me = payload.get("fromMe", False)
+        try:
+            from message_service import MessageService
+            from models import SessionLocal as _SessionLocal
 
+            _db = _SessionLocal()
+            rev_uid, rev_pid = None, None
+            try:
+                from tenant import resolver_perfil_por_session
+                rev_uid, rev_pid = resolver_perfil_por_session(data.get("session", ""), _db)
+                who = "Tu" if from_me else "El cliente"
+                MessageService.add_system_event(
+                    _db,
+                    phone,
+                    "mensaje_eliminado",
+                    f"{who} elimino un mensaje",
+                    metadata={"original": original, "from_me": from_me},
+                    usuario_id=rev_uid,
+                    perfil_id=rev_pid,
+                )
+            finally:
+                _db.close()
+            if rev_uid is not None:
+                await ws_manager.broadcast_to_perfil(
+                    rev_uid, rev_pid,
+                    "message_revoked",
+                    {"telefono": phone, "original": original, "from_me": from_me},
+                )
+        except Exception as e:
+            logger.warning(f"Error guardando mensaje eliminado: {e}")
+    return {"status": "ok"}
+
+
+def _verificar_puede_responder(
+    _db, usuario_id: int, perfil_id: int, from_number: str, mensajes: list
+) -> dict | None:
+    """Chequeos previos al turno del agente: comando #reactivar, modo humano y
+    agente habilitado. Retorna el status a devolver si el agente NO debe responder."""
+    # Verificar comando #reactivar
+    reactivar_command = get_config("human_mode_reactivar_command", "#reactivar", usuario_id=usuario_id, perfil_id=perfil_id)
+    if any(m.strip().lower() == reactivar_command.lower() for m in mensajes):
+        try:
+            if desactivar_modo_humano_por_telefono(from_number, db=_db, usuario_id=usuario_id):
+                logger.info(
+                    f"Modo humano desactivado para {from_number} por comando"
+                )
+                return {"status": "human_mode_deactivated"}
+        except Exception as e:
+            logger.warning(f"Error procesando comando reactivar: {e}")
 
-def _classify_trigger_intent(mensaje: str, trigger_type: str, keyword: str, usuario_id: int = None) -> bool:
-    """
-    Layer 2: Use AI to verify if the trigger keyword represents genuine intent
-    for human intervention, or is just an informational question.
-    """
+    # Verificar modo humano
     try:
-        from agent import get_openai_client
-        client = get_openai_client(usuario_id)
-
-        prompt = f"""Analiza este mensaje de un cliente y determina si REALMENTE necesita intervención humana.
-
-Mensaje del cliente: "{mensaje}"
-Se detectó la palabra clave: "{keyword}" (categoría: {trigger_type})
-
-Responde SOLO con "SI" o "NO".
-- SI: El cliente genuinamente necesita hablar con un humano, está frustrado de verdad, tiene una emergencia, o hace una queja seria.
-- NO: El cliente solo hace una pregunta informativa, pregunta por curiosidad, o la palabra clave aparece en un contexto no urgente.
-
-Ejemplos:
-- "Quiero hablar con una persona real" → SI
-- "Eres una persona real?" → NO
-- "Necesito un notario para la firma" → SI
-- "Cuánto cobra el notario?" → NO
-- "Estoy harto de que no me respondan" → SI
-- "Mi perro tiene sangre en el vómito" → SI"""
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=10,
-            temperature=0,
-        )
-        answer = response.choices[0].message.content.strip().upper()
-        is_genuine = answer.startswith("SI") or answer == "SÍ"
-        logger.info(f"Layer 2 AI classification for '{keyword}' ({trigger_type}): {answer} -> {'trigger' if is_genuine else 'no trigger'}")
-        return is_genuine
+        if verificar_modo_humano(from_number, db=_db, usuario_id=usuario_id):
+            logger.info(f"Contacto {from_number} en modo humano, IA no responde")
+            return {"status": "human_mode_active"}
     except Exception as e:
-        logger.warning(f"AI trigger classification failed: {e}, falling back to keyword match")
-        return True
+        logger.warning(f"Error verificando modo humano: {e}")
 
+    # Verificar si agente esta habilitado
+    agent_enabled = get_config("agent_enabled", "true", usuario_id=usuario_id, perfil_id=perfil_id).lower() == "true"
+    if not agent_enabled:
+        logger.info("Agent is disabled, not responding")
+        return {"status": "agent_disabled"}
 
-router = APIRouter(tags=["Webhook"])
+    return None
 
 
-@router.post(
-    "/whatsapp",
-    summary="WhatsApp webhook",
-    description="Receive incoming messages from WAHA or Evolution API. Processes messages, generates AI responses and sends replies.",
-)
-async def whatsapp_webhook(request: Request):
-    _verify_webhook_token(request)
-    try:
-        # Parsear request segun content-type
-        content_type = request.headers.get("content-type", "")
+async def procesar_evento(data: dict, esperar_rafaga: bool = True, evento_id: str = None) -> dict:
+    """Procesar un evento del bridge ya validado (typing, revocado o mensaje).
 
-        if "application/json" in content_type:
-            data = await request.json()
-        else:
-            form_data = await request.form()
-            data = dict(form_data)
-
-        # Ignorar status callbacks
-        if "MessageStatus" in data:
-            return Response(content="", media_type="text/plain", status_code=200)
-
-        # Evento de typing (contacto esta escribiendo)
-        if data.get("event") == "typing":
-            payload = data.get("payload", {})
-            phone = (
-                payload.get("from", "")
-                .replace("@c.us", "")
-                .replace("@s.whatsapp.net", "")
-                .replace("@lid", "")
-            )
-            if phone:
-                if not phone.startswith("+"):
-                    phone = f"+{phone}"
-                from tenant import resolver_perfil_por_session
-                from models import SessionLocal as _SL
-                _db = _SL()
-                try:
-                    uid, pid = resolver_perfil_por_session(data.get("session", ""), _db)
-                finally:
-                    _db.close()
-                if uid is not None:
-                    await ws_manager.broadcast_to_perfil(uid, pid, "typing", {"telefono": phone})
-            return Response(
-                content='{"status":"ok"}',
-                media_type="application/json",
-                status_code=200,
-            )
+    Es el pipeline completo: contacto, dedup, modo humano, agente y envío de la
+    respuesta. Lo usan el webhook (modo inline) y los consumidores de la cola
+    durable en worker.py. Retorna un dict con el status del procesamiento.
 
-        # Mensaje eliminado
-        if data.get("event") == "message_revoked":
-            payload = data.get("payload", {})
-            phone = (
-                payload.get("from", "")
-                .replace("@c.us", "")
-                .replace("@s.whatsapp.net", "")
-                .replace("@lid", "")
-            )
-            if phone:
-                if not phone.startswith("+"):
-                    phone = f"+{phone}"
-                original = payload.get("originalBody", "")
-                from_me = payload.get("fromMe", False)
-                try:
-                    from message_service import MessageService
-                    from models import SessionLocal as _SessionLocal
-
-                    _db = _SessionLocal()
-                    rev_uid, rev_pid = None, None
-                    try:
-                        from tenant import resolver_perfil_por_session
-                        rev_uid, rev_pid = resolver_perfil_por_session(data.get("session", ""), _db)
-                        who = "Tu" if from_me else "El cliente"
-                        MessageService.add_system_event(
-                            _db,
-                            phone,
-                            "mensaje_eliminado",
-                            f"{who} elimino un mensaje",
-                            metadata={"original": original, "from_me": from_me},
-                            usuario_id=rev_uid,
-                            perfil_id=rev_pid,
-                        )
-                    finally:
-                        _db.close()
-                    if rev_uid is not None:
-                        await ws_manager.broadcast_to_perfil(
-                            rev_uid, rev_pid,
-                            "message_revoked",
-                            {"telefono": phone, "original": original, "from_me": from_me},
-                        )
-                except Exception as e:
-                    logger.warning(f"Error guardando mensaje eliminado: {e}")
-            return Response(
-                content='{"status":"ok"}',
-                media_type="application/json",
-                status_code=200,
-            )
+    Con debounce activo, `esperar_rafaga=False` devuelve de inmediato y el turno
+    de la ráfaga corre en background (el bridge corta el request a los 10s).
+    `evento_id` es el id del evento en la cola durable: con status "buffered" el
+    caller NO debe confirmarlo, lo confirma el líder de la ráfaga al terminar el turno.
 
-        # Parsear mensaje
-        parsed = parse_webhook_message(data)
+    Cada etapa se mide (metrics.etapa) y se exporta en /metrics por tenant.
+    """
+    import time
+    from metrics import Cronometro, usar_cronometro, STAGE_SECONDS, MENSAJES_PROCESADOS
+
+    if data.get("event") != "message":
+        return await _procesar_evento(data, esperar_rafaga, evento_id)
+
+    crono = Cronometro()
+    inicio = time.perf_counter()
+    with usar_cronometro(crono):
+        result = await _procesar_evento(data, esperar_rafaga, evento_id)
+    uid = crono.usuario_id if crono.usuario_id is not None else ""
+    STAGE_SECONDS.observe(time.perf_counter() - inicio, stage="webhook_total", usuario_id=uid)
+    MENSAJES_PROCESADOS.inc(status=result.get("status", ""), usuario_id=uid)
+    return result
+
+
+async def _procesar_evento(data: dict, esperar_rafaga: bool = True, evento_id: str = None) -> dict:
+    # Ignorar status callbacks
+    if "MessageStatus" in data:
+        return {"status": "ignored"}
+
+    # Turno del agente diferido por saturación (ver _manejar_saturacion)
+    if data.get("event") == "agent_turn":
+        turno = data.get("payload", {})
+        return await _turno_agente(
+            turno.get("usuario_id"), turno.get("perfil_id"), turno.get("telefono", ""),
+            turno.get("nombre", ""), turno.get("mensaje", ""), guardar_mensaje=False,
+        )
 
-        if not parsed:
-            logger.debug(
-                f"Webhook ignorado (no es mensaje valido): {data.get('event', 'unknown')}"
-            )
-            return Response(
-                content='{"status": "ignored"}',
-                media_type="application/json",
-                status_code=200,
-            )
+    # Evento de typing (contacto esta escribiendo)
+    if data.get("event") == "typing":
+        return await _procesar_typing(data)
 
-        from_number = parsed["phone"]
-        incoming_msg = parsed["message"]
-        contact_name = parsed.get("name", "")
-        is_from_me = parsed.get("from_me", False)
-        media_url = parsed.get("media_url")
-        media_type = parsed.get("media_type")
-        quoted_msg = parsed.get("quoted_msg")
-        session_name = parsed.get("session", "")
-
-        # Single DB session for entire webhook processing
-        from message_service import MessageService
-        from models import SessionLocal as _SessionLocal, MensajeConversacion
-        from datetime import datetime, timedelta
-        from tenant import resolver_usuario_por_telefono, resolver_perfil_por_session
-        from api.routers.perfiles import get_perfil_activo_id
-
-        _db = _SessionLocal()
-        perfil_id = None
-        try:
+    # Mensaje eliminado
+    if data.get("event") == "message_revoked":
+        return await _procesar_revocado(data)
+
+    # Parsear mensaje
+    parsed = parse_webhook_message(data)
+
+    if not parsed:
+        logger.debug(
+            f"Webhook ignorado (no es mensaje valido): {data.get('event', 'unknown')}"
+        )
+        return {"status": "ignored"}
+
+    from_number = parsed["phone"]
+    incoming_msg = parsed["message"]
+    contact_name = parsed.get("name", "")
+    is_from_me = parsed.get("from_me", False)
+    media_url = parsed.get("media_url")
+    media_type = parsed.get("media_type")
+    quoted_msg = parsed.get("quoted_msg")
+    session_name = parsed.get("session", "")
+
+    # Single DB session for entire webhook processing
+    from message_service import MessageService, memoria_migrada
+    from models import SessionLocal as _SessionLocal
+    from tenant import resolver_usuario_por_telefono, resolver_perfil_por_session
+    from api.routers.perfiles import get_perfil_activo_id
+    from metrics import etapa, cronometro_actual
+
+    _db = _SessionLocal()
+    perfil_id = None
+    try:
+        with etapa("tenant"):
             # Routing: prefer the bridge session ("perfil_<id>") — it tells us
             # exactly which profile (and owner) this WhatsApp number belongs to.
             usuario_id, perfil_id = resolver_perfil_por_session(session_name, _db)
@@ -305,155 +280,358 @@ async def whatsapp_webhook(request: Request):
                 # Fallback: resolve by the contact's phone + the user's active profile.
                 usuario_id = resolver_usuario_por_telefono(from_number, _db)
                 perfil_id = get_perfil_activo_id(_db, usuario_id)
+            if cronometro_actual() is not None:
+                cronometro_actual().usuario_id = usuario_id
 
-            logger.info(
-                f"{'Outgoing' if is_from_me else 'Message from'} {from_number} ({contact_name}) [user:{usuario_id}]: {incoming_msg[:80]}"
-            )
-
-            # Broadcast typing antes del mensaje (para que el frontend vea actividad)
-            if not is_from_me:
-                await ws_manager.broadcast_to_perfil(usuario_id, perfil_id, "typing", {"telefono": from_number})
-
-            # Construir contenido del mensaje (con media y quoted)
-            msg_content = incoming_msg
-            msg_metadata = {}
-            if media_url:
-                msg_metadata["media_url"] = media_url
-                msg_metadata["media_type"] = media_type
-            if quoted_msg:
-                msg_metadata["quoted"] = quoted_msg
-            wa_id = parsed.get("wa_id")
-            if wa_id:
-                msg_metadata["wa_id"] = wa_id
-
-            # Determinar rol y fuente
-            msg_role = "assistant" if is_from_me else "user"
-            if is_from_me:
-                msg_metadata["source"] = "phone"  # Respondido desde el celular
+        logger.info(
+            f"{'Outgoing' if is_from_me else 'Message from'} {from_number} ({contact_name}) [user:{usuario_id}]: {incoming_msg[:80]}"
+        )
 
-            # Guardar/actualizar contacto (entrantes y salientes desde el celular).
-            # También para salientes: si respondes a un número desde el celular sin
-            # historial entrante, el contacto no existiría y la conversación no
-            # aparecería en el dashboard. guardar_contacto_mensaje no pisa nombres
-            # ya existentes y está scoped por usuario_id.
-            try:
+        # Broadcast typing antes del mensaje (para que el frontend vea actividad)
+        if not is_from_me:
+            await ws_manager.broadcast_to_perfil(usuario_id, perfil_id, "typing", {"telefono": from_number})
+
+        # Construir contenido del mensaje (con media y quoted)
+        msg_content = incoming_msg
+        msg_metadata = {}
+        if media_url:
+            msg_metadata["media_url"] = media_url
+            msg_metadata["media_type"] = media_type
+        if quoted_msg:
+            msg_metadata["quoted"] = quoted_msg
+        wa_id = parsed.get("wa_id")
+        if wa_id:
+            msg_metadata["wa_id"] = wa_id
+
+        # Determinar rol y fuente
+        msg_role = "assistant" if is_from_me else "user"
+        if is_from_me:
+            msg_metadata["source"] = "phone"  # Respondido desde el celular
+
+        # Guardar/actualizar contacto (entrantes y salientes desde el celular).
+        # También para salientes: si respondes a un número desde el celular sin
+        # historial entrante, el contacto no existiría y la conversación no
+        # aparecería en el dashboard. guardar_contacto_mensaje no pisa nombres
+        # ya existentes y está scoped por usuario_id.
+        try:
+            with etapa("contacto"):
                 guardar_contacto_mensaje(from_number, contact_name, db=_db, usuario_id=usuario_id, perfil_id=perfil_id)
-            except Exception as e:
-                logger.warning(f"Error guardando contacto: {e}")
-
-            # Guardar mensaje (verificar que no sea duplicado)
-            try:
-                MessageService.migrate_from_memoria(_db, from_number, usuario_id)
-
-                # Verificar duplicado: mismo telefono, rol, contenido en los ultimos 10s
-                is_duplicate = False
-                if msg_content:
-                    recent = (
-                        _db.query(MensajeConversacion)
-                        .filter(
-                            MensajeConversacion.telefono == from_number,
-                            MensajeConversacion.rol == msg_role,
-                            MensajeConversacion.contenido == msg_content,
-                            MensajeConversacion.created_at
-                            >= datetime.utcnow() - timedelta(seconds=10),
-                        )
-                        .first()
-                    )
-                    is_duplicate = recent is not None
-
-                if not is_duplicate:
-                    MessageService.add_message(
-                        _db,
-                        from_number,
-                        msg_role,
-                        msg_content,
-                        metadata=msg_metadata if msg_metadata else None,
-                        usuario_id=usuario_id,
-                        perfil_id=perfil_id,
-                    )
-                    await ws_manager.broadcast_to_perfil(
-                        usuario_id,
-                        perfil_id,
-                        "new_message",
-                        {
-                            "telefono": from_number,
-                            "nombre": contact_name,
-                            "mensaje": msg_content[:200],
-                            "rol": msg_role,
-                            "media_url": media_url,
-                        },
-                    )
-                else:
-                    logger.info(f"Duplicate message skipped for {from_number}")
-            except Exception as e:
-                logger.warning(f"Error guardando mensaje: {e}")
+        except Exception as e:
+            logger.warning(f"Error guardando contacto: {e}")
 
-            # Si es mensaje enviado por nosotros (desde cel), no procesar con IA
+        # Guardar mensaje de forma idempotente: el wa_id es la llave, un evento
+        # reentregado por el bridge es un no-op y no dispara otro turno del agente.
+        try:
+            # Solo hasta que corra la migración masiva (worker); después no consulta nada
+            if not memoria_migrada():
+                with etapa("migrate_from_memoria"):
+                    MessageService.migrate_from_memoria(_db, from_number, usuario_id)
+
+            if is_from_me and MessageService.adopt_outgoing_echo(
+                _db, from_number, msg_content, wa_id, usuario_id
+            ):
+                # Eco de un mensaje que ya guardamos (respuesta del agente o del dashboard)
+                return {"status": "outgoing_saved"}
             if is_from_me:
-                return Response(
-                    content='{"status": "outgoing_saved"}',
-                    media_type="application/json",
-                    status_code=200,
+                from streaming_delivery import es_fragmento_enviado
+
+                if es_fragmento_enviado(usuario_id, wa_id):
+                    # Eco de un fragmento de una respuesta en streaming: el
+                    # historial guarda la respuesta completa en una sola fila
+                    return {"status": "outgoing_saved"}
+
+            with etapa("ingesta"):
+                guardado = MessageService.add_message_if_absent(
+                    _db,
+                    from_number,
+                    msg_role,
+                    msg_content,
+                    wa_id,
+                    usuario_id=usuario_id,
+                    metadata=msg_metadata if msg_metadata else None,
+                    perfil_id=perfil_id,
                 )
+            if guardado is None:
+                # Reentrega de un mensaje cuyo turno nunca respondió (el proceso
+                # murió tras el insert): se vuelve a correr el turno. Si es
+                # reciente, su turno original probablemente sigue en vuelo.
+                if is_from_me or not MessageService.sin_respuesta(
+                    _db, from_number, wa_id, usuario_id, antiguedad_minima=TURNO_EN_VUELO_SECONDS
+                ):
+                    logger.info(f"Duplicate message skipped for {from_number} (wa_id={wa_id})")
+                    return {"status": "duplicate"}
+                logger.warning(f"Message {wa_id} from {from_number} has no reply, re-running its turn")
+
+            await ws_manager.broadcast_to_perfil(
+                usuario_id,
+                perfil_id,
+                "new_message",
+                {
+                    "telefono": from_number,
+                    "nombre": contact_name,
+                    "mensaje": msg_content[:200],
+                    "rol": msg_role,
+                    "media_url": media_url,
+                },
+            )
+        except Exception as e:
+            _db.rollback()
+            logger.warning(f"Error guardando mensaje: {e}")
 
-            # Marcar como respondido en campanas activas
-            try:
-                await marcar_respondido(from_number)
-            except Exception as e:
-                logger.warning(f"Error marcando respondido: {e}")
+        # Si es mensaje enviado por nosotros (desde cel), no procesar con IA
+        if is_from_me:
+            return {"status": "outgoing_saved"}
 
-            # Verificar comando #reactivar
-            reactivar_command = get_config("human_mode_reactivar_command", "#reactivar", usuario_id=usuario_id, perfil_id=perfil_id)
-            if incoming_msg.strip().lower() == reactivar_command.lower():
-                try:
-                    if desactivar_modo_humano_por_telefono(from_number, db=_db, usuario_id=usuario_id):
-                        logger.info(
-                            f"Modo humano desactivado para {from_number} por comando"
-                        )
-                        return Response(
-                            content='{"status": "human_mode_deactivated"}',
-                            media_type="application/json",
-                            status_code=200,
-                        )
-                except Exception as e:
-                    logger.warning(f"Error procesando comando reactivar: {e}")
-
-            # Verificar modo humano
-            try:
-                if verificar_modo_humano(from_number, db=_db, usuario_id=usuario_id):
-                    logger.info(f"Contacto {from_number} en modo humano, IA no responde")
-                    return Response(
-                        content='{"status": "human_mode_active"}',
-                        media_type="application/json",
-                        status_code=200,
-                    )
-            except Exception as e:
-                logger.warning(f"Error verificando modo humano: {e}")
-        finally:
-            _db.close()
-
-        # Verificar si agente esta habilitado
-        agent_enabled = get_config("agent_enabled", "true", usuario_id=usuario_id, perfil_id=perfil_id).lower() == "true"
-
-        if not agent_enabled:
-            logger.info("Agent is disabled, not responding")
-            return Response(
-                content='{"status": "agent_disabled"}',
-                media_type="application/json",
-                status_code=200,
-            )
+        # Marcar como respondido en campanas activas
+        try:
+            await marcar_respondido(from_number)
+        except Exception as e:
+            logger.warning(f"Error marcando respondido: {e}")
+
+        with etapa("verificaciones"):
+            estado = _verificar_puede_responder(_db, usuario_id, perfil_id, from_number, [incoming_msg])
+        if estado:
+            return estado
+    finally:
+        _db.close()
+
+    # Debounce: agrupar ráfagas de mensajes cortos en un solo turno del agente
+    from message_coalescer import obtener_ventana
+
+    ventana = obtener_ventana(usuario_id, perfil_id)
+    if ventana > 0:
+        rafaga = _agrupar_y_responder(
+            usuario_id, perfil_id, from_number, contact_name, incoming_msg, ventana, evento_id
+        )
+        if esperar_rafaga:
+            return await rafaga
+        _lanzar_en_background(rafaga)
+        return {"status": "buffered"}
+
+    # El mensaje ya quedó guardado arriba
+    return await _turno_agente(
+        usuario_id, perfil_id, from_number, contact_name, incoming_msg, guardar_mensaje=False
+    )
+
+
+_tareas_background: set = set()
+
+
+def _lanzar_en_background(coro) -> None:
+    """Correr una corrutina sin bloquear la respuesta HTTP (guardando la referencia
+    para que el GC no cancele la tarea)."""
+    import asyncio
+
+    task = asyncio.create_task(coro)
+    _tareas_background.add(task)
+    task.add_done_callback(_tareas_background.discard)
+
+
+async def _agrupar_y_responder(
+    usuario_id: int, perfil_id: int, from_number: str, contact_name: str, incoming_msg: str, ventana: float,
+    evento_id: str = None,
+) -> dict:
+    """Sumar el mensaje a la ráfaga de la conversación; el líder corre un único
+    turno del agente con todos los mensajes cuando vence la ventana.
+
+    El líder confirma los eventos de la cola durable de toda la ráfaga recién
+    cuando el turno terminó; si falla quedan pendientes para XAUTOCLAIM."""
+    from message_coalescer import agrupar
 
-        # Generar respuesta con el agente (en thread pool para no bloquear event loop)
-        import asyncio
+    agrupados = await agrupar(usuario_id, perfil_id, from_number, incoming_msg, ventana, evento_id)
+    if agrupados is None:
+        return {"status": "coalesced"}
+    mensajes, eventos = agrupados
+    result = await _responder_rafaga(usuario_id, perfil_id, from_number, contact_name, mensajes)
+    if eventos:
+        from redis_queue import confirmar_evento_entrante
 
-        loop = asyncio.get_event_loop()
-        respuesta = await loop.run_in_executor(
-            None, responder, incoming_msg, from_number, usuario_id, perfil_id
+        confirmar_evento_entrante(*eventos)
+    return result
+
+
+async def _responder_rafaga(
+    usuario_id: int, perfil_id: int, from_number: str, contact_name: str, mensajes: list
+) -> dict:
+    """Un único turno del agente con todos los mensajes de la ráfaga."""
+    if len(mensajes) > 1:
+        logger.info(f"Rafaga de {len(mensajes)} mensajes agrupada para {from_number}")
+
+    # El contacto pudo pasar a modo humano mientras se acumulaba la ráfaga
+    from models import SessionLocal as _SessionLocal
+
+    _db = _SessionLocal()
+    try:
+        if verificar_modo_humano(from_number, db=_db, usuario_id=usuario_id):
+            return {"status": "human_mode_active"}
+    except Exception as e:
+        logger.warning(f"Error verificando modo humano: {e}")
+    finally:
+        _db.close()
+
+    # Los mensajes individuales ya están guardados en el historial
+    return await _turno_agente(
+        usuario_id, perfil_id, from_number, contact_name, "\n".join(mensajes),
+        guardar_mensaje=False,
+    )
+
+
+async def _manejar_saturacion(
+    error, usuario_id: int, perfil_id: int, from_number: str, contact_name: str, incoming_msg: str
+) -> dict:
+    """Aplicar AGENT_OVERLOAD_MODE cuando el pool del agente no admite el turno."""
+    from agent_executor import agent_executor, RECHAZOS_AGENTE, MENSAJE_ESPERA_DEFAULT
+
+    modo = agent_executor.modo
+    RECHAZOS_AGENTE.inc(mode=modo, usuario_id=usuario_id)
+    logger.warning(f"{error} (modo {modo})")
+
+    if modo == "hold":
+        await _enviar_mensaje_espera(
+            usuario_id, perfil_id, from_number,
+            get_config("agent_holding_message", MENSAJE_ESPERA_DEFAULT, usuario_id=usuario_id, perfil_id=perfil_id),
         )
 
-        logger.info(f"Response: {respuesta[:100]}...")
+    # defer / hold (y reject si la saturación llegó después del chequeo de
+    # admisión del webhook): el turno pasa a la cola durable para el worker.
+    event_id = _reencolar_turno(usuario_id, perfil_id, from_number, contact_name, incoming_msg)
+    if event_id:
+        return {"status": "deferred", "event_id": event_id}
 
-        # Notificar via WebSocket la respuesta del agente
+    # Sin cola disponible: esperar turno en el pool
+    from metrics import Cronometro
+
+    session = f"perfil_{perfil_id}" if perfil_id else "default"
+    async with whatsapp_service.escribiendo(from_number, session):
+        respuesta = await responder_async(
+            incoming_msg, from_number, usuario_id, perfil_id, False, Cronometro(usuario_id), esperar=True,
+        )
+    return await _entregar_respuesta(usuario_id, perfil_id, from_number, contact_name, incoming_msg, respuesta)
+
+
+def _reencolar_turno(
+    usuario_id: int, perfil_id: int, from_number: str, contact_name: str, incoming_msg: str
+) -> str | None:
+    """Pasar el turno a la cola durable como evento agent_turn (el mensaje ya
+    está guardado). Retorna el event_id, o None si la cola no está disponible."""
+    from redis_queue import encolar_evento_entrante
+
+    return encolar_evento_entrante({
+        "event": "agent_turn",
+        "payload": {
+            "usuario_id": usuario_id,
+            "perfil_id": perfil_id,
+            "telefono": from_number,
+            "nombre": contact_name,
+            "mensaje": incoming_msg,
+        },
+    })
+
+
+async def _enviar_mensaje_espera(usuario_id: int, perfil_id: int, from_number: str, texto: str) -> None:
+    """Mensaje corto de espera, como mucho uno por minuto por contacto."""
+    if not texto or not whatsapp_service.is_configured():
+        return
+    try:
+        from redis_queue import get_redis
+        if not get_redis().set(f"agent:holding:{usuario_id}:{from_number}", "1", nx=True, ex=60):
+            return
+    except Exception:
+        pass
+    # Guardar antes de enviar (como las respuestas del agente): así el eco del
+    # bridge encuentra la fila en adopt_outgoing_echo y no se guarda dos veces
+    from message_service import MessageService
+    from models import SessionLocal as _SessionLocal
+
+    _db = _SessionLocal()
+    try:
+        MessageService.add_message(
+            _db, from_number, "assistant", texto,
+            metadata={"source": "ai", "skill": "holding"},
+            usuario_id=usuario_id, perfil_id=perfil_id,
+        )
+    finally:
+        _db.close()
+
+    session = f"perfil_{perfil_id}" if perfil_id else "default"
+    result = await whatsapp_service.send_message(from_number, texto, session=session)
+    if not result.get("success"):
+        logger.error(f"Error enviando mensaje de espera: {result.get('error')}")
+
+
+async def _turno_agente(
+    usuario_id: int,
+    perfil_id: int,
+    from_number: str,
+    contact_name: str,
+    incoming_msg: str,
+    guardar_mensaje: bool = True,
+) -> dict:
+    """Turno del agente serializado por conversación (un solo turno en vuelo por
+    contacto, también entre réplicas de la API y el worker).
+
+    Si otro proceso retiene la conversación más de lo esperado el turno se
+    reencola; si la cola tampoco está disponible se propaga el error (el
+    worker no confirma el evento y el bridge reintenta el webhook)."""
+    from conversation_lock import turno_conversacion, ConversacionOcupada, LeasePerdido
+
+    try:
+        async with turno_conversacion(usuario_id, perfil_id, from_number):
+            return await _generar_y_enviar_respuesta(
+                usuario_id, perfil_id, from_number, contact_name, incoming_msg, guardar_mensaje
+            )
+    except ConversacionOcupada as e:
+        event_id = _reencolar_turno(usuario_id, perfil_id, from_number, contact_name, incoming_msg)
+        if not event_id:
+            raise
+        logger.warning(f"{e}: turno reencolado ({event_id})")
+        return {"status": "deferred", "event_id": event_id}
+    except LeasePerdido as e:
+        # Otro proceso tomó la conversación: su turno ya lee este mensaje del historial
+        logger.warning(str(e))
+        return {"status": "lease_lost"}
+
+
+async def _generar_y_enviar_respuesta(
+    usuario_id: int,
+    perfil_id: int,
+    from_number: str,
+    contact_name: str,
+    incoming_msg: str,
+    guardar_mensaje: bool = True,
+) -> dict:
+    """Generar la respuesta del agente, notificar al dashboard y enviarla por WhatsApp."""
+    # Generar respuesta con el agente: DB y clasificación en el pool dedicado,
+    # la completion en el event loop. El cronómetro no cruza solo a los
+    # threads: se pasa explícito.
+    from metrics import Cronometro, cronometro_actual, etapa
+    from agent_executor import AgenteSaturado
+
+    crono = cronometro_actual() or Cronometro(usuario_id)
+
+    # streaming_enabled: la respuesta sale por WhatsApp de a párrafos/oraciones
+    # mientras se genera (ver streaming_delivery)
+    entrega = None
+    from streaming_delivery import EntregaProgresiva, streaming_habilitado
+
+    if whatsapp_service.is_configured() and streaming_habilitado(usuario_id, perfil_id):
+        entrega = EntregaProgresiva(usuario_id, perfil_id, from_number, contact_name)
+
+    # "escribiendo..." se renueva en background mientras se genera y se corta
+    # antes de enviar la respuesta
+    session = f"perfil_{perfil_id}" if perfil_id else "default"
+    try:
+        with etapa("agente", usuario_id):
+            async with whatsapp_service.escribiendo(from_number, session):
+                respuesta = await responder_async(
+                    incoming_msg, from_number, usuario_id, perfil_id, guardar_mensaje, crono,
+                    on_fragmento=entrega,
+                )
+    except AgenteSaturado as e:
+        return await _manejar_saturacion(e, usuario_id, perfil_id, from_number, contact_name, incoming_msg)
+
+    if entrega is not None and (entrega.enviados or entrega.fallidos):
+        await entrega.reintentar_fallidos()
         await ws_manager.broadcast_to_perfil(
             usuario_id,
             perfil_id,
@@ -465,45 +643,296 @@ async def whatsapp_webhook(request: Request):
                 "rol": "assistant",
             },
         )
+        return {"status": "ok", "fragmentos": len(entrega.enviados)}
 
-        # Detectar triggers para modo humano
-        try:
-            if detectar_trigger_modo_humano(incoming_msg, respuesta, usuario_id=usuario_id, perfil_id=perfil_id):
-                activar_modo_humano_por_telefono(
-                    from_number, "Trigger automático detectado", usuario_id=usuario_id
-                )
-                logger.info(f"Modo humano activado automáticamente para {from_number}")
-        except Exception as e:
-            logger.warning(f"Error detectando triggers: {e}")
+    return await _entregar_respuesta(usuario_id, perfil_id, from_number, contact_name, incoming_msg, respuesta)
+
+
+async def _entregar_respuesta(
+    usuario_id: int, perfil_id: int, from_number: str, contact_name: str, incoming_msg: str, respuesta: str
+) -> dict:
+    """Notificar al dashboard y enviar la respuesta por WhatsApp.
 
-        # Enviar respuesta usando la sesión del perfil
-        if whatsapp_service.is_configured():
-            session = f"perfil_{perfil_id}" if perfil_id else "default"
+    Los triggers de modo humano ya se evaluaron antes de generar la respuesta
+    (nivel 0 de classify_intent), así que aquí no se repite la detección.
+    """
+    from metrics import etapa
+
+    logger.info(f"Response: {respuesta[:100]}...")
+
+    # Notificar via WebSocket la respuesta del agente
+    await ws_manager.broadcast_to_perfil(
+        usuario_id,
+        perfil_id,
+        "new_message",
+        {
+            "telefono": from_number,
+            "nombre": contact_name,
+            "mensaje": respuesta[:200],
+            "rol": "assistant",
+        },
+    )
+
+    # Enviar respuesta usando la sesión del perfil
+    if whatsapp_service.is_configured():
+        session = f"perfil_{perfil_id}" if perfil_id else "default"
+        with etapa("envio", usuario_id):
             result = await whatsapp_service.send_message(from_number, respuesta, session=session)
-            if result["success"]:
-                logger.info(f"Mensaje enviado a {from_number}")
-            else:
-                logger.error(f"Error enviando mensaje: {result.get('error')}")
-            return Response(
-                content='{"status": "ok"}',
-                media_type="application/json",
-                status_code=200,
-            )
+        if result["success"]:
+            logger.info(f"Mensaje enviado a {from_number}")
         else:
-            logger.warning("WhatsApp no configurado, no se puede enviar respuesta")
-            return Response(
-                content='{"status": "whatsapp_not_configured"}',
-                media_type="application/json",
-                status_code=200,
-            )
+            logger.error(f"Error enviando mensaje: {result.get('error')}")
+        return {"status": "ok"}
+    else:
+        logger.warning("WhatsApp no configurado, no se puede enviar respuesta")
+        return {"status": "whatsapp_not_configured"}
+
+
+def _rechazo_por_saturacion(data: dict) -> Response | None:
+    """AGENT_OVERLOAD_MODE=reject: 429 antes de ingerir el mensaje, para que el
+    reintento del bridge no choque con el wa_id ya guardado."""
+    from agent_executor import agent_executor, RECHAZOS_AGENTE
+
+    if agent_executor.modo != "reject" or not _es_evento_encolable(data):
+        return None
+    payload = data.get("payload", {})
+    if payload.get("fromMe"):
+        return None
+    from tenant import resolver_perfil_por_session
+
+    usuario_id, _ = resolver_perfil_por_session(data.get("session", ""))
+    if usuario_id is None or not agent_executor.saturado(usuario_id):
+        return None
+    RECHAZOS_AGENTE.inc(mode="reject", usuario_id=usuario_id)
+    response = _json_response({"status": "overloaded"}, status_code=429)
+    response.headers["Retry-After"] = "5"
+    return response
+
+
+@router.post(
+    "/whatsapp",
+    summary="WhatsApp webhook",
+    description="Receive incoming messages from WAHA or Evolution API. Processes messages, generates AI responses and sends replies. With WEBHOOK_ASYNC_MODE=true, messages are persisted to a durable queue and acknowledged immediately.",
+)
+async def whatsapp_webhook(request: Request):
+    _verify_webhook_token(request)
+    try:
+        data = await _leer_payload(request)
+
+        if WEBHOOK_ASYNC_MODE and _es_evento_encolable(data):
+            from redis_queue import encolar_evento_entrante
+
+            event_id = encolar_evento_entrante(data)
+            if event_id:
+                return _json_response({"status": "queued", "event_id": event_id})
+            logger.warning("Cola de entrada no disponible, procesando evento inline")
+
+        rechazo = _rechazo_por_saturacion(data)
+        if rechazo is not None:
+            return rechazo
+
+        result = await procesar_evento(data, esperar_rafaga=False)
+        return _json_response(result)
 
     except Exception as e:
         logger.error(f"Webhook error: {str(e)}", exc_info=True)
-        return Response(
-            content='{"status": "error"}',
-            media_type="application/json",
-            status_code=500,
-        )
+        return _json_response({"status": "error"}, status_code=500)
+
+
+async def procesar_lote(eventos: list) -> dict:
+    """Procesar un lote de eventos del bridge (reconexión / flush de backlog).
+
+    Resuelve el tenant una vez por nombre de sesión, inserta mensajes y
+    actualiza contactos en una sola transacción, notifica por WebSocket en una
+    pasada y agenda un único turno del agente por conversación con todos sus
+    mensajes nuevos. Typing y revocados se procesan como eventos sueltos.
+    """
+    from message_service import MessageService, memoria_migrada
+    from models import SessionLocal as _SessionLocal, unit_of_work
+    from tenant import resolver_usuario_por_telefono, resolver_perfil_por_session
+    from api.routers.perfiles import get_perfil_activo_id
+    from api.routers.contactos import guardar_contactos_lote
+    from streaming_delivery import es_fragmento_enviado
+
+    resumen = {"recibidos": len(eventos), "insertados": 0, "duplicados": 0, "ecos": 0, "ignorados": 0, "turnos": 0}
+    sueltos = []
+    mensajes = []
+    for data in eventos:
+        if not isinstance(data, dict) or "MessageStatus" in data:
+            resumen["ignorados"] += 1
+            continue
+        if data.get("event") in ("typing", "message_revoked"):
+            sueltos.append(data)
+            continue
+        parsed = parse_webhook_message(data)
+        if not parsed:
+            resumen["ignorados"] += 1
+            continue
+        mensajes.append(parsed)
+
+    for data in sueltos:
+        try:
+            await procesar_evento(data)
+        except Exception as e:
+            logger.warning(f"Error procesando evento del lote: {e}")
+
+    if not mensajes:
+        return {"status": "ok", **resumen}
+
+    _db = _SessionLocal()
+    try:
+        # Una sola transacción para todo el lote (los servicios no commitean)
+        with unit_of_work(_db):
+            tenants_por_sesion = {}
+            tenants_por_telefono = {}
+            filas = []
+            for parsed in mensajes:
+                session_name = parsed.get("session", "")
+                if session_name not in tenants_por_sesion:
+                    tenants_por_sesion[session_name] = resolver_perfil_por_session(session_name, _db)
+                usuario_id, perfil_id = tenants_por_sesion[session_name]
+                if usuario_id is None:
+                    phone = parsed["phone"]
+                    if phone not in tenants_por_telefono:
+                        uid = resolver_usuario_por_telefono(phone, _db)
+                        tenants_por_telefono[phone] = (uid, get_perfil_activo_id(_db, uid))
+                    usuario_id, perfil_id = tenants_por_telefono[phone]
+
+                metadata = {}
+                if parsed.get("media_url"):
+                    metadata["media_url"] = parsed["media_url"]
+                    metadata["media_type"] = parsed.get("media_type")
+                if parsed.get("quoted_msg"):
+                    metadata["quoted"] = parsed["quoted_msg"]
+                if parsed.get("wa_id"):
+                    metadata["wa_id"] = parsed["wa_id"]
+                if parsed.get("from_me"):
+                    metadata["source"] = "phone"
+
+                filas.append({
+                    "telefono": parsed["phone"],
+                    "rol": "assistant" if parsed.get("from_me") else "user",
+                    "contenido": parsed["message"],
+                    "usuario_id": usuario_id,
+                    "perfil_id": perfil_id,
+                    "metadata": metadata or None,
+                    "wa_id": parsed.get("wa_id"),
+                    "nombre": parsed.get("name", ""),
+                    "media_url": parsed.get("media_url"),
+                })
+
+            # Ecos de mensajes que ya guardamos (respuestas del agente/dashboard)
+            # y de fragmentos de respuestas en streaming (el historial guarda
+            # la respuesta completa en una sola fila), igual que en el evento suelto
+            nuevas = []
+            for f in filas:
+                if f["rol"] == "assistant" and (
+                    es_fragmento_enviado(f["usuario_id"], f["wa_id"])
+                    or MessageService.adopt_outgoing_echo(
+                        _db, f["telefono"], f["contenido"], f["wa_id"], f["usuario_id"]
+                    )
+                ):
+                    resumen["ecos"] += 1
+                else:
+                    nuevas.append(f)
+
+            insertadas = MessageService.add_messages_bulk(_db, nuevas)
+            resumen["duplicados"] = len(nuevas) - len(insertadas)
+            resumen["insertados"] = len(insertadas)
+
+            actividad = {}
+            for f in insertadas:
+                info = actividad.setdefault((f["usuario_id"], f["perfil_id"]), {}).setdefault(
+                    f["telefono"], {"nombre": None, "mensajes": 0, "mensajes_usuario": 0}
+                )
+                info["mensajes"] += 1
+                info["mensajes_usuario"] += f["rol"] == "user"
+                if f["nombre"]:
+                    info["nombre"] = f["nombre"]
+            for (usuario_id, perfil_id), por_telefono in actividad.items():
+                guardar_contactos_lote(_db, usuario_id, perfil_id, por_telefono)
+    except Exception:
+        _db.close()
+        raise
+
+    try:
+        # Notificaciones al dashboard en una pasada
+        for f in insertadas:
+            await ws_manager.broadcast_to_perfil(
+                f["usuario_id"],
+                f["perfil_id"],
+                "new_message",
+                {
+                    "telefono": f["telefono"],
+                    "nombre": f["nombre"],
+                    "mensaje": f["contenido"][:200],
+                    "rol": f["rol"],
+                    "media_url": f["media_url"],
+                },
+            )
+
+        # Un turno del agente por conversación con sus mensajes entrantes nuevos
+        conversaciones = {}
+        for f in insertadas:
+            if f["rol"] != "user":
+                continue
+            clave = (f["usuario_id"], f["perfil_id"], f["telefono"])
+            conv = conversaciones.setdefault(clave, {"nombre": "", "mensajes": []})
+            conv["mensajes"].append(f["contenido"])
+            conv["nombre"] = f["nombre"] or conv["nombre"]
+
+        for (usuario_id, perfil_id, telefono), conv in conversaciones.items():
+            try:
+                await marcar_respondido(telefono)
+            except Exception as e:
+                logger.warning(f"Error marcando respondido: {e}")
+            if _verificar_puede_responder(_db, usuario_id, perfil_id, telefono, conv["mensajes"]):
+                continue
+            _lanzar_en_background(_turno_agente(
+                usuario_id, perfil_id, telefono, conv["nombre"], "\n".join(conv["mensajes"]),
+                guardar_mensaje=False,
+            ))
+            resumen["turnos"] += 1
+    finally:
+        _db.close()
+
+    logger.info(f"Lote de webhook procesado: {resumen}")
+    return {"status": "ok", **resumen}
+
+
+@router.post(
+    "/whatsapp/batch",
+    summary="WhatsApp webhook (batch)",
+    description="Receive a JSON array of bridge events (e.g. a backlog flush after a reconnect). Messages are stored in one transaction and each conversation gets a single agent turn with all its new messages.",
+)
+async def whatsapp_webhook_batch(request: Request):
+    _verify_webhook_token(request)
+    try:
+        data = await request.json()
+        eventos = data.get("events", []) if isinstance(data, dict) else data
+        if not isinstance(eventos, list):
+            return _json_response({"status": "error", "detail": "Expected a JSON array of events"}, status_code=400)
+
+        encolados = 0
+        if WEBHOOK_ASYNC_MODE:
+            # Igual que el webhook suelto: los mensajes van a la cola durable
+            from redis_queue import encolar_evento_entrante
+
+            pendientes = []
+            for data in eventos:
+                if isinstance(data, dict) and _es_evento_encolable(data) and encolar_evento_entrante(data):
+                    encolados += 1
+                else:
+                    pendientes.append(data)
+            eventos = pendientes
+
+        result = await procesar_lote(eventos) if eventos else {"status": "ok"}
+        if encolados:
+            result["encolados"] = encolados
+        return _json_response(result)
+    except Exception as e:
+        logger.error(f"Batch webhook error: {str(e)}", exc_info=True)
+        return _json_response({"status": "error"}, status_code=500)
 
 
 @router.post(
@@ -513,3 +942,12 @@ async def whatsapp_webhook(request: Request):
 )
 async def whatsapp_webhook_alias(request: Request):
     return await whatsapp_webhook(request)
+
+
+@router.post(
+    "/api/webhook/whatsapp/batch",
+    summary="WhatsApp webhook (batch, alias)",
+    description="Batch endpoint under the alias webhook URL (the bridge posts to <webhook URL>/batch).",
+)
+async def whatsapp_webhook_batch_alias(request: Request):
+    return await whatsapp_webhook_batch(request)
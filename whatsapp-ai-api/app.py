@@ -5,7 +5,7 @@ Wtx API - WhatsApp AI Agent
 import json
 import os
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
@@ -56,6 +56,30 @@ async def startup_event():
     asyncio.create_task(campaign_worker())
     logger.info("Campaign worker scheduled")
 
+    # Reenviar a los WebSockets locales los eventos publicados por el worker
+    from ws_manager import ws_manager
+
+    asyncio.create_task(ws_manager.escuchar_relay())
+
+    # Tabla de ruteo sesión -> (usuario_id, perfil_id) en memoria
+    from tenant import cargar_tabla_ruteo, vigilar_tabla_ruteo
+
+    try:
+        cargar_tabla_ruteo()
+    except Exception as e:
+        logger.warning(f"No se pudo cargar la tabla de ruteo: {e}")
+    asyncio.create_task(vigilar_tabla_ruteo())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Cerrar los pools HTTP de los clientes OpenAI compartidos
+    from openai_clients import cerrar_clientes
+    from whatsapp_service import whatsapp_service
+
+    await cerrar_clientes()
+    await whatsapp_service.cerrar()
+
 
 # CORS middleware — allow any localhost port for local dev.
 # Explicit origins come from CORS_ORIGINS (comma-separated). "*" is rejected
@@ -151,6 +175,19 @@ async def websocket_endpoint(websocket: WebSocket):
         ws_manager.disconnect(websocket)
 
 
+# Métricas Prometheus (latencia por etapa del pipeline de mensajes).
+# Si METRICS_TOKEN está configurado se exige como Bearer o ?token=.
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    from fastapi.responses import PlainTextResponse
+    from metrics import render_prometheus, token_valido
+
+    provided = request.query_params.get("token") or request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not token_valido(provided):
+        return PlainTextResponse("unauthorized\n", status_code=401)
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 # Root endpoint
 @app.get("/")
 async def root():
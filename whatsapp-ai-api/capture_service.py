@@ -5,7 +5,7 @@ Data Capture Service - Gestiona campos de captura y extraccion de datos del cont
 import json
 import logging
 from sqlalchemy.orm import Session
-from models import CampoCaptura, Contacto
+from models import CampoCaptura, Contacto, commit_or_flush
 
 logger = logging.getLogger(__name__)
 
@@ -131,7 +131,7 @@ class CaptureService:
             contacto.email = datos["email"]
 
         contacto.datos_capturados = json.dumps(existing, ensure_ascii=False)
-        db.commit()
+        commit_or_flush(db)
 
         return existing
 
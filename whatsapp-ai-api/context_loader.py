@@ -0,0 +1,139 @@
+"""
+Context Loader - Snapshot inmutable de la conversación para un turno del agente
+
+Antes, armar el contexto del orquestador costaba una cadena de queries: el
+Contacto se leía cuatro veces (contexto, datos capturados, campos faltantes y
+paso del funnel), más los campos de captura y el paso actual por separado.
+
+`cargar_snapshot` trae todo en un número fijo de round trips:
+  1. Contacto + su paso del funnel (LEFT JOIN).
+  2. Campos de captura activos del usuario.
+  3. Resumen acumulado de la conversación (history_window).
+  4. Mensajes user/assistant posteriores al resumen (los más nuevos).
+y devuelve un SnapshotConversacion congelado. El clasificador, los skills y el
+prompt builder leen de ahí en vez de volver a consultar la base.
+"""
+
+import json
+import logging
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from history_window import HISTORIAL_MAX_MENSAJES
+from models import CampoCaptura, Contacto, FunnelPaso, MensajeConversacion, ResumenConversacion
+
+logger = logging.getLogger(__name__)
+
+HISTORIAL_LIMITE = HISTORIAL_MAX_MENSAJES
+
+_VACIO: Mapping = MappingProxyType({})
+
+
+def _congelar(d: Optional[dict]) -> Mapping:
+    return MappingProxyType(dict(d)) if d else _VACIO
+
+
+@dataclass(frozen=True)
+class SnapshotConversacion:
+    """Estado de la conversación al inicio del turno (solo lectura)."""
+
+    usuario_id: int
+    perfil_id: Optional[int]
+    telefono: str
+    existe_contacto: bool = False
+    nombre: Optional[str] = None
+    lead_score: Optional[int] = None
+    estado_lead: Optional[str] = None
+    paso_funnel: Optional[str] = None
+    paso: Optional[Mapping] = None
+    datos_capturados: Mapping = field(default_factory=lambda: _VACIO)
+    campos: Tuple[Mapping, ...] = ()
+    historial: Tuple[Mapping, ...] = ()
+    # Resumen de los mensajes anteriores a `historial` (vacío si no hay)
+    resumen: str = ""
+
+    @property
+    def instrucciones_paso(self) -> Optional[str]:
+        return self.paso.get("instrucciones_agente") if self.paso else None
+
+    def campos_faltantes(self, capturados: Optional[Mapping] = None) -> list:
+        """Campos obligatorios sin capturar (opcionalmente contra datos más nuevos)."""
+        capturados = self.datos_capturados if capturados is None else capturados
+        return [dict(c) for c in self.campos if c.get("obligatorio") and c["nombre"] not in capturados]
+
+    def historial_lista(self) -> list:
+        return [dict(m) for m in self.historial]
+
+
+def cargar_snapshot(
+    db: Session, usuario_id: int, perfil_id: Optional[int], telefono: str, limite_historial: int = HISTORIAL_LIMITE
+) -> SnapshotConversacion:
+    """Leer contacto, paso del funnel, campos de captura e historial reciente."""
+    fila = (
+        db.query(Contacto, FunnelPaso)
+        .outerjoin(
+            FunnelPaso,
+            and_(FunnelPaso.usuario_id == Contacto.usuario_id, FunnelPaso.nombre == Contacto.paso_funnel),
+        )
+        .filter(Contacto.usuario_id == usuario_id, Contacto.telefono == telefono)
+        .first()
+    )
+    contacto, paso = fila if fila else (None, None)
+
+    campos = (
+        db.query(CampoCaptura)
+        .filter(CampoCaptura.usuario_id == usuario_id, CampoCaptura.activo == True)
+        .order_by(CampoCaptura.orden)
+        .all()
+    )
+
+    resumen = (
+        db.query(ResumenConversacion.resumen, ResumenConversacion.hasta_mensaje_id)
+        .filter(ResumenConversacion.usuario_id == usuario_id, ResumenConversacion.telefono == telefono)
+        .first()
+    )
+    texto_resumen, hasta_mensaje_id = resumen if resumen else ("", 0)
+
+    mensajes = (
+        db.query(MensajeConversacion.rol, MensajeConversacion.contenido)
+        .filter(
+            MensajeConversacion.telefono == telefono,
+            MensajeConversacion.usuario_id == usuario_id,
+            MensajeConversacion.rol.in_(["user", "assistant"]),
+            MensajeConversacion.tipo_evento == None,
+            MensajeConversacion.id > hasta_mensaje_id,
+        )
+        .order_by(MensajeConversacion.created_at.desc())
+        .limit(limite_historial)
+        .all()
+    )
+    historial = tuple(
+        MappingProxyType({"role": rol, "content": contenido}) for rol, contenido in reversed(mensajes)
+    )
+
+    datos = {}
+    if contacto is not None and contacto.datos_capturados:
+        try:
+            datos = json.loads(contacto.datos_capturados) or {}
+        except (json.JSONDecodeError, TypeError):
+            datos = {}
+
+    return SnapshotConversacion(
+        usuario_id=usuario_id,
+        perfil_id=perfil_id,
+        telefono=telefono,
+        existe_contacto=contacto is not None,
+        nombre=contacto.nombre if contacto is not None else None,
+        lead_score=contacto.lead_score if contacto is not None else None,
+        estado_lead=contacto.estado_lead if contacto is not None else None,
+        paso_funnel=contacto.paso_funnel if contacto is not None else None,
+        paso=_congelar(paso.to_dict()) if paso is not None else None,
+        datos_capturados=_congelar(datos),
+        campos=tuple(_congelar(c.to_dict()) for c in campos),
+        historial=historial,
+        resumen=texto_resumen or "",
+    )
@@ -0,0 +1,155 @@
+"""
+Conversation Lock - Un solo turno del agente en vuelo por conversación
+
+Dos entregas del webhook para el mismo teléfono no deben correr `responder` en
+paralelo: ambas leen el historial, clasifican y escriben (el funnel avanza dos
+veces, el lead score compite y las respuestas llegan desordenadas).
+
+`turno_conversacion(usuario_id, perfil_id, telefono)` serializa por conversación:
+  - Dentro del proceso, un asyncio.Lock por conversación (FIFO: los turnos salen
+    en el orden en que llegaron los mensajes).
+  - Entre procesos/contenedores, un lease en Redis (SET NX PX con token) que se
+    renueva mientras el turno sigue vivo y se libera solo por su dueño.
+Las demás conversaciones conservan paralelismo total. Solo con
+CONVERSATION_LOCK_LOCAL_ONLY=true (un único proceso, desarrollo) se usa el lock
+local sin Redis; si no, Redis caído es ConversacionOcupada: otra réplica puede
+tener el lease y correr el turno sin serializar sería peor que reencolarlo.
+
+Si el lease no se obtiene en LEASE_WAIT_SECONDS (o Redis falla o no responde) el
+turno NO corre: se lanza ConversacionOcupada y el caller lo reencola. Si el
+lease se pierde con el turno en curso (expiró y otro proceso pudo tomarlo) el
+turno se cancela y se lanza LeasePerdido.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Duración del lease; se renueva cada LEASE_MS/3 mientras el turno corre, así
+# que solo expira si el proceso dueño murió.
+LEASE_MS = int(os.getenv("CONVERSATION_LEASE_MS", "30000"))
+# Cuánto esperar el lease antes de desistir (el turno se reencola).
+LEASE_WAIT_SECONDS = float(os.getenv("CONVERSATION_LEASE_WAIT_SECONDS", "120"))
+# Opt-in explícito: serializar solo dentro del proceso (sin Redis)
+LOCAL_ONLY = os.getenv("CONVERSATION_LOCK_LOCAL_ONLY", "false").lower() == "true"
+
+_LUA_RENOVAR = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_LUA_LIBERAR = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# clave -> [lock, referencias]
+_locks_locales: Dict[Tuple, list] = {}
+
+
+class ConversacionOcupada(Exception):
+    """No se obtuvo el lease de la conversación: el turno no corrió."""
+
+
+class LeasePerdido(Exception):
+    """El lease expiró con el turno en curso: el turno se abortó."""
+
+
+def _llave(usuario_id: int, perfil_id: Optional[int], telefono: str) -> str:
+    return f"conv:lease:{usuario_id}:{perfil_id or 0}:{telefono}"
+
+
+async def _adquirir_lease(r, llave: str, token: str) -> bool:
+    espera = 0.05
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + LEASE_WAIT_SECONDS
+    while True:
+        if await r.set(llave, token, nx=True, px=LEASE_MS):
+            return True
+        if loop.time() >= limite:
+            return False
+        await asyncio.sleep(espera)
+        espera = min(espera * 2, 0.5)
+
+
+async def _renovar_lease(r, llave: str, token: str, tarea: asyncio.Task, estado: dict) -> None:
+    """Renovar el lease mientras el turno corre. Si se pierde (otro token en la
+    llave, o no se pudo renovar antes de que venciera) cancela el turno."""
+    loop = asyncio.get_running_loop()
+    vigente_hasta = loop.time() + LEASE_MS / 1000.0
+    while True:
+        await asyncio.sleep(LEASE_MS / 3000.0)
+        antes = loop.time()
+        try:
+            if await r.eval(_LUA_RENOVAR, 1, llave, token, LEASE_MS):
+                vigente_hasta = antes + LEASE_MS / 1000.0
+                continue
+            logger.warning(f"Lease perdido para {llave}, se aborta el turno")
+        except Exception as e:
+            if loop.time() < vigente_hasta:
+                logger.warning(f"Error renovando lease {llave}: {e}")
+                continue
+            logger.warning(f"Lease {llave} vencido sin poder renovarlo ({e}), se aborta el turno")
+        estado["perdido"] = True
+        tarea.cancel()
+        return
+
+
+@asynccontextmanager
+async def turno_conversacion(usuario_id: int, perfil_id: Optional[int], telefono: str):
+    """Context manager async: garantiza a lo sumo un turno en vuelo por conversación.
+
+    Lanza ConversacionOcupada (antes de correr) o LeasePerdido (turno abortado)."""
+    from redis_queue import get_redis_async
+
+    clave = (usuario_id, perfil_id, telefono)
+    entrada = _locks_locales.setdefault(clave, [asyncio.Lock(), 0])
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            if LOCAL_ONLY:
+                yield
+                return
+
+            llave = _llave(usuario_id, perfil_id, telefono)
+            r = await get_redis_async()
+            if r is None:
+                raise ConversacionOcupada(f"Redis no disponible para el lease {llave}")
+            token = uuid.uuid4().hex
+            try:
+                adquirido = await _adquirir_lease(r, llave, token)
+            except Exception as e:
+                raise ConversacionOcupada(f"Error adquiriendo lease {llave}: {e}") from e
+            if not adquirido:
+                raise ConversacionOcupada(f"Lease de {llave} no disponible tras {LEASE_WAIT_SECONDS:.0f}s")
+
+            tarea = asyncio.current_task()
+            estado = {"perdido": False}
+            renovador = asyncio.create_task(_renovar_lease(r, llave, token, tarea, estado))
+            try:
+                yield
+            except asyncio.CancelledError:
+                if not estado["perdido"]:
+                    raise
+                if hasattr(tarea, "uncancel"):
+                    tarea.uncancel()
+                raise LeasePerdido(f"Lease de {llave} perdido con el turno en curso") from None
+            finally:
+                renovador.cancel()
+                try:
+                    await r.eval(_LUA_LIBERAR, 1, llave, token)
+                except Exception as e:
+                    logger.warning(f"Error liberando lease {llave}: {e}")
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            _locks_locales.pop(clave, None)
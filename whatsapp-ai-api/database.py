@@ -157,6 +157,11 @@ def set_config(clave: str, valor: str, usuario_id: int = 0, perfil_id: int = 0):
     finally:
         db.close()
 
+    from prompt_builder import PREFIX_CONFIG_KEYS, invalidar_prefijo
+
+    if clave in PREFIX_CONFIG_KEYS:
+        invalidar_prefijo(usuario_id)
+
 
 def get_all_config(usuario_id: int = None, perfil_id: int = None) -> dict:
     """Obtener toda la config mergeada: global(0,0) -> usuario(uid,0) -> perfil(uid,pid)."""
@@ -4,11 +4,25 @@ Funnel Service - Gestiona pasos del funnel y progresion de contactos
 
 import json
 import logging
+import time
 from sqlalchemy.orm import Session
-from models import FunnelPaso, Contacto, MensajeConversacion
+from models import FunnelPaso, Contacto, MensajeConversacion, commit_or_flush
 
 logger = logging.getLogger(__name__)
 
+# ─── Cache de orden de pasos (lead scoring) ──────────────────────────────
+# usuario_id -> {"ordenes": {nombre: orden}, "ts": float}. Se invalida en las
+# escrituras de pasos de este proceso; los demás lo ven al vencer el TTL.
+_ORDENES_TTL = 60
+_ordenes_cache: dict = {}
+
+
+def invalidar_ordenes(usuario_id: int = None) -> None:
+    if usuario_id is None:
+        _ordenes_cache.clear()
+    else:
+        _ordenes_cache.pop(usuario_id, None)
+
 
 class FunnelService:
     """Servicio para gestionar el funnel de ventas"""
@@ -66,6 +80,7 @@ class FunnelService:
         db.add(paso)
         db.commit()
         db.refresh(paso)
+        invalidar_ordenes(usuario_id)
         return paso.to_dict()
 
     @staticmethod
@@ -86,6 +101,7 @@ class FunnelService:
                 setattr(paso, key, value)
         db.commit()
         db.refresh(paso)
+        invalidar_ordenes(usuario_id)
         return paso.to_dict()
 
     @staticmethod
@@ -101,8 +117,22 @@ class FunnelService:
             return False
         db.delete(paso)
         db.commit()
+        invalidar_ordenes(usuario_id)
         return True
 
+    @staticmethod
+    def get_step_orders(db: Session, usuario_id: int) -> dict:
+        """{nombre: orden} de los pasos del usuario (cacheado por proceso)."""
+        entrada = _ordenes_cache.get(usuario_id)
+        if entrada is not None and time.time() - entrada["ts"] < _ORDENES_TTL:
+            return entrada["ordenes"]
+        ordenes = {}
+        for nombre, orden in db.query(FunnelPaso.nombre, FunnelPaso.orden).filter(FunnelPaso.usuario_id == usuario_id):
+            # Mismo nombre en varios perfiles: el menor orden (igual que el recalculo SQL)
+            ordenes[nombre] = min(orden or 0, ordenes.get(nombre, orden or 0))
+        _ordenes_cache[usuario_id] = {"ordenes": ordenes, "ts": time.time()}
+        return ordenes
+
     @staticmethod
     def get_first_step(db: Session, usuario_id: int) -> dict | None:
         """Obtener el primer paso del funnel"""
@@ -147,7 +177,7 @@ class FunnelService:
         if not contacto:
             return False
         contacto.paso_funnel = step_name
-        db.commit()
+        commit_or_flush(db)
         return True
 
     @staticmethod
@@ -167,7 +197,7 @@ class FunnelService:
             first = FunnelService.get_first_step(db, usuario_id)
             if first:
                 contacto.paso_funnel = first["nombre"]
-                db.commit()
+                commit_or_flush(db)
                 return {"paso_anterior": None, "paso_nuevo": first, "razon": razon}
             return None
 
@@ -177,7 +207,7 @@ class FunnelService:
 
         paso_anterior = current_name
         contacto.paso_funnel = next_step["nombre"]
-        db.commit()
+        commit_or_flush(db)
 
         # Execute action on entering new step
         accion = next_step.get("accion_al_entrar", "ninguna")
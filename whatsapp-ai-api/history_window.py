@@ -0,0 +1,256 @@
+"""
+History Window - Historial del prompt acotado por tokens + resumen acumulado
+
+Antes el agente mandaba siempre los últimos 20 mensajes tal cual: una
+conversación larga (o con mensajes largos) inflaba el prompt y la latencia.
+Ahora:
+
+  - armar_ventana: llena un presupuesto de tokens (`history_token_budget`)
+    de lo más nuevo a lo más viejo; lo que no entra queda representado por el
+    resumen de la conversación, que va primero como mensaje de sistema.
+  - El resumen (ResumenConversacion) cubre los mensajes hasta
+    `hasta_mensaje_id` y se actualiza de forma incremental en background cada
+    `history_summary_every` mensajes nuevos (resumen anterior + mensajes nuevos
+    -> resumen nuevo), dejando siempre afuera los más recientes.
+
+Los tokens se estiman por caracteres (sin tokenizer): alcanza para acotar el
+prompt y no agrega dependencias.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from typing import Dict, Iterable, List, Optional
+
+from database import get_config
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = 1500
+HISTORY_SUMMARY_EVERY = 10
+# Mensajes más nuevos que nunca se resumen (siempre van tal cual)
+MENSAJES_RECIENTES = 4
+# Tope de mensajes posteriores al resumen que carga el snapshot
+HISTORIAL_MAX_MENSAJES = 40
+# Tope de mensajes por actualización del resumen
+LOTE_RESUMEN = 40
+
+RESUMEN_MAX_TOKENS = 300
+_CARACTERES_POR_TOKEN = 4
+_TOKENS_POR_MENSAJE = 4  # rol + separadores del formato chat
+_LOCK_TTL_SEGUNDOS = 120
+
+_PROMPT_RESUMEN = (
+    "Resume la conversacion entre un cliente y el asistente de un negocio por WhatsApp. "
+    "Conserva los datos concretos (nombre, productos, cantidades, fechas, precios, "
+    "acuerdos, dudas abiertas) y omite saludos y relleno. "
+    "Maximo 120 palabras, en espanol, en prosa breve."
+)
+
+_locks_locales: Dict[str, float] = {}
+_tareas: set = set()
+
+
+def estimar_tokens(texto: str) -> int:
+    return math.ceil(len(texto or "") / _CARACTERES_POR_TOKEN) + _TOKENS_POR_MENSAJE
+
+
+def presupuesto_historial(usuario_id: int, perfil_id: int = None) -> int:
+    try:
+        return int(get_config("history_token_budget", str(HISTORY_TOKEN_BUDGET), usuario_id=usuario_id, perfil_id=perfil_id))
+    except (TypeError, ValueError):
+        return HISTORY_TOKEN_BUDGET
+
+
+def resumir_cada(usuario_id: int, perfil_id: int = None) -> int:
+    try:
+        return max(1, int(get_config("history_summary_every", str(HISTORY_SUMMARY_EVERY), usuario_id=usuario_id, perfil_id=perfil_id)))
+    except (TypeError, ValueError):
+        return HISTORY_SUMMARY_EVERY
+
+
+def mensaje_resumen(resumen: str) -> dict:
+    return {"role": "system", "content": f"Resumen de la conversacion anterior:\n{resumen}"}
+
+
+def armar_ventana(mensajes: Iterable[dict], presupuesto: int, resumen: str = "") -> List[dict]:
+    """Mensajes (cronológicos) que entran en `presupuesto` tokens, de lo más
+    nuevo a lo más viejo, precedidos por el resumen si lo hay.
+
+    El último mensaje va siempre, aunque solo él ya supere el presupuesto."""
+    mensajes = list(mensajes)
+    encabezado = [mensaje_resumen(resumen)] if resumen else []
+    restante = presupuesto - sum(estimar_tokens(m["content"]) for m in encabezado)
+
+    elegidos = []
+    for m in reversed(mensajes):
+        costo = estimar_tokens(m.get("content"))
+        if elegidos and costo > restante:
+            break
+        elegidos.append(m)
+        restante -= costo
+    elegidos.reverse()
+    return encabezado + elegidos
+
+
+def necesita_resumen(pendientes: int, cada: int) -> bool:
+    """Hay al menos `cada` mensajes sin resumir además de los recientes."""
+    return pendientes >= cada + MENSAJES_RECIENTES
+
+
+# ─── Actualización en background ────────────────────────────────────────
+
+
+def _llave_lock(usuario_id: int, telefono: str) -> str:
+    return f"resumen:lock:{usuario_id}:{telefono}"
+
+
+def _tomar_lock(usuario_id: int, telefono: str) -> bool:
+    llave = _llave_lock(usuario_id, telefono)
+    try:
+        from redis_queue import get_redis
+
+        return bool(get_redis().set(llave, "1", nx=True, ex=_LOCK_TTL_SEGUNDOS))
+    except Exception:
+        pass
+    ahora = time.monotonic()
+    if _locks_locales.get(llave, 0) > ahora:
+        return False
+    _locks_locales[llave] = ahora + _LOCK_TTL_SEGUNDOS
+    return True
+
+
+def _soltar_lock(usuario_id: int, telefono: str) -> None:
+    llave = _llave_lock(usuario_id, telefono)
+    _locks_locales.pop(llave, None)
+    try:
+        from redis_queue import get_redis
+
+        get_redis().delete(llave)
+    except Exception:
+        pass
+
+
+def programar_resumen(usuario_id: int, perfil_id: Optional[int], telefono: str) -> None:
+    """Lanzar la actualización del resumen sin esperar (una por conversación a la vez)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # camino síncrono (scripts): el siguiente turno async lo hará
+    if not _tomar_lock(usuario_id, telefono):
+        return
+    task = loop.create_task(_refrescar_con_lock(usuario_id, perfil_id, telefono))
+    _tareas.add(task)
+    task.add_done_callback(_tareas.discard)
+
+
+async def _refrescar_con_lock(usuario_id: int, perfil_id: Optional[int], telefono: str) -> None:
+    try:
+        await refrescar_resumen(usuario_id, perfil_id, telefono)
+    except Exception as e:
+        logger.error(f"Error actualizando resumen de {telefono}: {e}")
+    finally:
+        _soltar_lock(usuario_id, telefono)
+
+
+def _cargar_pendientes(usuario_id: int, telefono: str):
+    """Resumen actual + mensajes posteriores a resumir (sin los más recientes)."""
+    from models import MensajeConversacion, ResumenConversacion, SessionLocal
+
+    db = SessionLocal()
+    try:
+        fila = (
+            db.query(ResumenConversacion)
+            .filter(ResumenConversacion.usuario_id == usuario_id, ResumenConversacion.telefono == telefono)
+            .first()
+        )
+        hasta = fila.hasta_mensaje_id if fila else 0
+        mensajes = (
+            db.query(MensajeConversacion.id, MensajeConversacion.rol, MensajeConversacion.contenido)
+            .filter(
+                MensajeConversacion.usuario_id == usuario_id,
+                MensajeConversacion.telefono == telefono,
+                MensajeConversacion.rol.in_(["user", "assistant"]),
+                MensajeConversacion.tipo_evento == None,
+                MensajeConversacion.id > hasta,
+            )
+            .order_by(MensajeConversacion.id)
+            .limit(LOTE_RESUMEN + MENSAJES_RECIENTES)
+            .all()
+        )
+        return (fila.resumen if fila else ""), hasta, list(mensajes[: max(0, len(mensajes) - MENSAJES_RECIENTES)])
+    finally:
+        db.close()
+
+
+def _guardar_resumen(usuario_id: int, perfil_id: Optional[int], telefono: str, resumen: str, hasta_previo: int, hasta: int, cantidad: int) -> bool:
+    """Guardar solo si nadie lo movió mientras se generaba (hasta_previo)."""
+    from models import ResumenConversacion, SessionLocal
+
+    db = SessionLocal()
+    try:
+        fila = (
+            db.query(ResumenConversacion)
+            .filter(ResumenConversacion.usuario_id == usuario_id, ResumenConversacion.telefono == telefono)
+            .with_for_update()
+            .first()
+        )
+        if fila is None:
+            if hasta_previo:
+                return False  # la conversación se borró mientras tanto
+            fila = ResumenConversacion(usuario_id=usuario_id, perfil_id=perfil_id, telefono=telefono, mensajes_resumidos=0)
+            db.add(fila)
+        elif fila.hasta_mensaje_id != hasta_previo:
+            return False
+        fila.resumen = resumen
+        fila.hasta_mensaje_id = hasta
+        fila.mensajes_resumidos = (fila.mensajes_resumidos or 0) + cantidad
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def refrescar_resumen(usuario_id: int, perfil_id: Optional[int], telefono: str) -> bool:
+    """Incorporar al resumen los mensajes nuevos (menos los recientes). True si cambió."""
+    from llm_resilience import completar_async
+
+    loop = asyncio.get_running_loop()
+    resumen, hasta, mensajes = await loop.run_in_executor(None, _cargar_pendientes, usuario_id, telefono)
+    if not mensajes:
+        return False
+
+    transcripcion = "\n".join(
+        f"{'Cliente' if rol == 'user' else 'Asistente'}: {contenido}" for _, rol, contenido in mensajes
+    )
+    contenido = (
+        f"Resumen hasta ahora:\n{resumen}\n\nMensajes nuevos:\n{transcripcion}"
+        if resumen
+        else f"Conversacion:\n{transcripcion}"
+    )
+    response = await completar_async(
+        "resumen",
+        usuario_id,
+        perfil_id=perfil_id,
+        model=get_config("summary_model", "gpt-4o-mini", usuario_id=usuario_id),
+        messages=[
+            {"role": "system", "content": _PROMPT_RESUMEN},
+            {"role": "user", "content": contenido},
+        ],
+        temperature=0.2,
+        max_tokens=RESUMEN_MAX_TOKENS,
+    )
+    nuevo = (response.choices[0].message.content or "").strip()
+    if not nuevo:
+        return False
+
+    guardado = await loop.run_in_executor(
+        None, _guardar_resumen, usuario_id, perfil_id, telefono, nuevo, hasta, mensajes[-1][0], len(mensajes)
+    )
+    if guardado:
+        logger.info(f"Resumen de {telefono} actualizado ({len(mensajes)} mensajes nuevos)")
+    return guardado
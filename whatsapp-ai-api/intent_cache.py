@@ -0,0 +1,130 @@
+"""
+Intent Cache - Caché de clasificaciones del nivel 3 (mini AI)
+
+Buena parte del tráfico se repite ("hola", "gracias", "precio?", "ok") y cada
+mensaje que no coincide con ninguna keyword pagaba un viaje a gpt-4o-mini.
+Aquí se guarda la decisión del clasificador (skill + trigger) en dos niveles:
+
+  - LRU en memoria del proceso, acotado (INTENT_CACHE_SIZE) y con TTL.
+  - Redis (opcional, INTENT_CACHE_REDIS): compartido entre réplicas; un hit
+    en Redis se copia al LRU local.
+
+La clave es (usuario_id, perfil_id) + mensaje normalizado + skills habilitados
++ triggers pendientes + una huella gruesa del contexto (si hay datos por
+capturar). El historial reciente NO entra en la clave: por eso solo se cachean
+mensajes cortos (INTENT_CACHE_MAX_CHARS), que son los que se repiten y los que
+menos dependen de la conversación. Un cambio de skills o triggers cambia la
+clave; lo viejo expira solo por TTL.
+
+Métrica: wtx_intent_cache_total{resultado=hit_local|hit_redis|miss}.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from metrics import Contador
+
+logger = logging.getLogger(__name__)
+
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "5000"))
+INTENT_CACHE_TTL_SECONDS = int(os.getenv("INTENT_CACHE_TTL_SECONDS", "3600"))
+INTENT_CACHE_MAX_CHARS = int(os.getenv("INTENT_CACHE_MAX_CHARS", "80"))
+INTENT_CACHE_REDIS = os.getenv("INTENT_CACHE_REDIS", "true").lower() == "true"
+
+INTENT_CACHE = Contador(
+    "wtx_intent_cache_total",
+    "Consultas al cache de clasificacion de intencion por resultado",
+    ("resultado", "usuario_id"),
+)
+
+_entradas: "OrderedDict[str, tuple]" = OrderedDict()  # clave -> (expira, decision)
+_lock = threading.Lock()
+
+
+def cacheable(normalizado: str) -> bool:
+    return 0 < len(normalizado) <= INTENT_CACHE_MAX_CHARS
+
+
+def huella_contexto(context: dict) -> str:
+    return "pendientes" if context.get("datos_pendientes") else "-"
+
+
+def clave(
+    usuario_id: int,
+    perfil_id: Optional[int],
+    normalizado: str,
+    enabled_skills: Optional[Iterable[str]],
+    intenciones: Iterable[str],
+    huella: str,
+) -> str:
+    """Clave con namespace por tenant; el resto va hasheado."""
+    partes = json.dumps(
+        [
+            " ".join(normalizado.split()),
+            sorted(enabled_skills) if enabled_skills is not None else None,
+            list(intenciones),
+            huella,
+        ],
+        ensure_ascii=False,
+    )
+    digest = hashlib.sha1(partes.encode("utf-8")).hexdigest()
+    return f"intent:{usuario_id}:{perfil_id or 0}:{digest}"
+
+
+def obtener(llave: str, usuario_id: int) -> Optional[dict]:
+    ahora = time.monotonic()
+    with _lock:
+        entrada = _entradas.get(llave)
+        if entrada is not None:
+            if entrada[0] > ahora:
+                _entradas.move_to_end(llave)
+                INTENT_CACHE.inc(resultado="hit_local", usuario_id=usuario_id)
+                return dict(entrada[1])
+            del _entradas[llave]
+
+    if INTENT_CACHE_REDIS:
+        try:
+            from redis_queue import get_redis
+
+            crudo = get_redis().get(llave)
+            if crudo:
+                decision = json.loads(crudo)
+                _guardar_local(llave, decision)
+                INTENT_CACHE.inc(resultado="hit_redis", usuario_id=usuario_id)
+                return decision
+        except Exception as e:
+            logger.debug(f"Intent cache Redis no disponible: {e}")
+
+    INTENT_CACHE.inc(resultado="miss", usuario_id=usuario_id)
+    return None
+
+
+def _guardar_local(llave: str, decision: dict) -> None:
+    with _lock:
+        _entradas[llave] = (time.monotonic() + INTENT_CACHE_TTL_SECONDS, dict(decision))
+        _entradas.move_to_end(llave)
+        while len(_entradas) > INTENT_CACHE_SIZE:
+            _entradas.popitem(last=False)
+
+
+def guardar(llave: str, decision: dict) -> None:
+    _guardar_local(llave, decision)
+    if INTENT_CACHE_REDIS:
+        try:
+            from redis_queue import get_redis
+
+            get_redis().set(llave, json.dumps(decision), ex=INTENT_CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.debug(f"Intent cache Redis no disponible: {e}")
+
+
+def limpiar() -> None:
+    """Vaciar el nivel local (tests / cambios masivos de config)."""
+    with _lock:
+        _entradas.clear()
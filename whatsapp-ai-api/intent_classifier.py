@@ -4,16 +4,22 @@ Intent Classifier — 3-level message classification for WhatsApp messages.
 Classifies incoming messages into skill intents deterministically before
 invoking the AI agent. Levels (cheapest first):
   1. Keyword matching (free, instant)
+     + local model trained on past AI decisions (free, instant, if confident)
   2. Funnel context (free, instant)
-  3. Mini AI classifier (~50 tokens, only when ambiguous)
+  3. Mini AI classifier (one structured call, only when ambiguous)
+
+Level 0 (human-mode triggers) runs first. Whatever is still undecided after
+the cheap levels (trigger verification, descriptive triggers, skill) goes in a
+single JSON-output call, or inline in the main completion.
 """
 
 import os
 import json
 import logging
-import unicodedata
 from typing import Optional
 from dataclasses import dataclass, field
+from keyword_matcher import KeywordMatcher, normalizar
+from metrics import etapa
 
 logger = logging.getLogger(__name__)
 
@@ -25,8 +31,10 @@ logger = logging.getLogger(__name__)
 class IntentResult:
     primary: str  # main skill: "appointment", "catalog", "human_handoff", etc.
     secondary: str | None = None  # additional skill (e.g. "data_capture" from funnel)
-    confidence: str = "keyword"  # "keyword", "funnel", "ai", "default"
+    confidence: str = "keyword"  # "keyword", "local", "funnel", "ai", "default"
     matched_keywords: list = field(default_factory=list)  # for debugging
+    # Modo "inline": triggers de handoff que decide la completion principal
+    triggers_pendientes: Optional["TriggersPendientes"] = None
 
 
 # ─── Skill keyword registry ───────────────────────────────────────────────
@@ -57,8 +65,9 @@ SKILL_KEYWORDS: dict[str, list[str]] = {
     ],
 }
 
-# Pre-sort each skill's keywords so multi-word phrases are tried first.
-# Longer phrases are more specific and should take priority.
+# Pre-sort each skill's keywords so multi-word phrases are listed first.
+# Longer phrases are more specific and should take priority (the compiled
+# matcher also prefers the longest phrase at each position).
 for _skill in SKILL_KEYWORDS:
     SKILL_KEYWORDS[_skill].sort(key=lambda kw: -len(kw))
 
@@ -67,153 +76,255 @@ for _skill in SKILL_KEYWORDS:
 
 
 def _normalize(text: str) -> str:
-    """Remove accents and lowercase for flexible matching.
-
-    Uses NFD decomposition to strip combining characters (accents),
-    so "cómo estás" becomes "como estas".
-    """
-    nfkd = unicodedata.normalize("NFKD", text.lower())
-    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+    """Remove accents and lowercase for flexible matching ("cómo estás" -> "como estas")."""
+    return normalizar(text)
 
 
 # ─── Level 1: Keyword matching ────────────────────────────────────────────
 
 
-def classify_by_human_triggers(
-    message: str, usuario_id: int = 1, perfil_id: int = None
-) -> IntentResult | None:
-    """Level 0: Check user-configured human mode triggers FIRST.
+# Palabras clave por categoría de trigger de modo humano (las categorías activas
+# se eligen en el HumanModeTab del frontend -> config "human_mode_triggers").
+HUMAN_TRIGGER_KEYWORDS: dict[str, list[str]] = {
+    "frustration": ["molesto", "enojado", "frustrado", "harto", "cansado de", "no sirve", "pésimo", "horrible", "terrible", "indignado"],
+    "complaint": ["queja", "reclamo", "demanda", "problema grave", "inaceptable", "exijo", "reembolso", "devolución"],
+    "human_request": ["hablar con humano", "persona real", "agente humano", "hablar con alguien", "asesor", "ejecutivo", "representante", "operador", "supervisor"],
+    "urgency": ["urgente", "emergencia", "ahora mismo", "inmediatamente", "lo antes posible", "crítico"],
+    "complexity": ["no entiendes", "no me ayudas", "no puedes", "no sabes", "inútil", "no sirves"],
+    "negotiation": ["descuento", "rebaja", "precio especial", "promoción", "negociar", "oferta"],
+}
 
-    These are the highest priority — if the user configured "agendar" as a
-    human trigger, it takes precedence over the appointment skill.
+DEFAULT_HUMAN_TRIGGERS = '["frustration","complaint","human_request"]'
 
-    Loads triggers from DB config (same as HumanModeTab in frontend).
-    """
-    from database import get_config
-    import json
 
-    normalized = _normalize(message)
+# ─── Matchers compilados ──────────────────────────────────────────────────
+# Todas las keywords (skills, categorías de trigger y triggers custom) se
+# compilan en un KeywordMatcher por perfil: el mensaje se normaliza y se
+# recorre UNA vez. Se reconstruye solo si cambia la config de triggers.
+
+_PRIORIDAD_CUSTOM = 0
+_PRIORIDAD_HANDOFF = 1
+_PRIORIDAD_CATEGORIA = 2  # + posición de la categoría en la config
+_PRIORIDAD_SKILL = 1000
+
+
+def _entradas_skills() -> list:
+    return [
+        (kw, ("skill", skill), _PRIORIDAD_SKILL)
+        for skill, keywords in SKILL_KEYWORDS.items()
+        if skill != "human_handoff"
+        for kw in keywords
+    ]
+
+
+_skills_matcher: KeywordMatcher | None = None
+
 
-    # Load configured trigger categories
-    triggers_str = get_config("human_mode_triggers", '["frustration","complaint","human_request"]', usuario_id=usuario_id, perfil_id=perfil_id)
+def _matcher_skills() -> KeywordMatcher:
+    """Solo keywords de skills (classify_by_keywords sin perfil)."""
+    global _skills_matcher
+    if _skills_matcher is None:
+        _skills_matcher = KeywordMatcher(_entradas_skills())
+    return _skills_matcher
+
+
+@dataclass
+class KeywordsPerfil:
+    firma: tuple
+    matcher: KeywordMatcher
+    # Triggers custom de más de 2 palabras: solo los puede decidir un LLM
+    descriptivos: list
+
+
+_perfiles: dict[tuple, KeywordsPerfil] = {}
+
+
+def _parsear_categorias(triggers_str: str) -> list:
     try:
-        active_categories = json.loads(triggers_str) if triggers_str else []
+        categorias = json.loads(triggers_str) if triggers_str else []
     except (json.JSONDecodeError, TypeError):
-        active_categories = []
-
-    # Check hardcoded keywords for active categories
-    if "human_handoff" in SKILL_KEYWORDS:
-        for kw in SKILL_KEYWORDS["human_handoff"]:
-            if _normalize(kw) in normalized:
-                logger.info("Human trigger (built-in keyword): '%s'", kw)
-                return IntentResult(
-                    primary="human_handoff",
-                    confidence="keyword",
-                    matched_keywords=[kw],
-                )
-
-    # Check custom triggers from config
+        categorias = json.loads(DEFAULT_HUMAN_TRIGGERS)
+    return categorias if isinstance(categorias, list) else []
+
+
+def keywords_perfil(usuario_id: int, perfil_id: int = None) -> KeywordsPerfil:
+    """Matcher del perfil; se recompila solo si cambió su config de triggers."""
+    from database import get_config
+
+    triggers_str = get_config("human_mode_triggers", DEFAULT_HUMAN_TRIGGERS, usuario_id=usuario_id, perfil_id=perfil_id)
     custom_str = get_config("human_mode_custom_triggers", "", usuario_id=usuario_id, perfil_id=perfil_id)
-    if custom_str:
-        custom_triggers = [t.strip() for t in custom_str.split(",") if t.strip()]
-
-        # First pass: exact keyword match (fast, free)
-        for trigger in custom_triggers:
-            if _normalize(trigger) in normalized:
-                logger.info("Human trigger (custom keyword): '%s'", trigger)
-                return IntentResult(
-                    primary="human_handoff",
-                    confidence="keyword",
-                    matched_keywords=[trigger],
-                )
-
-        # Second pass: AI intent match for descriptive triggers
-        # e.g. "cuando el usuario quiera agendar" → checks if message MEANS that
-        descriptive_triggers = [t for t in custom_triggers if len(t.split()) > 2]
-        if descriptive_triggers:
-            match = _match_triggers_by_ai(message, descriptive_triggers, usuario_id)
-            if match:
-                logger.info("Human trigger (AI intent match): '%s'", match)
-                return IntentResult(
-                    primary="human_handoff",
-                    confidence="ai",
-                    matched_keywords=[match],
-                )
+    firma = (triggers_str, custom_str)
+
+    clave = (usuario_id, perfil_id)
+    actual = _perfiles.get(clave)
+    if actual is not None and actual.firma == firma:
+        return actual
+
+    custom = [t.strip() for t in custom_str.split(",") if t.strip()] if custom_str else []
+    entradas = [(t, ("custom", None), _PRIORIDAD_CUSTOM) for t in custom if len(t.split()) <= 2]
+    # Las frases de SKILL_KEYWORDS["human_handoff"] cuentan siempre como
+    # human_request; el resto solo para categorías activas.
+    entradas += [(kw, ("trigger", "human_request"), _PRIORIDAD_HANDOFF) for kw in SKILL_KEYWORDS.get("human_handoff", [])]
+    for i, categoria in enumerate(_parsear_categorias(triggers_str)):
+        entradas += [
+            (kw, ("trigger", categoria), _PRIORIDAD_CATEGORIA + i)
+            for kw in HUMAN_TRIGGER_KEYWORDS.get(categoria, [])
+        ]
+    entradas += _entradas_skills()
+
+    actual = KeywordsPerfil(
+        firma=firma,
+        matcher=KeywordMatcher(entradas),
+        descriptivos=[t for t in custom if len(t.split()) > 2],
+    )
+    _perfiles[clave] = actual
+    return actual
 
-    return None
 
+@dataclass
+class TriggersPendientes:
+    """Triggers de modo humano que solo puede decidir un LLM: un keyword a
+    verificar (human_mode_ai_classification) y/o triggers descriptivos."""
 
-def _match_triggers_by_ai(message: str, triggers: list[str], usuario_id: int) -> str | None:
-    """Use mini-AI to check if message matches any descriptive trigger intent.
-    Returns the matched trigger string or None.
-    """
-    try:
-        from agent import get_openai_client
-
-        client = get_openai_client(usuario_id)
-        triggers_list = "\n".join(f"- {t}" for t in triggers)
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Evalua si el mensaje del cliente coincide con alguna de estas intenciones.\n"
-                        f"Intenciones:\n{triggers_list}\n\n"
-                        "Si el mensaje coincide con alguna, responde SOLO con el texto exacto de la intencion.\n"
-                        "Si no coincide con ninguna, responde SOLO: NO"
-                    ),
-                },
-                {"role": "user", "content": message},
-            ],
-            temperature=0,
-            max_tokens=50,
-        )
+    keyword_hit: tuple[str, str] | None = None
+    descriptivos: list = field(default_factory=list)
 
-        result = response.choices[0].message.content.strip()
-        if result.upper() == "NO":
+    @property
+    def keyword_label(self) -> str | None:
+        if not self.keyword_hit:
             return None
+        category, keyword = self.keyword_hit
+        return f"necesita intervencion humana real ({category}: '{keyword}')"
 
-        # Validate that the response is one of the triggers
-        for trigger in triggers:
-            if _normalize(trigger) in _normalize(result) or _normalize(result) in _normalize(trigger):
-                return trigger
+    @property
+    def intenciones(self) -> list[str]:
+        return ([self.keyword_label] if self.keyword_hit else []) + list(self.descriptivos)
 
+    def resolver(self, texto: str | None) -> str | None:
+        """Trigger (o keyword) que corresponde al texto devuelto por el LLM."""
+        if not texto:
+            return None
+        for intencion in self.intenciones:
+            if _normalize(intencion) in _normalize(texto) or _normalize(texto) in _normalize(intencion):
+                return self.keyword_hit[1] if intencion == self.keyword_label else intencion
         return None
 
-    except Exception as e:
-        logger.error("AI trigger matching failed: %s", e)
+    def instrucciones(self) -> str:
+        lista = "\n".join(f"- {t}" for t in self.intenciones)
+        reglas = ""
+        if self.keyword_hit:
+            reglas = (
+                "La primera intencion solo aplica si el cliente GENUINAMENTE necesita hablar con un humano, "
+                "esta frustrado de verdad, tiene una emergencia o hace una queja seria; NO si solo hace una "
+                "pregunta informativa (\"Eres una persona real?\" -> NO, \"Quiero hablar con una persona real\" -> si).\n"
+            )
+        return f"Intenciones que requieren pasar a un humano:\n{lista}\n{reglas}"
+
+
+def evaluar_triggers_humanos(
+    message: str, usuario_id: int = 1, perfil_id: int = None, coincidencias: list = None
+) -> IntentResult | TriggersPendientes | None:
+    """Parte determinística del nivel 0.
+
+    Retorna IntentResult si un keyword decide el handoff, TriggersPendientes si
+    hace falta un LLM para decidir, o None si no hay nada que evaluar.
+    `coincidencias`: resultado de keywords_perfil(...).matcher.buscar si el
+    caller ya recorrió el mensaje.
+    """
+    from database import get_config
+
+    perfil = keywords_perfil(usuario_id, perfil_id)
+    if coincidencias is None:
+        coincidencias = perfil.matcher.buscar(_normalize(message))
+
+    # Vienen ordenadas por prioridad: custom, frases de handoff, categorías
+    keyword_hit = None
+    for c in coincidencias:
+        tipo, categoria = c.etiqueta
+        if tipo == "custom":
+            # 1. Custom keywords: el usuario los configuró explícitamente
+            logger.info("Human trigger (custom keyword): '%s'", c.keyword)
+            return IntentResult(
+                primary="human_handoff",
+                confidence="keyword",
+                matched_keywords=[c.keyword],
+            )
+        if tipo == "trigger":
+            # 2. Built-in category keywords
+            keyword_hit = (categoria, c.keyword)
+            break
+
+    ai_verify = keyword_hit is not None and get_config(
+        "human_mode_ai_classification", "true", usuario_id=usuario_id, perfil_id=perfil_id
+    ).lower() == "true"
+
+    if keyword_hit and not ai_verify:
+        logger.info("Human trigger (keyword %s): '%s'", keyword_hit[0], keyword_hit[1])
+        return IntentResult(
+            primary="human_handoff",
+            confidence="keyword",
+            matched_keywords=[keyword_hit[1]],
+        )
+
+    # 3. Lo que queda lo decide un LLM (verificación + triggers descriptivos)
+    if not (ai_verify or perfil.descriptivos):
+        return None
+    return TriggersPendientes(keyword_hit=keyword_hit if ai_verify else None, descriptivos=list(perfil.descriptivos))
+
+
+def _handoff_por_ia(match: str | None) -> IntentResult | None:
+    if not match:
         return None
+    logger.info("Human trigger (AI intent match): '%s'", match)
+    return IntentResult(primary="human_handoff", confidence="ai", matched_keywords=[match])
+
+
+def classify_by_human_triggers(
+    message: str, usuario_id: int = 1, perfil_id: int = None
+) -> IntentResult | None:
+    """Level 0: unified human-mode trigger stage — runs BEFORE any completion.
+
+    It is the only place that decides a handoff (the webhook's
+    detectar_trigger_modo_humano delegates here), so a triggered message never
+    pays for a reply that would be discarded. Steps, cheapest first:
+      1. Custom keyword triggers from config (explicit → handoff, no AI).
+      2. Built-in category keywords (human_mode_triggers) + SKILL_KEYWORDS.
+      3. At most ONE structured mini-AI call that both verifies an ambiguous
+         keyword hit (if human_mode_ai_classification is on) and matches
+         descriptive custom triggers ("cuando el usuario quiera agendar").
+    classify_intent hace lo mismo pero resuelve el paso 3 junto con el skill.
+    """
+    resultado = evaluar_triggers_humanos(message, usuario_id, perfil_id=perfil_id)
+    if not isinstance(resultado, TriggersPendientes):
+        return resultado
+    decision = _clasificar_con_cache(message, usuario_id, perfil_id, pendientes=resultado)
+    return _handoff_por_ia(decision["trigger"])
 
 
 def classify_by_keywords(
-    message: str, enabled_skills: list[str]
+    message: str, enabled_skills: list[str], coincidencias: list = None
 ) -> IntentResult | None:
     """Level 1: Fast keyword matching against SKILL_KEYWORDS.
 
     Only checks ENABLED skills. Disabled skills are simply skipped.
-    human_handoff is handled separately in Level 0.
+    human_handoff is handled separately in Level 0. The longest matched
+    keyword decides the skill.
     """
-    normalized = _normalize(message)
+    if coincidencias is None:
+        coincidencias = _matcher_skills().buscar(_normalize(message))
+
     best_skill: str | None = None
     best_length: int = 0
     matched: list[str] = []
 
-    for skill in SKILL_KEYWORDS:
-        # Skip human_handoff (handled in Level 0) and disabled skills
-        if skill == "human_handoff":
-            continue
-        if skill not in enabled_skills:
+    for c in sorted(coincidencias, key=lambda c: c.inicio):
+        tipo, skill = c.etiqueta
+        if tipo != "skill" or skill not in enabled_skills:
             continue
-
-        for keyword in SKILL_KEYWORDS[skill]:
-            norm_kw = _normalize(keyword)
-            if norm_kw in normalized:
-                matched.append(keyword)
-                if len(norm_kw) > best_length:
-                    best_length = len(norm_kw)
-                    best_skill = skill
+        matched.append(c.keyword)
+        if len(c.keyword) > best_length:
+            best_length = len(c.keyword)
+            best_skill = skill
 
     if best_skill:
         logger.info(
@@ -230,6 +341,28 @@ def classify_by_keywords(
     return None
 
 
+def classify_by_local_model(
+    message: str, enabled_skills: list[str], usuario_id: int, perfil_id: int = None
+) -> IntentResult | None:
+    """Level 1b: per-profile model trained on past AI decisions (local_intent_model).
+
+    Only answers when it is confident; otherwise level 3 decides (and its
+    decision becomes a new training example).
+    """
+    from local_intent_model import predecir
+
+    try:
+        prediccion = predecir(usuario_id, perfil_id, _normalize(message).strip(), enabled_skills)
+    except Exception as e:
+        logger.error("Local intent model failed: %s", e)
+        return None
+    if prediccion is None:
+        return None
+    skill, probabilidad = prediccion
+    logger.info("Intent classified by local model: %s (p=%.2f)", skill, probabilidad)
+    return IntentResult(primary=skill, confidence="local")
+
+
 # ─── Level 2: Funnel context ──────────────────────────────────────────────
 
 
@@ -252,68 +385,159 @@ def classify_by_funnel(context: dict) -> str | None:
 # ─── Level 3: Mini AI classifier ──────────────────────────────────────────
 
 
-def classify_by_ai(
+def classify_by_ai_structured(
     message: str,
-    enabled_skills: list[str],
-    recent_messages: list,
     usuario_id: int,
-) -> str:
-    """Level 3: Minimal AI classification (~50 tokens).
-
-    Only called when levels 1 and 2 produce no primary match.
-    Uses gpt-4o-mini with a tiny prompt to classify into one skill.
-    Returns the skill name string.
+    enabled_skills: list[str] | None = None,
+    recent_messages: list | None = None,
+    pendientes: TriggersPendientes | None = None,
+    perfil_id: int | None = None,
+) -> dict:
+    """Level 3: one mini-AI call with JSON output for everything still open.
+
+    Decides in the same request the handoff triggers that need an LLM
+    (`pendientes`) and, if `enabled_skills` is given, the skill. Returns
+    {"trigger": str|None, "skill": str|None, "confidence": float}; `trigger`
+    is the matched trigger (or the verified keyword). If the call fails, a
+    keyword hit is honored and the skill falls back to free_chat.
     """
-    from agent import get_openai_client
-
-    skills_str = ", ".join(enabled_skills + ["free_chat"])
+    from llm_resilience import completar
+
+    valid_skills = (enabled_skills or []) + ["free_chat"] if enabled_skills is not None else None
+    campos = {}
+    partes = ["Eres un clasificador de mensajes de clientes de WhatsApp."]
+    if pendientes is not None:
+        partes.append(pendientes.instrucciones())
+        campos["trigger"] = "texto exacto de la intencion que coincide, o null si ninguna"
+    if valid_skills is not None:
+        partes.append("Skills: " + ", ".join(valid_skills) + ".")
+        campos["skill"] = "exactamente uno de los skills"
+    campos["confidence"] = "numero de 0 a 1"
+    partes.append(
+        "Responde SOLO un objeto JSON con las claves: "
+        + "; ".join(f'"{k}": {v}' for k, v in campos.items())
+        + "."
+    )
 
-    # Build minimal conversation context (last 2 messages)
     context_lines = ""
     for msg in (recent_messages or [])[-2:]:
         role = msg.get("role", "user")
         text = msg.get("content", "")[:100]
         context_lines += f"{role}: {text}\n"
-
-    system_prompt = (
-        "You are a message classifier. Classify the user message into "
-        "exactly ONE of these skills: " + skills_str + ".\n"
-        "Reply with ONLY the skill name, nothing else."
-    )
-
     user_prompt = ""
     if context_lines:
-        user_prompt += f"Recent conversation:\n{context_lines}\n"
-    user_prompt += f"New message: {message}"
-
+        user_prompt += f"Conversacion reciente:\n{context_lines}\n"
+    user_prompt += f"Mensaje nuevo: {message}"
+
+    fallback = {
+        "trigger": pendientes.keyword_hit[1] if pendientes and pendientes.keyword_hit else None,
+        "skill": "free_chat" if valid_skills is not None else None,
+        "confidence": 0.0,
+        "fallback": True,  # no se cachea
+    }
     try:
-        client = get_openai_client(usuario_id)
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            max_tokens=10,
-            temperature=0,
-        )
-        skill = response.choices[0].message.content.strip().lower()
+        with etapa("clasificador_ia"):
+            response = completar(
+                "clasificador",
+                usuario_id,
+                perfil_id=perfil_id,
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "\n".join(partes)},
+                    {"role": "user", "content": user_prompt},
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=60,
+                temperature=0,
+            )
+        data = json.loads(response.choices[0].message.content or "{}")
+    except Exception as e:
+        logger.error("AI classifier failed: %s — using fallback", e)
+        return fallback
+
+    trigger = pendientes.resolver(data.get("trigger")) if pendientes is not None else None
 
-        # Validate the returned skill is in our list
-        valid_skills = set(enabled_skills + ["free_chat"])
+    skill = None
+    if valid_skills is not None:
+        skill = str(data.get("skill") or "").strip().lower()
         if skill not in valid_skills:
-            logger.warning(
-                "AI classifier returned unknown skill '%s', falling back to free_chat",
-                skill,
-            )
-            return "free_chat"
+            logger.warning("AI classifier returned unknown skill '%s', falling back to free_chat", skill)
+            skill = "free_chat"
 
-        logger.info("Intent classified by AI: %s", skill)
-        return skill
+    try:
+        confidence = float(data.get("confidence", 0))
+    except (TypeError, ValueError):
+        confidence = 0.0
 
-    except Exception as e:
-        logger.error("AI classifier failed: %s — falling back to free_chat", e)
-        return "free_chat"
+    logger.info("Intent classified by AI: skill=%s trigger=%s confidence=%.2f", skill, trigger, confidence)
+    return {"trigger": trigger, "skill": skill, "confidence": confidence}
+
+
+def _clasificar_con_cache(
+    message: str,
+    usuario_id: int,
+    perfil_id: int = None,
+    enabled_skills: list[str] | None = None,
+    recent_messages: list | None = None,
+    pendientes: TriggersPendientes | None = None,
+    huella: str = "-",
+) -> dict:
+    """classify_by_ai_structured detrás de intent_cache (mensajes cortos)."""
+    import intent_cache
+
+    normalized = _normalize(message).strip()
+    if not intent_cache.cacheable(normalized):
+        return _clasificar_y_aprender(message, usuario_id, perfil_id, enabled_skills, recent_messages, pendientes)
+
+    llave = intent_cache.clave(
+        usuario_id, perfil_id, normalized, enabled_skills,
+        pendientes.intenciones if pendientes is not None else [], huella,
+    )
+    decision = intent_cache.obtener(llave, usuario_id)
+    if decision is not None:
+        logger.info("Intent from cache: skill=%s trigger=%s", decision.get("skill"), decision.get("trigger"))
+        return decision
+
+    decision = _clasificar_y_aprender(message, usuario_id, perfil_id, enabled_skills, recent_messages, pendientes)
+    if not decision.get("fallback"):
+        intent_cache.guardar(llave, decision)
+    return decision
+
+
+def _clasificar_y_aprender(message, usuario_id, perfil_id, enabled_skills, recent_messages, pendientes) -> dict:
+    """classify_by_ai_structured + guardar su decisión de skill como ejemplo
+    de entrenamiento del modelo local."""
+    decision = classify_by_ai_structured(
+        message, usuario_id, enabled_skills, recent_messages, pendientes, perfil_id=perfil_id
+    )
+    if enabled_skills is not None and not decision.get("fallback") and not decision.get("trigger"):
+        from local_intent_model import registrar_ejemplo
+
+        registrar_ejemplo(usuario_id, perfil_id, _normalize(message).strip(), decision["skill"], decision["confidence"])
+    return decision
+
+
+def classify_by_ai(
+    message: str,
+    enabled_skills: list[str],
+    recent_messages: list,
+    usuario_id: int,
+) -> str:
+    """Solo el skill (sin triggers); ver classify_by_ai_structured."""
+    return classify_by_ai_structured(
+        message, usuario_id, enabled_skills=enabled_skills, recent_messages=recent_messages
+    )["skill"]
+
+
+def modo_clasificacion(usuario_id: int, perfil_id: int = None) -> str:
+    """"ai": una llamada de clasificación antes de la respuesta si hace falta.
+    "inline": ninguna; los triggers pendientes los decide la completion principal
+    con salida estructurada y el skill queda en free_chat (el conocimiento ya va
+    en el prefijo del prompt)."""
+    from database import get_config
+
+    modo = get_config("intent_classification_mode", "ai", usuario_id=usuario_id, perfil_id=perfil_id).lower()
+    return modo if modo in ("ai", "inline") else "ai"
 
 
 # ─── Main classifier ──────────────────────────────────────────────────────
@@ -325,7 +549,12 @@ def classify_intent(
     enabled_skills: list[str],
     usuario_id: int = 1,
 ) -> IntentResult:
-    """Main classifier — tries levels 1, 2, 3 in order.
+    """Main classifier — level 0, then levels 1, 2, 3.
+
+    Everything that needs an LLM (handoff triggers to verify/match and, without
+    a keyword match, the skill) is resolved in ONE structured call. In
+    "inline" mode (intent_classification_mode) there is no call at all: pending
+    triggers travel in IntentResult.triggers_pendientes for the main completion.
 
     Args:
         message: The incoming WhatsApp message text.
@@ -341,30 +570,62 @@ def classify_intent(
 
     perfil_id = context.get("perfil_id")
 
+    # Una sola pasada sobre el mensaje para los niveles 0 y 1
+    coincidencias = keywords_perfil(usuario_id, perfil_id).matcher.buscar(_normalize(message))
+
     # Level 0: Human mode triggers — HIGHEST PRIORITY
     # User-configured triggers always win over skills
-    human_result = classify_by_human_triggers(message, usuario_id, perfil_id=perfil_id)
-    if human_result:
+    human_result = evaluar_triggers_humanos(message, usuario_id, perfil_id=perfil_id, coincidencias=coincidencias)
+    if isinstance(human_result, IntentResult):
         return human_result
+    pendientes = human_result
 
     # Level 1: Keyword matching for enabled skills
-    result = classify_by_keywords(message, enabled_skills)
+    result = classify_by_keywords(message, enabled_skills, coincidencias)
+
+    # Level 1b: modelo local entrenado con decisiones previas de la IA
+    if result is None:
+        result = classify_by_local_model(message, enabled_skills, usuario_id, perfil_id)
 
     # Level 2: Funnel context — adds secondary intent
     funnel_intent = classify_by_funnel(context)
 
-    if result:
+    if modo_clasificacion(usuario_id, perfil_id) == "inline":
+        result = result or IntentResult(primary="free_chat", confidence="default")
         if funnel_intent:
             result.secondary = funnel_intent
+        result.triggers_pendientes = pendientes
         return result
 
-    # Level 3: Mini AI classifier (only when no keyword match)
-    recent_messages = context.get("recent_messages", [])
-    ai_skill = classify_by_ai(message, enabled_skills, recent_messages, usuario_id)
+    if result is not None and pendientes is None:
+        if funnel_intent:
+            result.secondary = funnel_intent
+        return result
 
-    return IntentResult(
-        primary=ai_skill,
-        secondary=funnel_intent,
-        confidence="ai" if ai_skill != "free_chat" else "default",
-        matched_keywords=[],
+    # Level 3: una sola llamada para triggers pendientes y/o skill
+    # (cacheada por mensaje normalizado para los mensajes cortos repetidos)
+    from intent_cache import huella_contexto
+
+    decision = _clasificar_con_cache(
+        message,
+        usuario_id,
+        perfil_id,
+        enabled_skills=None if result is not None else enabled_skills,
+        recent_messages=context.get("recent_messages", []),
+        pendientes=pendientes,
+        huella=huella_contexto(context),
     )
+    handoff = _handoff_por_ia(decision["trigger"])
+    if handoff:
+        return handoff
+
+    if result is None:
+        ai_skill = decision["skill"]
+        result = IntentResult(
+            primary=ai_skill,
+            confidence="ai" if ai_skill != "free_chat" else "default",
+            matched_keywords=[],
+        )
+    if funnel_intent:
+        result.secondary = funnel_intent
+    return result
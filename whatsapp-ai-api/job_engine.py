@@ -191,9 +191,49 @@ async def procesar_campana_masiva(job: BackgroundJob, db):
     )
 
 
+async def procesar_recalculo_leads(job: BackgroundJob, db):
+    """Recalcula lead_score y estado_lead de todos los contactos del perfil
+    con los pesos vigentes (lead_scoring_weights)."""
+    from lead_scoring import recalcular_leads_perfil
+
+    job.mensaje = "Recalculando lead scores..."
+    db.commit()
+
+    # Una sentencia SQL: en un thread para no frenar a los consumidores del worker
+    loop = asyncio.get_running_loop()
+    resultado = await loop.run_in_executor(None, recalcular_leads_perfil, db, job.usuario_id, job.perfil_id)
+
+    job.total = resultado["contactos"]
+    job.procesados = resultado["contactos"]
+    job.exitosos = resultado["cambios"]
+    job.mensaje = f"Completado: {resultado['contactos']} contactos, {resultado['cambios']} actualizados"
+
+
+async def procesar_entrenamiento_intenciones(job: BackgroundJob, db):
+    """Entrena el modelo local de intención del perfil con los ejemplos
+    guardados del clasificador IA (local_intent_model)."""
+    from local_intent_model import entrenar_perfil
+
+    job.mensaje = "Entrenando modelo de intención..."
+    db.commit()
+
+    loop = asyncio.get_running_loop()
+    resultado = await loop.run_in_executor(None, entrenar_perfil, db, job.usuario_id, job.perfil_id)
+
+    job.total = resultado["ejemplos"]
+    job.procesados = resultado["ejemplos"]
+    exactitud = resultado["exactitud"]
+    job.mensaje = (
+        f"Completado: {resultado['ejemplos']} ejemplos, "
+        f"exactitud {exactitud:.0%}" if exactitud is not None else f"Completado: {resultado['ejemplos']} ejemplos"
+    ) + ("" if resultado["activo"] else " (modelo inactivo)")
+
+
 # Registro de procesadores - usado por worker.py
 JOB_PROCESSORS: Dict[str, Callable] = {
     "verificar_contactos": procesar_verificacion_contactos,
     "sync_contactos": procesar_sync_contactos,
     "campana_masiva": procesar_campana_masiva,
+    "recalcular_leads": procesar_recalculo_leads,
+    "entrenar_intenciones": procesar_entrenamiento_intenciones,
 }
@@ -0,0 +1,73 @@
+"""
+Keyword Matcher - Búsqueda de muchas palabras clave en una sola pasada
+
+Antes cada mensaje normalizaba (NFKD) cada keyword y hacía un `in` por
+keyword: costo proporcional a la cantidad de keywords, y sin límites de
+palabra ("asesor" coincidía dentro de "asesoria").
+
+KeywordMatcher compila todas las keywords en UNA regex:
+
+    (?<!\\w)(?=(frase mas larga|frase|palabra)(?!\\w))
+
+El lookahead hace que coincidencias superpuestas ("quiero hablar con" y
+"hablar con alguien") se encuentren todas, como en Aho-Corasick, y la
+alternación ordenada por largo da la frase más larga en cada posición.
+Los espacios dentro de una frase aceptan cualquier cantidad de blancos.
+
+El matcher es genérico: cada keyword lleva una o más etiquetas arbitrarias
+(skill, categoría de trigger, ...) y una prioridad; quien lo construye
+decide qué significan.
+"""
+
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Hashable, Iterable, List, Tuple
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas y sin acentos ("Cómo ESTÁS" -> "como estas")."""
+    nfkd = unicodedata.normalize("NFKD", (texto or "").lower())
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+
+
+@dataclass(frozen=True)
+class Coincidencia:
+    keyword: str  # tal como se configuró
+    etiqueta: Hashable
+    prioridad: int
+    inicio: int  # posición en el texto normalizado
+
+
+class KeywordMatcher:
+    """Conjunto de keywords compilado; se construye una vez y se reusa."""
+
+    def __init__(self, entradas: Iterable[Tuple[str, Hashable, int]]):
+        """entradas: (keyword, etiqueta, prioridad). Menor prioridad gana."""
+        self._por_keyword: dict[str, List[Tuple[str, Hashable, int]]] = {}
+        for keyword, etiqueta, prioridad in entradas:
+            clave = " ".join(normalizar(keyword).split())
+            if clave:
+                self._por_keyword.setdefault(clave, []).append((keyword, etiqueta, prioridad))
+
+        self._regex = None
+        if self._por_keyword:
+            alternativas = sorted(self._por_keyword, key=lambda k: (-len(k), k))
+            cuerpo = "|".join(r"\s+".join(map(re.escape, k.split())) for k in alternativas)
+            self._regex = re.compile(rf"(?<!\w)(?=({cuerpo})(?!\w))")
+
+    def __len__(self) -> int:
+        return len(self._por_keyword)
+
+    def buscar(self, normalizado: str) -> List[Coincidencia]:
+        """Todas las coincidencias en `normalizado` (ya pasado por normalizar),
+        ordenadas por prioridad y luego por posición."""
+        if self._regex is None or not normalizado:
+            return []
+        encontradas = []
+        for m in self._regex.finditer(normalizado):
+            clave = " ".join(m.group(1).split())
+            for keyword, etiqueta, prioridad in self._por_keyword.get(clave, ()):
+                encontradas.append(Coincidencia(keyword, etiqueta, prioridad, m.start()))
+        encontradas.sort(key=lambda c: (c.prioridad, c.inicio))
+        return encontradas
@@ -6,6 +6,7 @@ import json
 import logging
 from sqlalchemy.orm import Session
 from models import DocumentoConocimiento
+from prompt_builder import invalidar_prefijo
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +63,7 @@ class KnowledgeService:
         db.add(doc)
         db.commit()
         db.refresh(doc)
+        invalidar_prefijo(usuario_id)
         return doc.to_dict()
 
     @staticmethod
@@ -79,6 +81,7 @@ class KnowledgeService:
         doc.sincronizado = False
         db.commit()
         db.refresh(doc)
+        invalidar_prefijo(usuario_id)
         return doc.to_dict()
 
     @staticmethod
@@ -92,6 +95,7 @@ class KnowledgeService:
             return False
         db.delete(doc)
         db.commit()
+        invalidar_prefijo(usuario_id)
         return True
 
     @staticmethod
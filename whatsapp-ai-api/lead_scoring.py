@@ -1,14 +1,40 @@
 """
 Lead Scoring Service - Calcula puntuacion automatica de leads
+
+El score sale del contacto ya cargado, sin recorrer la conversación:
+  - Contacto.mensajes_usuario: contador que MessageService incrementa al
+    insertar cada mensaje del usuario.
+  - Orden del paso del funnel: FunnelService.get_step_orders (cache por proceso).
+actualizar_lead calcula score y estado con una sola lectura del contacto y una
+sola escritura.
+
+Los pesos y umbrales son configurables por perfil (config `lead_scoring_weights`,
+JSON parcial sobre PESOS_DEFAULT). Al cambiarlos, recalcular_leads_perfil
+(job "recalcular_leads") rehace score y estado de todos los contactos del
+perfil con un solo UPDATE agregado en SQL; recalcular_leads es la versión por
+ORM para otros motores o para toda la base.
 """
 
 import json
 import logging
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-from models import Contacto, MensajeConversacion
+from database import get_config
+from models import Contacto, MensajeConversacion, commit_or_flush
 
 logger = logging.getLogger(__name__)
 
+PESOS_DEFAULT = {
+    "por_campo": 10,  # por dato capturado con valor
+    "max_campos": 40,
+    "por_mensaje": 2,  # por mensaje del usuario
+    "max_mensajes": 20,
+    "por_paso": 5,  # por orden del paso del funnel
+    "max_paso": 20,
+    "interesado_desde": 60,  # score minimo para "interesado"
+    "calificado_desde": 30,  # score minimo (+2 datos) para "calificado"
+}
+
 
 # Estados de lead en orden de avance
 LEAD_STATES = [
@@ -22,118 +48,313 @@ LEAD_STATES = [
 ]
 
 
-def calculate_lead_score(db: Session, telefono: str, usuario_id: int) -> int:
+def _datos_capturados(contacto: Contacto) -> dict:
+    try:
+        return json.loads(contacto.datos_capturados) if contacto.datos_capturados else {}
+    except (json.JSONDecodeError, TypeError):
+        return {}
+
+
+# Un campo capturado cuenta si tiene valor: no nulo y no vacío como texto (un
+# false o un 0 capturados son respuestas). Misma regla que el SQL del
+# recálculo masivo: json_each_text + btrim con estos mismos caracteres.
+_BLANCOS = " \t\n\r"
+
+
+def _tiene_valor(valor) -> bool:
+    return valor is not None and str(valor).strip(_BLANCOS) != ""
+
+
+def normalizar_pesos(valores) -> dict:
+    """PESOS_DEFAULT con los valores enteros >= 0 de `valores` encima."""
+    pesos = dict(PESOS_DEFAULT)
+    for clave, valor in (valores or {}).items():
+        if clave not in pesos:
+            continue
+        try:
+            pesos[clave] = max(0, int(valor))
+        except (TypeError, ValueError):
+            continue
+    return pesos
+
+
+def pesos_scoring(usuario_id: int, perfil_id: int = None) -> dict:
+    raw = get_config("lead_scoring_weights", "", usuario_id=usuario_id, perfil_id=perfil_id)
+    try:
+        return normalizar_pesos(json.loads(raw) if raw else {})
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return dict(PESOS_DEFAULT)
+
+
+def puntuar(contacto: Contacto, orden_paso: int = None, pesos: dict = None) -> int:
     """
-    Calcular lead score (0-100) basado en:
-    - Datos capturados: +10 por campo
-    - Mensajes intercambiados: +2 por mensaje (max 20 pts)
-    - Paso del funnel: +10 por paso avanzado
-    - Estado del lead: +5 por cada nivel
+    Calcular lead score (0-100) basado en (valores por defecto):
+    - Datos capturados: +10 por campo (max 40)
+    - Mensajes del usuario: +2 por mensaje (max 20)
+    - Paso del funnel: +5 por orden del paso (max 20)
     """
-    contacto = db.query(Contacto).filter(
+    pesos = pesos or PESOS_DEFAULT
+    datos = _datos_capturados(contacto)
+    campos_con_valor = sum(1 for v in datos.values() if _tiene_valor(v))
+
+    score = min(campos_con_valor * pesos["por_campo"], pesos["max_campos"])
+    score += min((contacto.mensajes_usuario or 0) * pesos["por_mensaje"], pesos["max_mensajes"])
+    if orden_paso is not None:
+        score += min(orden_paso * pesos["por_paso"], pesos["max_paso"])
+    return min(score, 100)
+
+
+def estado_siguiente(contacto: Contacto, score: int, pesos: dict = None) -> str:
+    """Estado automatico segun score y actividad; solo avanza, nunca retrocede."""
+    pesos = pesos or PESOS_DEFAULT
+    current_state = contacto.estado_lead or "nuevo"
+    if current_state in ("cerrado", "perdido"):
+        return current_state  # No cambiar estados finales automaticamente
+
+    datos = _datos_capturados(contacto)
+    new_state = current_state
+    if score >= pesos["interesado_desde"]:
+        new_state = "interesado"
+    elif score >= pesos["calificado_desde"] and len(datos) >= 2:
+        new_state = "calificado"
+    elif contacto.total_mensajes and contacto.total_mensajes > 0:
+        new_state = "contactado"
+
+    current_idx = LEAD_STATES.index(current_state) if current_state in LEAD_STATES else 0
+    new_idx = LEAD_STATES.index(new_state) if new_state in LEAD_STATES else 0
+    return new_state if new_idx > current_idx else current_state
+
+
+def _cargar_contacto(db: Session, telefono: str, usuario_id: int):
+    return db.query(Contacto).filter(
         Contacto.telefono == telefono,
         Contacto.usuario_id == usuario_id,
     ).first()
+
+
+def _orden_paso(db: Session, contacto: Contacto, ordenes: dict = None):
+    if not contacto.paso_funnel:
+        return None
+    if ordenes is None:
+        from funnel_service import FunnelService
+
+        ordenes = FunnelService.get_step_orders(db, contacto.usuario_id)
+    return ordenes.get(contacto.paso_funnel)
+
+
+def actualizar_lead(db: Session, telefono: str, usuario_id: int, contacto: Contacto = None) -> dict:
+    """Recalcular score y estado del contacto y guardarlos con una sola escritura.
+
+    Retorna {"lead_score", "estado_lead"} (score 0 / "nuevo" si no existe)."""
+    if contacto is None:
+        contacto = _cargar_contacto(db, telefono, usuario_id)
+    if not contacto:
+        return {"lead_score": 0, "estado_lead": "nuevo"}
+
+    pesos = pesos_scoring(contacto.usuario_id, contacto.perfil_id)
+    score = puntuar(contacto, _orden_paso(db, contacto), pesos)
+    estado = estado_siguiente(contacto, score, pesos)
+    if contacto.lead_score != score or contacto.estado_lead != estado:
+        contacto.lead_score = score
+        contacto.estado_lead = estado
+        commit_or_flush(db)
+    return {"lead_score": score, "estado_lead": estado}
+
+
+def calculate_lead_score(db: Session, telefono: str, usuario_id: int) -> int:
+    """Lead score actual del contacto (sin guardar)."""
+    contacto = _cargar_contacto(db, telefono, usuario_id)
     if not contacto:
         return 0
+    return puntuar(contacto, _orden_paso(db, contacto), pesos_scoring(usuario_id, contacto.perfil_id))
 
-    score = 0
 
-    # 1. Datos capturados (+10 cada uno, max 40)
-    try:
-        datos = (
-            json.loads(contacto.datos_capturados) if contacto.datos_capturados else {}
-        )
-    except (json.JSONDecodeError, TypeError):
-        datos = {}
+def update_lead_score(db: Session, telefono: str, usuario_id: int) -> int:
+    """Recalcular y guardar el lead score (y el estado, en la misma escritura)"""
+    return actualizar_lead(db, telefono, usuario_id)["lead_score"]
 
-    campos_con_valor = sum(1 for v in datos.values() if v and str(v).strip())
-    score += min(campos_con_valor * 10, 40)
 
-    # 2. Mensajes intercambiados (+2 cada uno, max 20)
-    msg_count = (
-        db.query(MensajeConversacion)
+def update_lead_state(db: Session, telefono: str, usuario_id: int) -> str:
+    """Actualizar estado del lead basado en actividad automatica"""
+    return actualizar_lead(db, telefono, usuario_id)["estado_lead"]
+
+
+def _conteo_mensajes_usuario(db: Session):
+    """Subquery correlacionada con Contacto: mensajes escritos por el contacto."""
+    from sqlalchemy import func
+
+    return (
+        db.query(func.count(MensajeConversacion.id))
         .filter(
-            MensajeConversacion.telefono == telefono,
-            MensajeConversacion.usuario_id == usuario_id,
+            MensajeConversacion.usuario_id == Contacto.usuario_id,
+            MensajeConversacion.telefono == Contacto.telefono,
             MensajeConversacion.rol == "user",
             MensajeConversacion.tipo_evento == None,
         )
-        .count()
+        .correlate(Contacto)
+        .scalar_subquery()
     )
-    score += min(msg_count * 2, 20)
 
-    # 3. Paso del funnel avanzado (+5 por paso, usa orden)
-    if contacto.paso_funnel:
-        from models import FunnelPaso
 
-        paso = (
-            db.query(FunnelPaso)
-            .filter(
-                FunnelPaso.nombre == contacto.paso_funnel,
-                FunnelPaso.usuario_id == usuario_id,
-            )
-            .first()
-        )
-        if paso:
-            score += min(paso.orden * 5, 20)
+def recontar_mensajes_usuario(db: Session, usuario_id: int, telefono: str = None) -> None:
+    """Recalcular Contacto.mensajes_usuario tras borrar mensajes (sin commit).
 
-    return min(score, 100)
+    Sin esto el siguiente actualizar_lead volvería a sumar los puntos de los
+    mensajes borrados."""
+    query = db.query(Contacto).filter(Contacto.usuario_id == usuario_id)
+    if telefono is not None:
+        query = query.filter(Contacto.telefono == telefono)
+    query.update({Contacto.mensajes_usuario: _conteo_mensajes_usuario(db)}, synchronize_session=False)
 
 
-def update_lead_score(db: Session, telefono: str, usuario_id: int) -> int:
-    """Recalcular y guardar el lead score"""
-    score = calculate_lead_score(db, telefono, usuario_id)
-    contacto = db.query(Contacto).filter(
-        Contacto.telefono == telefono,
-        Contacto.usuario_id == usuario_id,
-    ).first()
-    if contacto:
-        contacto.lead_score = score
-        db.commit()
-    return score
+def recalcular_leads(db: Session, usuario_id: int = None, lote: int = 500, perfil_id: int = None) -> dict:
+    """Recalcular en lote mensajes_usuario, lead_score y estado_lead.
 
+    Para cuando cambian las reglas de scoring o los contadores quedaron
+    desfasados (importaciones, borrados). Recorre los contactos por id en
+    lotes y hace commit por lote."""
+    from funnel_service import FunnelService
 
-def update_lead_state(db: Session, telefono: str, usuario_id: int) -> str:
-    """Actualizar estado del lead basado en actividad automatica"""
-    contacto = db.query(Contacto).filter(
-        Contacto.telefono == telefono,
-        Contacto.usuario_id == usuario_id,
-    ).first()
-    if not contacto:
-        return "nuevo"
+    query = db.query(Contacto)
+    if usuario_id is not None:
+        query = query.filter(Contacto.usuario_id == usuario_id)
+    if perfil_id is not None:
+        query = query.filter(Contacto.perfil_id == perfil_id)
+    query.update({Contacto.mensajes_usuario: _conteo_mensajes_usuario(db)}, synchronize_session=False)
+    db.commit()
 
-    current_state = contacto.estado_lead or "nuevo"
-    if current_state in ("cerrado", "perdido"):
-        return current_state  # No cambiar estados finales automaticamente
+    contactos = 0
+    cambios = 0
+    ultimo_id = 0
+    ordenes = {}
+    pesos = {}
+    while True:
+        q = db.query(Contacto).filter(Contacto.id > ultimo_id)
+        if usuario_id is not None:
+            q = q.filter(Contacto.usuario_id == usuario_id)
+        if perfil_id is not None:
+            q = q.filter(Contacto.perfil_id == perfil_id)
+        filas = q.order_by(Contacto.id).limit(lote).all()
+        if not filas:
+            break
+        ultimo_id = filas[-1].id
+        for contacto in filas:
+            if contacto.usuario_id not in ordenes:
+                ordenes[contacto.usuario_id] = FunnelService.get_step_orders(db, contacto.usuario_id)
+            llave = (contacto.usuario_id, contacto.perfil_id)
+            if llave not in pesos:
+                pesos[llave] = pesos_scoring(*llave)
+            score = puntuar(contacto, _orden_paso(db, contacto, ordenes[contacto.usuario_id]), pesos[llave])
+            estado = estado_siguiente(contacto, score, pesos[llave])
+            if contacto.lead_score != score or contacto.estado_lead != estado:
+                contacto.lead_score = score
+                contacto.estado_lead = estado
+                cambios += 1
+            contactos += 1
+        db.commit()
+        db.expunge_all()
 
-    # Determinar nuevo estado basado en score y actividad
-    score = contacto.lead_score or 0
-    try:
-        datos = (
-            json.loads(contacto.datos_capturados) if contacto.datos_capturados else {}
-        )
-    except (json.JSONDecodeError, TypeError):
-        datos = {}
+    logger.info(f"Leads recalculados: {contactos} contactos, {cambios} con cambios")
+    return {"contactos": contactos, "cambios": cambios}
 
-    new_state = current_state
 
-    if score >= 60:
-        new_state = "interesado"
-    elif score >= 30 and len(datos) >= 2:
-        new_state = "calificado"
-    elif contacto.total_mensajes and contacto.total_mensajes > 0:
-        new_state = "contactado"
+# ─── Recalculo set-based por perfil ──────────────────────────────────────
 
-    # Solo avanzar, nunca retroceder
-    current_idx = (
-        LEAD_STATES.index(current_state) if current_state in LEAD_STATES else 0
+_SQL_RECALCULO = text(
+    """
+    WITH conteos AS (
+        SELECT telefono, COUNT(*) AS n
+        FROM mensajes_conversacion
+        WHERE usuario_id = :uid AND rol = 'user' AND tipo_evento IS NULL
+        GROUP BY telefono
+    ),
+    pasos AS (
+        SELECT nombre, MIN(COALESCE(orden, 0)) AS orden
+        FROM funnel_pasos
+        WHERE usuario_id = :uid
+        GROUP BY nombre
+    ),
+    base AS (
+        SELECT c.id,
+               COALESCE(m.n, 0) AS mensajes,
+               d.llaves,
+               d.con_valor,
+               p.orden,
+               COALESCE(c.estado_lead, 'nuevo') AS estado,
+               COALESCE(c.total_mensajes, 0) AS total
+        FROM contactos c
+        LEFT JOIN conteos m ON m.telefono = c.telefono
+        LEFT JOIN pasos p ON p.nombre = c.paso_funnel
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS llaves,
+                   COUNT(*) FILTER (WHERE btrim(e.value, E' \\t\\n\\r') <> '') AS con_valor
+            FROM json_each_text(
+                CASE WHEN left(c.datos_capturados, 1) = '{' THEN CAST(c.datos_capturados AS json)
+                     ELSE CAST('{}' AS json) END
+            ) e
+        ) d
+        WHERE c.usuario_id = :uid AND c.perfil_id = :pid
+    ),
+    puntaje AS (
+        SELECT id, mensajes, llaves, estado, total,
+               LEAST(100,
+                     LEAST(con_valor * :por_campo, :max_campos)
+                     + LEAST(mensajes * :por_mensaje, :max_mensajes)
+                     + COALESCE(LEAST(orden * :por_paso, :max_paso), 0)) AS score
+        FROM base
+    ),
+    candidatos AS (
+        SELECT id, mensajes, score, estado,
+               CASE WHEN estado IN ('cerrado', 'perdido') THEN estado
+                    WHEN score >= :interesado_desde THEN 'interesado'
+                    WHEN score >= :calificado_desde AND llaves >= 2 THEN 'calificado'
+                    WHEN total > 0 THEN 'contactado'
+                    ELSE estado END AS candidato
+        FROM puntaje
+    ),
+    finales AS (
+        SELECT id, mensajes, score,
+               CASE WHEN COALESCE(array_position(CAST(:estados AS text[]), candidato), 1)
+                         > COALESCE(array_position(CAST(:estados AS text[]), estado), 1)
+                    THEN candidato ELSE estado END AS estado
+        FROM candidatos
     )
-    new_idx = LEAD_STATES.index(new_state) if new_state in LEAD_STATES else 0
+    UPDATE contactos c
+    SET mensajes_usuario = f.mensajes,
+        lead_score = f.score,
+        estado_lead = f.estado
+    FROM finales f
+    WHERE c.id = f.id
+      AND (c.mensajes_usuario IS DISTINCT FROM f.mensajes
+           OR c.lead_score IS DISTINCT FROM f.score
+           OR c.estado_lead IS DISTINCT FROM f.estado)
+    """
+)
 
-    if new_idx > current_idx:
-        contacto.estado_lead = new_state
-        db.commit()
-        return new_state
 
-    return current_state
+def recalcular_leads_perfil(db: Session, usuario_id: int, perfil_id: int) -> dict:
+    """Recalcular contador, score y estado de todos los contactos del perfil
+    con los pesos vigentes: una sola sentencia agregada (conteo de mensajes,
+    orden de pasos y datos capturados en SQL), sin cargar contactos.
+
+    Fuera de Postgres, o si la sentencia falla (p. ej. un datos_capturados con
+    JSON inválido), cae a recalcular_leads por ORM."""
+    from database import invalidate_config_cache
+
+    # Corre en el worker: leer los pesos recién guardados, no los de su cache
+    invalidate_config_cache("lead_scoring_weights")
+    total = db.query(Contacto).filter(Contacto.usuario_id == usuario_id, Contacto.perfil_id == perfil_id).count()
+    if db.get_bind().dialect.name == "postgresql":
+        try:
+            resultado = db.execute(
+                _SQL_RECALCULO,
+                {"uid": usuario_id, "pid": perfil_id, "estados": LEAD_STATES, **pesos_scoring(usuario_id, perfil_id)},
+            )
+            db.commit()
+            cambios = resultado.rowcount
+            logger.info(f"Leads recalculados (SQL) usuario {usuario_id} perfil {perfil_id}: {total} contactos, {cambios} con cambios")
+            return {"contactos": total, "cambios": cambios}
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Recalculo SQL de leads fallo, usando ORM: {e}")
+    return recalcular_leads(db, usuario_id=usuario_id, perfil_id=perfil_id)
@@ -0,0 +1,352 @@
+"""
+LLM Resilience - Deadlines, hedging, circuit breaker y modelo de respaldo
+
+Todas las completions pasan por aquí (`completar` síncrono, `completar_async`
+en el event loop). Antes, con OpenAI lento, cada llamada esperaba el timeout
+del SDK (60 s + reintentos) y recién entonces el agente pedía disculpas.
+
+  - Deadline por sitio (SITIOS, override con LLM_DEADLINE_<SITIO>): tiempo
+    total de la llamada, reintentos y respaldo incluidos. El SDK no reintenta
+    por su cuenta (max_retries=0): los reintentos los decide esta capa.
+  - Hedging (solo async, sin stream): si la primera petición no respondió
+    tras el p95 reciente del sitio, se lanza una segunda idéntica y gana la
+    primera que termine; la otra se cancela.
+  - Circuit breaker por (API key, modelo): tras LLM_BREAKER_FALLOS errores
+    seguidos (timeouts, 5xx, rate limit, conexión) el modelo se saltea
+    LLM_BREAKER_SEGUNDOS; luego se deja pasar una petición de prueba.
+  - Modelo de respaldo (config `fallback_model`, default LLM_FALLBACK_MODEL):
+    se usa cuando el principal falla o tiene el circuito abierto.
+
+Los errores del request (400, auth) no cuentan como fallas del proveedor: se
+propagan sin reintentar. Si nada responde a tiempo se lanza LLMNoDisponible.
+
+Cada respuesta se anota en llm_usage (tokens, modelo, latencia, sitio) para
+el tenant (usuario_id, perfil_id). Con stream=True el `usage` llega en el
+último chunk: lo anota quien consume el stream. La petición duplicada de un
+hedge también se factura: se anota como sitio "<sitio>_hedge" con los prompt
+tokens de la ganadora (mismo prompt) y 0 de completion (no se conocen).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import openai
+
+from metrics import Contador
+
+logger = logging.getLogger(__name__)
+
+# Deadline total por sitio de llamada (segundos)
+SITIOS: Dict[str, float] = {
+    "respuesta": 25.0,
+    "clasificador": 4.0,
+    "resumen": 30.0,
+    "mejorar_prompt": 30.0,
+    "mejorar_mensaje": 20.0,
+    "setup_chat": 45.0,
+}
+DEADLINE_DEFAULT = 30.0
+
+LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "0.5"))
+LLM_HEDGE_MUESTRAS = 20  # muestras mínimas antes de confiar en el p95
+LLM_BREAKER_FALLOS = int(os.getenv("LLM_BREAKER_FALLOS", "5"))
+LLM_BREAKER_SEGUNDOS = float(os.getenv("LLM_BREAKER_SEGUNDOS", "30"))
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gpt-4o-mini")
+# Tiempo mínimo que tiene que quedar para intentar con el respaldo
+_MINIMO_INTENTO = 1.0
+
+LLM_LLAMADAS = Contador(
+    "wtx_llm_calls_total",
+    "Llamadas al LLM por sitio y resultado",
+    ("sitio", "resultado"),
+)
+
+# Errores del proveedor (no del request): cuentan para el breaker y pasan al respaldo
+_ERRORES_PROVEEDOR = (
+    asyncio.TimeoutError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class LLMNoDisponible(Exception):
+    """Ningún modelo respondió dentro del deadline del sitio."""
+
+
+def deadline(sitio: str) -> float:
+    valor = os.getenv(f"LLM_DEADLINE_{sitio.upper()}")
+    try:
+        return float(valor) if valor else SITIOS.get(sitio, DEADLINE_DEFAULT)
+    except ValueError:
+        return SITIOS.get(sitio, DEADLINE_DEFAULT)
+
+
+# ─── Latencias por sitio (p95 para el hedging) ──────────────────────────
+
+_latencias: Dict[str, deque] = {}
+_lock = threading.Lock()
+
+
+def _registrar_latencia(sitio: str, segundos: float) -> None:
+    with _lock:
+        _latencias.setdefault(sitio, deque(maxlen=200)).append(segundos)
+
+
+def p95(sitio: str) -> Optional[float]:
+    with _lock:
+        muestras = sorted(_latencias.get(sitio, ()))
+    if len(muestras) < LLM_HEDGE_MUESTRAS:
+        return None
+    return muestras[int(len(muestras) * 0.95) - 1]
+
+
+def _espera_hedge(sitio: str, limite: float) -> float:
+    """Cuánto esperar antes de la segunda petición (nunca más de medio deadline)."""
+    base = p95(sitio) or limite / 2
+    return min(max(base, LLM_HEDGE_MIN_SECONDS), limite / 2)
+
+
+# ─── Circuit breaker por (API key, modelo) ──────────────────────────────
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self.probando = False
+
+    def permite(self) -> bool:
+        with _lock:
+            if self.fallos < LLM_BREAKER_FALLOS:
+                return True
+            if time.monotonic() < self.abierto_hasta or self.probando:
+                return False
+            self.probando = True  # medio abierto: una petición de prueba
+            return True
+
+    def exito(self) -> None:
+        with _lock:
+            self.fallos = 0
+            self.probando = False
+
+    def liberar(self) -> None:
+        """La petición terminó sin decir nada del proveedor (request inválido, cancelación)."""
+        with _lock:
+            self.probando = False
+
+    def fallo(self) -> None:
+        with _lock:
+            self.fallos += 1
+            self.probando = False
+            if self.fallos >= LLM_BREAKER_FALLOS:
+                self.abierto_hasta = time.monotonic() + LLM_BREAKER_SEGUNDOS
+
+
+_breakers: Dict[tuple, CircuitBreaker] = {}
+
+
+def _breaker(api_key: str, modelo: str) -> CircuitBreaker:
+    # La key no se guarda en claro
+    clave = (hashlib.sha256(api_key.encode()).hexdigest()[:16], modelo)
+    with _lock:
+        breaker = _breakers.get(clave)
+        if breaker is None:
+            breaker = _breakers[clave] = CircuitBreaker()
+    return breaker
+
+
+# ─── Llamadas ───────────────────────────────────────────────────────────
+
+
+def _resolver_key(usuario_id: Optional[int], api_key: Optional[str]) -> str:
+    if api_key:
+        return api_key
+    from agent import _get_api_key
+
+    return _get_api_key(usuario_id)
+
+
+def _modelos(params: dict, usuario_id: Optional[int], fallback_model: Optional[str]) -> list:
+    principal = params.get("model", "gpt-4o-mini")
+    if fallback_model is None:
+        from database import get_config
+
+        fallback_model = get_config("fallback_model", LLM_FALLBACK_MODEL, usuario_id=usuario_id)
+    return [principal] + ([fallback_model] if fallback_model and fallback_model != principal else [])
+
+
+def _anotar_uso(sitio, modelo, respuesta, segundos, usuario_id, perfil_id, params) -> None:
+    if params.get("stream"):
+        return
+    try:
+        from llm_usage import registrar
+
+        registrar(sitio, getattr(respuesta, "model", None) or modelo, getattr(respuesta, "usage", None),
+                  segundos, usuario_id=usuario_id, perfil_id=perfil_id)
+    except Exception as e:
+        logger.debug(f"No se pudo anotar uso del LLM: {e}")
+
+
+def _anotar_hedge(sitio, modelo, respuesta, segundos, duplicadas, usuario_id, perfil_id) -> None:
+    from types import SimpleNamespace
+
+    usage = getattr(respuesta, "usage", None)
+    if usage is None:
+        return
+    descartada = SimpleNamespace(
+        prompt_tokens=getattr(usage, "prompt_tokens", 0),
+        completion_tokens=0,
+        prompt_tokens_details=getattr(usage, "prompt_tokens_details", None),
+    )
+    try:
+        from llm_usage import registrar
+
+        for _ in range(duplicadas):
+            registrar(f"{sitio}_hedge", getattr(respuesta, "model", None) or modelo, descartada,
+                      segundos, usuario_id=usuario_id, perfil_id=perfil_id)
+    except Exception as e:
+        logger.debug(f"No se pudo anotar uso del hedge: {e}")
+
+
+def completar(
+    sitio: str, usuario_id: int = None, api_key: str = None, fallback_model: str = None,
+    perfil_id: int = None, **params
+):
+    """chat.completions.create con deadline, breaker y respaldo (cliente síncrono)."""
+    from openai_clients import obtener_cliente
+
+    api_key = _resolver_key(usuario_id, api_key)
+    cliente = obtener_cliente(api_key)
+    fin = time.monotonic() + deadline(sitio)
+    ultimo_error = None
+
+    for i, modelo in enumerate(_modelos(params, usuario_id, fallback_model)):
+        restante = fin - time.monotonic()
+        if i and restante < _MINIMO_INTENTO:
+            break
+        breaker = _breaker(api_key, modelo)
+        if not breaker.permite():
+            LLM_LLAMADAS.inc(sitio=sitio, resultado="circuito_abierto")
+            continue
+        inicio = time.monotonic()
+        try:
+            respuesta = cliente.with_options(timeout=restante, max_retries=0).chat.completions.create(
+                **{**params, "model": modelo}
+            )
+        except _ERRORES_PROVEEDOR as e:
+            breaker.fallo()
+            ultimo_error = e
+            LLM_LLAMADAS.inc(sitio=sitio, resultado="error")
+            logger.warning(f"LLM {sitio}/{modelo} falló ({type(e).__name__}), siguiente opción")
+            continue
+        except BaseException:
+            breaker.liberar()
+            raise
+        breaker.exito()
+        segundos = time.monotonic() - inicio
+        if i == 0:
+            _registrar_latencia(sitio, segundos)
+        _anotar_uso(sitio, modelo, respuesta, segundos, usuario_id, perfil_id, params)
+        LLM_LLAMADAS.inc(sitio=sitio, resultado="ok" if i == 0 else "fallback")
+        return respuesta
+
+    raise LLMNoDisponible(f"LLM no disponible para {sitio}: {ultimo_error or 'circuito abierto'}")
+
+
+async def _con_hedge(cliente, sitio: str, params: dict, limite: float, hedge: bool):
+    """Una petición; si tarda más que el p95 del sitio, una segunda en paralelo.
+
+    Retorna (respuesta, duplicadas): cuántas otras peticiones se enviaron y no
+    fallaron (se cancelan o ya terminaron, pero se facturan igual)."""
+    primera = asyncio.ensure_future(cliente.chat.completions.create(**params))
+    tareas = {primera}
+    try:
+        if hedge:
+            espera = _espera_hedge(sitio, limite)
+            hechas, _ = await asyncio.wait(tareas, timeout=espera)
+            if not hechas:
+                LLM_LLAMADAS.inc(sitio=sitio, resultado="hedge")
+                tareas.add(asyncio.ensure_future(cliente.chat.completions.create(**params)))
+                limite -= espera
+
+        fin = time.monotonic() + limite
+        ultimo_error = None
+        while tareas:
+            hechas, tareas = await asyncio.wait(
+                tareas, timeout=max(0.0, fin - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not hechas:
+                raise asyncio.TimeoutError()
+            for tarea in hechas:
+                if tarea.exception() is None:
+                    otras = sum(1 for t in hechas if t is not tarea and t.exception() is None)
+                    return tarea.result(), otras + len(tareas)
+                ultimo_error = tarea.exception()
+        raise ultimo_error
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+
+
+async def completar_async(
+    sitio: str, usuario_id: int = None, api_key: str = None, fallback_model: str = None,
+    perfil_id: int = None, **params
+):
+    """chat.completions.create con deadline, hedging, breaker y respaldo (AsyncOpenAI).
+
+    Con stream=True el deadline cubre hasta recibir la respuesta (no el
+    consumo del stream) y no hay hedging."""
+    from openai_clients import obtener_cliente_async
+
+    api_key = _resolver_key(usuario_id, api_key)
+    cliente = obtener_cliente_async(api_key)
+    fin = time.monotonic() + deadline(sitio)
+    hedge = LLM_HEDGING and not params.get("stream")
+    ultimo_error = None
+
+    for i, modelo in enumerate(_modelos(params, usuario_id, fallback_model)):
+        restante = fin - time.monotonic()
+        if i and restante < _MINIMO_INTENTO:
+            break
+        breaker = _breaker(api_key, modelo)
+        if not breaker.permite():
+            LLM_LLAMADAS.inc(sitio=sitio, resultado="circuito_abierto")
+            continue
+        inicio = time.monotonic()
+        try:
+            respuesta, duplicadas = await _con_hedge(
+                cliente.with_options(timeout=restante, max_retries=0),
+                sitio,
+                {**params, "model": modelo},
+                restante,
+                hedge,
+            )
+        except _ERRORES_PROVEEDOR as e:
+            breaker.fallo()
+            ultimo_error = e
+            LLM_LLAMADAS.inc(sitio=sitio, resultado="error")
+            logger.warning(f"LLM {sitio}/{modelo} falló ({type(e).__name__}), siguiente opción")
+            continue
+        except BaseException:
+            breaker.liberar()
+            raise
+        breaker.exito()
+        segundos = time.monotonic() - inicio
+        if i == 0:
+            _registrar_latencia(sitio, segundos)
+        _anotar_uso(sitio, modelo, respuesta, segundos, usuario_id, perfil_id, params)
+        if duplicadas:
+            _anotar_hedge(sitio, modelo, respuesta, segundos, duplicadas, usuario_id, perfil_id)
+        LLM_LLAMADAS.inc(sitio=sitio, resultado="ok" if i == 0 else "fallback")
+        return respuesta
+
+    raise LLMNoDisponible(f"LLM no disponible para {sitio}: {ultimo_error or 'circuito abierto'}")
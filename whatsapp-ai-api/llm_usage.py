@@ -0,0 +1,181 @@
+"""
+LLM Usage - Libro de uso del LLM por tenant (tokens, modelo, latencia, sitio)
+
+Cada llamada que pasa por llm_resilience se anota con `registrar` (el sitio,
+el modelo que respondió y el `usage` de OpenAI: prompt, completion y tokens
+cacheados). Las anotaciones van a una cola en memoria y un thread daemon las
+escribe en lotes (UsoLLM) cada LLM_USAGE_FLUSH_SECONDS o al juntar
+LLM_USAGE_LOTE: el turno nunca espera un INSERT.
+
+El worker agrega el libro por día (`rollup_dia` -> UsoLLMDiario, recalculando
+el día completo, así que es idempotente) y borra las filas crudas más viejas
+que LLM_USAGE_RETENCION_DIAS. El dashboard lee solo el rollup.
+
+Además se exporta wtx_llm_tokens_total{sitio, tipo, usuario_id}.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from metrics import Contador
+
+logger = logging.getLogger(__name__)
+
+LLM_USAGE_LOTE = int(os.getenv("LLM_USAGE_LOTE", "200"))
+LLM_USAGE_FLUSH_SECONDS = float(os.getenv("LLM_USAGE_FLUSH_SECONDS", "5"))
+LLM_USAGE_RETENCION_DIAS = int(os.getenv("LLM_USAGE_RETENCION_DIAS", "30"))
+# Tope de la cola si la DB no responde: se descartan las más viejas
+_MAX_PENDIENTES = 10000
+
+LLM_TOKENS = Contador(
+    "wtx_llm_tokens_total",
+    "Tokens consumidos en llamadas al LLM por sitio y tipo",
+    ("sitio", "tipo", "usuario_id"),
+)
+
+_pendientes: deque = deque(maxlen=_MAX_PENDIENTES)
+_hay_lote = threading.Event()
+_hilo: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+
+def _tokens_cacheados(usage) -> int:
+    detalles = getattr(usage, "prompt_tokens_details", None)
+    return int(getattr(detalles, "cached_tokens", 0) or 0) if detalles is not None else 0
+
+
+def registrar(
+    sitio: str,
+    modelo: str,
+    usage,
+    latencia_s: float,
+    usuario_id: Optional[int] = None,
+    perfil_id: Optional[int] = None,
+) -> None:
+    """Anotar una llamada (no bloquea: la escritura es en lote desde otro thread)."""
+    prompt = int(getattr(usage, "prompt_tokens", 0) or 0) if usage is not None else 0
+    completion = int(getattr(usage, "completion_tokens", 0) or 0) if usage is not None else 0
+    cacheados = _tokens_cacheados(usage) if usage is not None else 0
+
+    uid = usuario_id if usuario_id is not None else ""
+    LLM_TOKENS.inc(prompt, sitio=sitio, tipo="prompt", usuario_id=uid)
+    LLM_TOKENS.inc(completion, sitio=sitio, tipo="completion", usuario_id=uid)
+    if cacheados:
+        LLM_TOKENS.inc(cacheados, sitio=sitio, tipo="cached", usuario_id=uid)
+
+    _pendientes.append({
+        "usuario_id": usuario_id,
+        "perfil_id": perfil_id,
+        "sitio": sitio[:30],
+        "modelo": (modelo or "")[:50],
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cached_tokens": cacheados,
+        "latencia_ms": int(latencia_s * 1000),
+        "created_at": datetime.utcnow(),
+    })
+    _asegurar_hilo()
+    if len(_pendientes) >= LLM_USAGE_LOTE:
+        _hay_lote.set()
+
+
+def _asegurar_hilo() -> None:
+    global _hilo
+    if _hilo is not None and _hilo.is_alive():
+        return
+    with _lock:
+        if _hilo is None or not _hilo.is_alive():
+            _hilo = threading.Thread(target=_bucle_escritura, name="llm-usage", daemon=True)
+            _hilo.start()
+
+
+def _bucle_escritura() -> None:
+    while True:
+        _hay_lote.wait(LLM_USAGE_FLUSH_SECONDS)
+        _hay_lote.clear()
+        try:
+            vaciar()
+        except Exception as e:
+            logger.error(f"Error guardando uso del LLM: {e}")
+            time.sleep(LLM_USAGE_FLUSH_SECONDS)
+
+
+def vaciar() -> int:
+    """Escribir lo pendiente ahora. Retorna cuántas filas se guardaron."""
+    lote = []
+    while _pendientes and len(lote) < LLM_USAGE_LOTE * 5:
+        lote.append(_pendientes.popleft())
+    if not lote:
+        return 0
+
+    from models import SessionLocal, UsoLLM
+
+    db = SessionLocal()
+    try:
+        db.bulk_insert_mappings(UsoLLM, lote)
+        db.commit()
+    except Exception:
+        db.rollback()
+        # Devolverlas a la cola para el próximo intento
+        _pendientes.extendleft(reversed(lote))
+        raise
+    finally:
+        db.close()
+    return len(lote)
+
+
+@atexit.register
+def _vaciar_al_salir() -> None:
+    try:
+        vaciar()
+    except Exception:
+        pass
+
+
+# ─── Rollup diario (worker) ─────────────────────────────────────────────
+
+_SQL_ROLLUP = """
+    INSERT INTO usos_llm_diarios (
+        fecha, usuario_id, perfil_id, sitio, modelo, llamadas,
+        prompt_tokens, completion_tokens, cached_tokens, latencia_ms_total, latencia_ms_max
+    )
+    SELECT
+        :fecha, usuario_id, perfil_id, sitio, modelo, COUNT(*),
+        COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+        COALESCE(SUM(cached_tokens), 0), COALESCE(SUM(latencia_ms), 0), COALESCE(MAX(latencia_ms), 0)
+    FROM usos_llm
+    WHERE created_at >= :desde AND created_at < :hasta
+    GROUP BY usuario_id, perfil_id, sitio, modelo
+"""
+
+
+def rollup_dia(db, fecha: date) -> int:
+    """Recalcular el rollup de `fecha` (UTC) desde el libro. Idempotente."""
+    from sqlalchemy import text
+    from models import UsoLLMDiario
+
+    desde = datetime.combine(fecha, datetime.min.time())
+    db.query(UsoLLMDiario).filter(UsoLLMDiario.fecha == fecha).delete(synchronize_session=False)
+    resultado = db.execute(text(_SQL_ROLLUP), {"fecha": fecha, "desde": desde, "hasta": desde + timedelta(days=1)})
+    db.commit()
+    return resultado.rowcount or 0
+
+
+def rollup_reciente(db) -> dict:
+    """Rollup de los últimos días + limpieza del libro (lo corre el worker cada
+    hora; con varios días se cubre un worker caído un rato)."""
+    from models import UsoLLM
+
+    hoy = datetime.utcnow().date()
+    filas = {str(dia): rollup_dia(db, dia) for dia in (hoy - timedelta(days=d) for d in range(2, -1, -1))}
+
+    limite = datetime.combine(hoy - timedelta(days=LLM_USAGE_RETENCION_DIAS), datetime.min.time())
+    borradas = db.query(UsoLLM).filter(UsoLLM.created_at < limite).delete(synchronize_session=False)
+    db.commit()
+    return {"rollup": filas, "borradas": borradas}
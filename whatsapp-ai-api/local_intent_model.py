@@ -0,0 +1,359 @@
+"""
+Local Intent Model - Clasificador de intención entrenado con las decisiones de la IA
+
+Cada decisión del mini clasificador IA (nivel 3 de intent_classifier) se
+guarda como ejemplo (EjemploIntencion: mensaje normalizado -> skill). Cuando
+un perfil junta suficientes ejemplos nuevos se encola un job que entrena un
+modelo local y lo guarda en ModeloIntencion. intent_classifier lo consulta
+entre las keywords y la IA: si predice con probabilidad >= umbral responde
+local (microsegundos) y solo lo dudoso sigue yendo a OpenAI.
+
+El modelo es Naive Bayes multinomial sobre palabras + n-gramas de caracteres
+(3 y 4, tolera typos y variantes: "holaa", "grax"), en Python puro: con los
+volúmenes por perfil (miles de mensajes cortos) no hace falta NumPy ni
+scikit-learn, y se serializa a JSON. Antes de activarlo se mide la exactitud
+sobre una parte de los ejemplos que no se usa para entrenar; si no alcanza
+INTENT_MODEL_MIN_EXACTITUD el perfil sigue usando solo la IA.
+
+Config por perfil:
+  local_intent_model      "true"/"false" (default "true")
+  local_intent_threshold  probabilidad mínima para responder local (0.9)
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INTENT_MODEL_MIN_EJEMPLOS = int(os.getenv("INTENT_MODEL_MIN_EJEMPLOS", "60"))
+INTENT_MODEL_MIN_POR_SKILL = int(os.getenv("INTENT_MODEL_MIN_POR_SKILL", "5"))
+INTENT_MODEL_MIN_EXACTITUD = float(os.getenv("INTENT_MODEL_MIN_EXACTITUD", "0.85"))
+INTENT_MODEL_MAX_EJEMPLOS = int(os.getenv("INTENT_MODEL_MAX_EJEMPLOS", "5000"))
+# Ejemplos nuevos desde el último entrenamiento para reentrenar
+INTENT_MODEL_REENTRENAR_CADA = int(os.getenv("INTENT_MODEL_REENTRENAR_CADA", "200"))
+# Solo se aprende de decisiones de la IA con al menos esta confianza
+INTENT_MODEL_MIN_CONFIANZA = float(os.getenv("INTENT_MODEL_MIN_CONFIANZA", "0.7"))
+UMBRAL_DEFAULT = 0.9
+
+_ALPHA = 0.5  # suavizado de Laplace
+_MODELOS_TTL = 300
+_LOTE_EJEMPLOS = 25
+_LOTE_MAX_SEGUNDOS = 30
+_PALABRA = re.compile(r"\w+")
+
+
+# ─── Modelo (sin DB) ────────────────────────────────────────────────────
+
+
+def caracteristicas(normalizado: str) -> Counter:
+    """Palabras y n-gramas de caracteres (3 y 4) de un texto ya normalizado."""
+    feats = Counter()
+    for palabra in _PALABRA.findall(normalizado):
+        feats["w:" + palabra] += 1
+        marcada = f" {palabra} "
+        for n in (3, 4):
+            for i in range(len(marcada) - n + 1):
+                feats["c:" + marcada[i:i + n]] += 1
+    return feats
+
+
+class ClasificadorNB:
+    """Naive Bayes multinomial serializable a JSON."""
+
+    def __init__(self, docs: Dict[str, int] = None, conteos: Dict[str, Dict[str, int]] = None, alpha: float = _ALPHA):
+        self.docs = dict(docs or {})
+        self.conteos = {clase: dict(c) for clase, c in (conteos or {}).items()}
+        self.alpha = alpha
+        self._preparar()
+
+    def _preparar(self) -> None:
+        self.vocabulario = set()
+        for c in self.conteos.values():
+            self.vocabulario.update(c)
+        total_docs = sum(self.docs.values()) or 1
+        v = len(self.vocabulario) or 1
+        self._log_prior = {clase: math.log(n / total_docs) for clase, n in self.docs.items() if n}
+        self._log_denominador = {
+            clase: math.log(sum(self.conteos.get(clase, {}).values()) + self.alpha * v)
+            for clase in self._log_prior
+        }
+
+    @classmethod
+    def entrenar(cls, ejemplos: Iterable[Tuple[str, str]], alpha: float = _ALPHA) -> "ClasificadorNB":
+        docs = Counter()
+        conteos: Dict[str, Counter] = defaultdict(Counter)
+        for texto, clase in ejemplos:
+            docs[clase] += 1
+            conteos[clase].update(caracteristicas(texto))
+        return cls(docs, conteos, alpha)
+
+    @property
+    def clases(self) -> List[str]:
+        return list(self._log_prior)
+
+    def predecir(self, normalizado: str) -> Optional[Tuple[str, float]]:
+        """(clase, probabilidad) o None si el texto no tiene nada conocido."""
+        feats = {f: n for f, n in caracteristicas(normalizado).items() if f in self.vocabulario}
+        if not feats or not self._log_prior:
+            return None
+        puntajes = {}
+        for clase, log_prior in self._log_prior.items():
+            conteos = self.conteos.get(clase, {})
+            denominador = self._log_denominador[clase]
+            puntajes[clase] = log_prior + sum(
+                n * (math.log(conteos.get(f, 0) + self.alpha) - denominador) for f, n in feats.items()
+            )
+        mejor = max(puntajes, key=puntajes.get)
+        maximo = puntajes[mejor]
+        total = sum(math.exp(p - maximo) for p in puntajes.values())
+        return mejor, 1.0 / total
+
+    def to_json(self) -> str:
+        return json.dumps({"alpha": self.alpha, "docs": self.docs, "conteos": self.conteos}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, crudo: str) -> "ClasificadorNB":
+        data = json.loads(crudo)
+        return cls(data.get("docs"), data.get("conteos"), data.get("alpha", _ALPHA))
+
+
+def evaluar(ejemplos: List[Tuple[str, str]], cada: int = 5) -> Optional[float]:
+    """Exactitud entrenando sin 1 de cada `cada` ejemplos y prediciendo esos.
+
+    Los pares (mensaje, skill) repetidos se cuentan una vez: las decisiones
+    logueadas se repiten mucho ("hola", "gracias") y, si no, el mismo ejemplo
+    quedaría en prueba y en entrenamiento e inflaría la exactitud."""
+    ejemplos = list(dict.fromkeys(ejemplos))
+    prueba = ejemplos[::cada]
+    if not prueba:
+        return None
+    entrenamiento = [e for i, e in enumerate(ejemplos) if i % cada]
+    modelo = ClasificadorNB.entrenar(entrenamiento)
+    aciertos = 0
+    for texto, clase in prueba:
+        prediccion = modelo.predecir(texto)
+        aciertos += bool(prediccion and prediccion[0] == clase)
+    return aciertos / len(prueba)
+
+
+# ─── Ejemplos: registro en lote ─────────────────────────────────────────
+
+_pendientes: list = []
+_pendientes_desde = 0.0
+_lock = threading.Lock()
+
+
+def registrar_ejemplo(usuario_id: int, perfil_id: Optional[int], normalizado: str, skill: str, confianza: float) -> None:
+    """Guardar una decisión de la IA como ejemplo (en lotes, sin bloquear el turno
+    con un INSERT por mensaje)."""
+    global _pendientes_desde
+    if not normalizado or confianza < INTENT_MODEL_MIN_CONFIANZA:
+        return
+    with _lock:
+        if not _pendientes:
+            _pendientes_desde = time.monotonic()
+        _pendientes.append({
+            "usuario_id": usuario_id,
+            "perfil_id": perfil_id,
+            "mensaje": normalizado[:300],
+            "skill": skill,
+            "confianza": confianza,
+        })
+        if len(_pendientes) < _LOTE_EJEMPLOS and time.monotonic() - _pendientes_desde < _LOTE_MAX_SEGUNDOS:
+            return
+        lote = list(_pendientes)
+        _pendientes.clear()
+    try:
+        _guardar_lote(lote)
+    except Exception as e:
+        logger.error(f"Error guardando ejemplos de intención: {e}")
+
+
+def _guardar_lote(lote: list) -> None:
+    from models import EjemploIntencion, SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.bulk_insert_mappings(EjemploIntencion, lote)
+        db.commit()
+        for usuario_id, perfil_id in {(e["usuario_id"], e["perfil_id"]) for e in lote}:
+            if _ejemplos_nuevos(db, usuario_id, perfil_id) >= INTENT_MODEL_REENTRENAR_CADA:
+                encolar_entrenamiento(db, usuario_id, perfil_id)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _ejemplos_nuevos(db, usuario_id: int, perfil_id: Optional[int]) -> int:
+    from models import EjemploIntencion, ModeloIntencion
+
+    hasta = (
+        db.query(ModeloIntencion.hasta_ejemplo_id)
+        .filter(ModeloIntencion.usuario_id == usuario_id, ModeloIntencion.perfil_id == perfil_id)
+        .scalar()
+    ) or 0
+    return (
+        db.query(EjemploIntencion.id)
+        .filter(
+            EjemploIntencion.usuario_id == usuario_id,
+            EjemploIntencion.perfil_id == perfil_id,
+            EjemploIntencion.id > hasta,
+        )
+        .count()
+    )
+
+
+def encolar_entrenamiento(db, usuario_id: int, perfil_id: Optional[int]) -> None:
+    """Encolar el job de entrenamiento del perfil (si no hay uno pendiente)."""
+    from models import BackgroundJob
+    from redis_queue import encolar_job
+
+    pendiente = db.query(BackgroundJob.id).filter(
+        BackgroundJob.tipo == "entrenar_intenciones",
+        BackgroundJob.usuario_id == usuario_id,
+        BackgroundJob.perfil_id == perfil_id,
+        BackgroundJob.estado.in_(["pendiente", "procesando"]),
+    ).first()
+    if pendiente:
+        return
+    job = BackgroundJob(
+        tipo="entrenar_intenciones",
+        estado="pendiente",
+        mensaje="En cola, esperando worker...",
+        usuario_id=usuario_id,
+        perfil_id=perfil_id,
+    )
+    db.add(job)
+    db.commit()
+    encolar_job(job.id, "entrenar_intenciones")
+
+
+# ─── Entrenamiento (job del worker) ─────────────────────────────────────
+
+
+def entrenar_perfil(db, usuario_id: int, perfil_id: Optional[int]) -> dict:
+    """Entrenar y guardar el modelo del perfil con sus últimos ejemplos.
+
+    Los ejemplos más viejos que INTENT_MODEL_MAX_EJEMPLOS se borran."""
+    from models import EjemploIntencion, ModeloIntencion
+
+    filas = (
+        db.query(EjemploIntencion.id, EjemploIntencion.mensaje, EjemploIntencion.skill)
+        .filter(EjemploIntencion.usuario_id == usuario_id, EjemploIntencion.perfil_id == perfil_id)
+        .order_by(EjemploIntencion.id.desc())
+        .limit(INTENT_MODEL_MAX_EJEMPLOS)
+        .all()
+    )
+    if not filas:
+        return {"ejemplos": 0, "exactitud": None, "activo": False}
+
+    hasta = filas[0][0]
+    minimo_id = filas[-1][0]
+    db.query(EjemploIntencion).filter(
+        EjemploIntencion.usuario_id == usuario_id,
+        EjemploIntencion.perfil_id == perfil_id,
+        EjemploIntencion.id < minimo_id,
+    ).delete(synchronize_session=False)
+
+    # Skills con muy pocos ejemplos no se aprenden (siguen yendo a la IA)
+    por_skill = Counter(skill for _, _, skill in filas)
+    ejemplos = [(m, s) for _, m, s in reversed(filas) if por_skill[s] >= INTENT_MODEL_MIN_POR_SKILL]
+
+    exactitud = evaluar(ejemplos) if len(ejemplos) >= INTENT_MODEL_MIN_EJEMPLOS else None
+    activo = exactitud is not None and exactitud >= INTENT_MODEL_MIN_EXACTITUD and len(set(s for _, s in ejemplos)) > 1
+
+    fila = (
+        db.query(ModeloIntencion)
+        .filter(ModeloIntencion.usuario_id == usuario_id, ModeloIntencion.perfil_id == perfil_id)
+        .first()
+    )
+    if fila is None:
+        fila = ModeloIntencion(usuario_id=usuario_id, perfil_id=perfil_id)
+        db.add(fila)
+    # Un modelo que no pasa la evaluación se guarda vacío: el perfil no lo usa
+    fila.modelo = ClasificadorNB.entrenar(ejemplos).to_json() if activo else ClasificadorNB().to_json()
+    fila.ejemplos = len(ejemplos)
+    fila.hasta_ejemplo_id = hasta
+    fila.exactitud = exactitud
+    db.commit()
+
+    invalidar_modelo(usuario_id, perfil_id)
+    logger.info(
+        f"Modelo de intención usuario={usuario_id} perfil={perfil_id}: "
+        f"{len(ejemplos)} ejemplos, exactitud={exactitud}, activo={activo}"
+    )
+    return {"ejemplos": len(ejemplos), "exactitud": exactitud, "activo": activo}
+
+
+# ─── Predicción (intent_classifier) ─────────────────────────────────────
+
+# (usuario_id, perfil_id) -> {"modelo": ClasificadorNB | None, "ts": float}.
+# Otros procesos ven un modelo nuevo al vencer el TTL.
+_modelos: dict = {}
+
+
+def invalidar_modelo(usuario_id: int = None, perfil_id: Optional[int] = None) -> None:
+    if usuario_id is None:
+        _modelos.clear()
+    else:
+        _modelos.pop((usuario_id, perfil_id), None)
+
+
+def _cargar_modelo(usuario_id: int, perfil_id: Optional[int]) -> Optional[ClasificadorNB]:
+    entrada = _modelos.get((usuario_id, perfil_id))
+    if entrada is not None and time.time() - entrada["ts"] < _MODELOS_TTL:
+        return entrada["modelo"]
+
+    from models import ModeloIntencion, SessionLocal
+
+    modelo = None
+    db = SessionLocal()
+    try:
+        crudo = (
+            db.query(ModeloIntencion.modelo)
+            .filter(ModeloIntencion.usuario_id == usuario_id, ModeloIntencion.perfil_id == perfil_id)
+            .scalar()
+        )
+        if crudo:
+            modelo = ClasificadorNB.from_json(crudo)
+            if not modelo.clases:
+                modelo = None
+    except Exception as e:
+        logger.error(f"Error cargando modelo de intención: {e}")
+    finally:
+        db.close()
+    _modelos[(usuario_id, perfil_id)] = {"modelo": modelo, "ts": time.time()}
+    return modelo
+
+
+def predecir(
+    usuario_id: int, perfil_id: Optional[int], normalizado: str, enabled_skills: List[str]
+) -> Optional[Tuple[str, float]]:
+    """(skill, probabilidad) si el modelo del perfil está seguro; si no, None."""
+    from database import get_config
+
+    if get_config("local_intent_model", "true", usuario_id=usuario_id, perfil_id=perfil_id).lower() != "true":
+        return None
+    modelo = _cargar_modelo(usuario_id, perfil_id)
+    if modelo is None:
+        return None
+    prediccion = modelo.predecir(normalizado)
+    if prediccion is None:
+        return None
+    skill, probabilidad = prediccion
+    try:
+        umbral = float(get_config("local_intent_threshold", str(UMBRAL_DEFAULT), usuario_id=usuario_id, perfil_id=perfil_id))
+    except (TypeError, ValueError):
+        umbral = UMBRAL_DEFAULT
+    if probabilidad < umbral or skill not in list(enabled_skills) + ["free_chat"]:
+        return None
+    return skill, probabilidad
@@ -0,0 +1,189 @@
+"""
+Message Coalescer - Agrupa ráfagas de mensajes de una conversación en un solo turno del agente
+
+Los contactos suelen mandar varios mensajes cortos seguidos ("hola", "una pregunta",
+"cuánto cuesta..."). En lugar de correr el agente por cada uno, los mensajes de la
+misma conversación (usuario_id, perfil_id, telefono) se acumulan durante una ventana
+de debounce configurable por perfil (`message_debounce_seconds`). Cada mensaje nuevo
+y cada evento de typing del contacto reinician la ventana; al vencer, el primer
+mensaje de la ráfaga (el líder) recibe todos los textos y corre un único turno.
+
+Si los mensajes vienen de la cola durable, la ráfaga también acumula sus ids de
+evento: el líder los confirma cuando termina el turno, así un worker caído a
+mitad de la ráfaga deja todos sus eventos pendientes para XAUTOCLAIM.
+
+El estado vive en Redis para que funcione entre procesos (API inline y consumidores
+del worker). Si Redis no está disponible se usa un buffer en memoria del proceso.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from database import get_config
+
+logger = logging.getLogger(__name__)
+
+# Límite duro de la ventana: más allá el contacto percibe al agente como caído.
+MAX_DEBOUNCE_SECONDS = 10.0
+# TTL de seguridad de las llaves de la ráfaga (por si el líder muere a mitad);
+# el líder lo renueva en cada sondeo mientras la ventana sigue abierta.
+_TTL_SEGURIDAD_MS = 60_000
+_POLL_MINIMO = 0.05
+
+# KEYS: buffer, ultimo, lider, eventos — ARGV: mensaje, ventana_ms, ttl_ms, evento_id
+# Agrega el mensaje (y su evento, si hay), reinicia la ventana y devuelve 1 si
+# el caller queda como líder.
+_LUA_AGREGAR = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('RPUSH', KEYS[4], ARGV[4])
+    redis.call('PEXPIRE', KEYS[4], ARGV[3])
+end
+redis.call('SET', KEYS[2], '1', 'PX', ARGV[2])
+if redis.call('SET', KEYS[3], '1', 'NX', 'PX', ARGV[3]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: buffer, ultimo, typing, lider, eventos — ARGV: ttl_ms
+# Si la ventana ya venció (sin mensajes ni typing recientes) drena el buffer y
+# los eventos y libera el liderazgo de forma atómica: {0, n_mensajes,
+# mensajes..., eventos...}. Si no, renueva el TTL del liderazgo y del buffer
+# (una ráfaga larga no puede perder su líder a mitad) y devuelve {ms que faltan}.
+_LUA_DRENAR = """
+local restante = math.max(redis.call('PTTL', KEYS[2]), redis.call('PTTL', KEYS[3]))
+if restante > 0 then
+    redis.call('PEXPIRE', KEYS[4], ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+    redis.call('PEXPIRE', KEYS[5], ARGV[1])
+    return {restante}
+end
+local mensajes = redis.call('LRANGE', KEYS[1], 0, -1)
+local resultado = {0, #mensajes}
+for _, m in ipairs(mensajes) do table.insert(resultado, m) end
+for _, e in ipairs(redis.call('LRANGE', KEYS[5], 0, -1)) do table.insert(resultado, e) end
+redis.call('DEL', KEYS[1], KEYS[4], KEYS[5])
+return resultado
+"""
+
+# Fallback en memoria: clave -> {"mensajes": [...], "eventos": [...], "ultimo": ts}
+_buffers_locales: Dict[Tuple, Dict] = {}
+_typing_local: Dict[Tuple, float] = {}
+
+
+def obtener_ventana(usuario_id: int, perfil_id: int = None) -> float:
+    """Ventana de debounce en segundos para el perfil (0 = deshabilitado)."""
+    raw = get_config("message_debounce_seconds", "0", usuario_id=usuario_id, perfil_id=perfil_id)
+    try:
+        ventana = float(raw or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, min(ventana, MAX_DEBOUNCE_SECONDS))
+
+
+def _llaves(usuario_id: int, perfil_id: Optional[int], telefono: str) -> Dict[str, str]:
+    base = f"{usuario_id}:{perfil_id or 0}:{telefono}"
+    return {
+        "buffer": f"coalesce:buf:{base}",
+        "ultimo": f"coalesce:ultimo:{base}",
+        "typing": f"coalesce:typing:{base}",
+        "lider": f"coalesce:lider:{base}",
+        "eventos": f"coalesce:eventos:{base}",
+    }
+
+
+async def registrar_typing(usuario_id: int, perfil_id: Optional[int], telefono: str) -> None:
+    """El contacto está escribiendo: extiende la ventana de la ráfaga en curso."""
+    from redis_queue import get_redis_async
+
+    ventana = obtener_ventana(usuario_id, perfil_id)
+    if ventana <= 0:
+        return
+    r = await get_redis_async()
+    if r is not None:
+        try:
+            await r.set(_llaves(usuario_id, perfil_id, telefono)["typing"], "1", px=int(ventana * 1000))
+            return
+        except Exception as e:
+            logger.warning(f"Coalescer: error registrando typing en Redis: {e}")
+    _typing_local[(usuario_id, perfil_id, telefono)] = time.monotonic()
+
+
+async def agrupar(
+    usuario_id: int, perfil_id: Optional[int], telefono: str, mensaje: str, ventana: float,
+    evento_id: str = None,
+) -> Optional[Tuple[List[str], List[str]]]:
+    """Sumar un mensaje a la ráfaga de su conversación.
+
+    Retorna None si el mensaje quedó absorbido por una ráfaga que ya tiene líder.
+    Si el caller es el líder, espera a que la ventana venza y retorna
+    (mensajes, eventos): todos los mensajes de la ráfaga en orden de llegada y
+    los ids de evento de la cola durable que la componen (a confirmar tras el turno).
+    """
+    from redis_queue import get_redis_async
+
+    r = await get_redis_async()
+    if r is not None:
+        try:
+            return await _agrupar_redis(r, usuario_id, perfil_id, telefono, mensaje, ventana, evento_id)
+        except Exception as e:
+            logger.warning(f"Coalescer: Redis no disponible, usando buffer local: {e}")
+    return await _agrupar_local((usuario_id, perfil_id, telefono), mensaje, ventana, evento_id)
+
+
+async def _agrupar_redis(
+    r, usuario_id, perfil_id, telefono, mensaje, ventana, evento_id
+) -> Optional[Tuple[List[str], List[str]]]:
+    llaves = _llaves(usuario_id, perfil_id, telefono)
+    ventana_ms = int(ventana * 1000)
+    es_lider = await r.eval(
+        _LUA_AGREGAR, 4,
+        llaves["buffer"], llaves["ultimo"], llaves["lider"], llaves["eventos"],
+        mensaje, ventana_ms, _TTL_SEGURIDAD_MS, evento_id or "",
+    )
+    if not es_lider:
+        return None
+
+    espera = ventana
+    while True:
+        await asyncio.sleep(max(espera, _POLL_MINIMO))
+        resultado = await r.eval(
+            _LUA_DRENAR, 5,
+            llaves["buffer"], llaves["ultimo"], llaves["typing"], llaves["lider"], llaves["eventos"],
+            _TTL_SEGURIDAD_MS,
+        )
+        if resultado and int(resultado[0]) > 0:
+            espera = int(resultado[0]) / 1000.0
+            continue
+        n = int(resultado[1]) if resultado and len(resultado) > 1 else 0
+        mensajes, eventos = list(resultado[2:2 + n]), list(resultado[2 + n:])
+        return mensajes or [mensaje], eventos or ([evento_id] if evento_id else [])
+
+
+async def _agrupar_local(
+    clave: Tuple, mensaje: str, ventana: float, evento_id: str = None
+) -> Optional[Tuple[List[str], List[str]]]:
+    rafaga = _buffers_locales.get(clave)
+    if rafaga is not None:
+        rafaga["mensajes"].append(mensaje)
+        if evento_id:
+            rafaga["eventos"].append(evento_id)
+        rafaga["ultimo"] = time.monotonic()
+        return None
+
+    rafaga = {"mensajes": [mensaje], "eventos": [evento_id] if evento_id else [], "ultimo": time.monotonic()}
+    _buffers_locales[clave] = rafaga
+    try:
+        while True:
+            referencia = max(rafaga["ultimo"], _typing_local.get(clave, 0.0))
+            restante = referencia + ventana - time.monotonic()
+            if restante <= 0:
+                return rafaga["mensajes"], rafaga["eventos"]
+            await asyncio.sleep(max(restante, _POLL_MINIMO))
+    finally:
+        _buffers_locales.pop(clave, None)
+        _typing_local.pop(clave, None)
@@ -6,11 +6,68 @@ import json
 import logging
 from datetime import datetime
 from sqlalchemy.orm import Session
-from models import MensajeConversacion, Memoria
+from sqlalchemy.exc import IntegrityError
+from models import Contacto, MensajeConversacion, Memoria, commit_or_flush, en_unit_of_work
 
 logger = logging.getLogger(__name__)
 
 
+def normalizar_wa_id(raw) -> str | None:
+    """Id de mensaje de WhatsApp en forma corta.
+
+    El webhook del bridge manda `msg.id.id` ("3EB0A1...") pero el envío devuelve
+    `_serialized` ("true_5215550000@c.us_3EB0A1..."); se guardan igual para que
+    el eco de un mensaje enviado por nosotros choque con su fila."""
+    if not raw:
+        return None
+    partes = str(raw).split("_")
+    if len(partes) >= 3 and partes[0] in ("true", "false"):
+        return partes[2] or None
+    return str(raw)[:128]
+
+
+# Flag global (config usuario 0): todos los blobs de Memoria ya están en
+# mensajes_conversacion y no hay que revisar la tabla legacy por conversación.
+MEMORIA_MIGRADA_KEY = "legacy_memoria_migrated"
+
+
+def memoria_migrada() -> bool:
+    from database import get_config
+
+    return get_config(MEMORIA_MIGRADA_KEY, "false").lower() == "true"
+
+
+# Lock de la migración masiva (worker.migrar_memoria_legacy)
+MIGRACION_MASIVA_LOCK = "worker:migrar_memoria:lock"
+
+
+def migracion_masiva_en_curso() -> bool:
+    """True mientras el worker migra todos los blobs (mientras tanto la
+    migración por conversación se saltea, para no migrar dos veces el mismo)."""
+    try:
+        from redis_queue import get_redis
+
+        return bool(get_redis().exists(MIGRACION_MASIVA_LOCK))
+    except Exception:
+        return False
+
+
+def _sumar_mensajes_usuario(db: Session, usuario_id: int, telefono: str, cantidad: int = 1) -> None:
+    """Incrementar Contacto.mensajes_usuario en la base (UPDATE atómico, sin cargar
+    el contacto). Es el contador que usa lead_scoring."""
+    from sqlalchemy import func
+
+    if usuario_id is None or cantidad <= 0:
+        return
+    db.query(Contacto).filter(
+        Contacto.usuario_id == usuario_id,
+        Contacto.telefono == telefono,
+    ).update(
+        {Contacto.mensajes_usuario: func.coalesce(Contacto.mensajes_usuario, 0) + cantidad},
+        synchronize_session=False,
+    )
+
+
 class MessageService:
     """Servicio para mensajes de conversacion per-message"""
 
@@ -24,6 +81,7 @@ class MessageService:
         tipo_evento: str = None,
         metadata: dict = None,
         perfil_id: int = None,
+        wa_id: str = None,
     ) -> dict:
         """Agregar un mensaje a la conversacion.
 
@@ -45,12 +103,248 @@ class MessageService:
             metadata_json=json.dumps(metadata, ensure_ascii=False)
             if metadata
             else None,
+            wa_id=normalizar_wa_id(wa_id),
         )
         db.add(msg)
-        db.commit()
-        db.refresh(msg)
+        if rol == "user" and tipo_evento is None:
+            _sumar_mensajes_usuario(db, usuario_id, telefono)
+        commit_or_flush(db)
         return msg.to_dict()
 
+    @staticmethod
+    def add_message_if_absent(
+        db: Session,
+        telefono: str,
+        rol: str,
+        contenido: str,
+        wa_id: str,
+        usuario_id: int,
+        metadata: dict = None,
+        perfil_id: int = None,
+    ) -> dict | None:
+        """Insertar un mensaje solo si su wa_id no existe para el usuario.
+
+        INSERT ... ON CONFLICT DO NOTHING sobre el índice único (usuario_id, wa_id):
+        un evento reentregado es un no-op O(1). Retorna None si ya existía.
+        Sin wa_id no hay llave de idempotencia y se inserta siempre."""
+        wa_id = normalizar_wa_id(wa_id)
+        if not wa_id:
+            return MessageService.add_message(
+                db, telefono, rol, contenido, usuario_id=usuario_id,
+                metadata=metadata, perfil_id=perfil_id,
+            )
+        if perfil_id is None and usuario_id is not None:
+            try:
+                from api.routers.perfiles import get_perfil_activo_id
+                perfil_id = get_perfil_activo_id(db, usuario_id)
+            except Exception:
+                perfil_id = None
+
+        valores = dict(
+            telefono=telefono,
+            rol=rol,
+            contenido=contenido,
+            usuario_id=usuario_id,
+            perfil_id=perfil_id,
+            metadata_json=json.dumps(metadata, ensure_ascii=False) if metadata else None,
+            wa_id=wa_id,
+            created_at=datetime.utcnow(),
+        )
+
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy import text as sa_text
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+            stmt = (
+                pg_insert(MensajeConversacion)
+                .values(**valores)
+                .on_conflict_do_nothing(
+                    index_elements=["usuario_id", "wa_id"],
+                    index_where=sa_text("wa_id IS NOT NULL"),
+                )
+                .returning(MensajeConversacion.id)
+            )
+            new_id = db.execute(stmt).scalar()
+            if new_id is not None and rol == "user":
+                _sumar_mensajes_usuario(db, usuario_id, telefono)
+            commit_or_flush(db)
+            if new_id is None:
+                return None
+            msg = db.get(MensajeConversacion, new_id)
+            return msg.to_dict() if msg else None
+
+        # Otros motores (tests locales): chequeo por el índice + insert
+        existe = (
+            db.query(MensajeConversacion.id)
+            .filter(MensajeConversacion.usuario_id == usuario_id, MensajeConversacion.wa_id == wa_id)
+            .first()
+        )
+        if existe:
+            return None
+        msg = MensajeConversacion(**valores)
+        db.add(msg)
+        if rol == "user":
+            _sumar_mensajes_usuario(db, usuario_id, telefono)
+        commit_or_flush(db)
+        return msg.to_dict()
+
+    @staticmethod
+    def sin_respuesta(
+        db: Session, telefono: str, wa_id: str, usuario_id: int, antiguedad_minima: float = 0
+    ) -> bool:
+        """True si el mensaje entrante `wa_id` ya está guardado pero ningún
+        mensaje del asistente lo siguió y tiene al menos `antiguedad_minima`
+        segundos: su turno se perdió (p. ej. el proceso murió entre el insert y
+        la respuesta) y un evento reentregado tiene que volver a correrlo."""
+        from datetime import timedelta
+
+        wa_id = normalizar_wa_id(wa_id)
+        if not wa_id:
+            return False
+        mensaje = (
+            db.query(MensajeConversacion.id, MensajeConversacion.created_at)
+            .filter(
+                MensajeConversacion.usuario_id == usuario_id,
+                MensajeConversacion.wa_id == wa_id,
+                MensajeConversacion.rol == "user",
+            )
+            .first()
+        )
+        if mensaje is None:
+            return False
+        if mensaje.created_at and mensaje.created_at > datetime.utcnow() - timedelta(seconds=antiguedad_minima):
+            return False
+        respondido = (
+            db.query(MensajeConversacion.id)
+            .filter(
+                MensajeConversacion.usuario_id == usuario_id,
+                MensajeConversacion.telefono == telefono,
+                MensajeConversacion.rol == "assistant",
+                MensajeConversacion.id > mensaje.id,
+            )
+            .first()
+        )
+        return respondido is None
+
+    @staticmethod
+    def add_messages_bulk(db: Session, filas: list) -> list:
+        """Insertar un lote de mensajes en una sola sentencia, sin commit (el caller
+        cierra la transacción).
+
+        Cada fila: telefono, rol, contenido, usuario_id, perfil_id y opcionales
+        metadata y wa_id. Los wa_id repetidos (en el lote o ya guardados) se
+        descartan igual que en add_message_if_absent. Retorna las filas insertadas.
+        Los contadores del contacto (mensajes_usuario) los suma el caller con
+        guardar_contactos_lote, que ya recorre los contactos del lote."""
+        vistos = set()
+        valores = []
+        pendientes = []
+        ahora = datetime.utcnow()
+        for fila in filas:
+            wa_id = normalizar_wa_id(fila.get("wa_id"))
+            if wa_id:
+                llave = (fila["usuario_id"], wa_id)
+                if llave in vistos:
+                    continue
+                vistos.add(llave)
+            metadata = fila.get("metadata")
+            valores.append(dict(
+                telefono=fila["telefono"],
+                rol=fila["rol"],
+                contenido=fila["contenido"],
+                usuario_id=fila["usuario_id"],
+                perfil_id=fila.get("perfil_id"),
+                metadata_json=json.dumps(metadata, ensure_ascii=False) if metadata else None,
+                wa_id=wa_id,
+                created_at=fila.get("created_at") or ahora,
+            ))
+            pendientes.append(fila)
+        if not valores:
+            return []
+
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy import text as sa_text
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+            stmt = (
+                pg_insert(MensajeConversacion)
+                .values(valores)
+                .on_conflict_do_nothing(
+                    index_elements=["usuario_id", "wa_id"],
+                    index_where=sa_text("wa_id IS NOT NULL"),
+                )
+                .returning(MensajeConversacion.usuario_id, MensajeConversacion.wa_id)
+            )
+            insertados = {(uid, wa) for uid, wa in db.execute(stmt).all() if wa}
+        else:
+            existentes = set()
+            por_usuario = {}
+            for v in valores:
+                if v["wa_id"]:
+                    por_usuario.setdefault(v["usuario_id"], []).append(v["wa_id"])
+            for uid, wa_ids in por_usuario.items():
+                existentes |= {
+                    (uid, wa) for (wa,) in db.query(MensajeConversacion.wa_id).filter(
+                        MensajeConversacion.usuario_id == uid,
+                        MensajeConversacion.wa_id.in_(wa_ids),
+                    )
+                }
+            nuevos = [v for v in valores if not v["wa_id"] or (v["usuario_id"], v["wa_id"]) not in existentes]
+            db.add_all([MensajeConversacion(**v) for v in nuevos])
+            db.flush()
+            insertados = {(v["usuario_id"], v["wa_id"]) for v in nuevos if v["wa_id"]}
+
+        return [
+            fila for fila, v in zip(pendientes, valores)
+            if not v["wa_id"] or (v["usuario_id"], v["wa_id"]) in insertados
+        ]
+
+    @staticmethod
+    def adopt_outgoing_echo(
+        db: Session, telefono: str, contenido: str, wa_id: str, usuario_id: int, ventana_segundos: int = 120
+    ) -> bool:
+        """Asignar el wa_id del eco de un mensaje que enviamos (agente o dashboard)
+        a su fila ya guardada, en vez de insertarlo de nuevo como mensaje del celular.
+
+        Solo mira las últimas filas salientes sin wa_id de la conversación
+        (índice usuario_id, telefono, created_at)."""
+        from datetime import timedelta
+
+        wa_id = normalizar_wa_id(wa_id)
+        if not wa_id:
+            return False
+        candidato = (
+            db.query(MensajeConversacion)
+            .filter(
+                MensajeConversacion.usuario_id == usuario_id,
+                MensajeConversacion.telefono == telefono,
+                MensajeConversacion.created_at >= datetime.utcnow() - timedelta(seconds=ventana_segundos),
+                MensajeConversacion.rol == "assistant",
+                MensajeConversacion.wa_id == None,
+                MensajeConversacion.contenido == contenido,
+            )
+            .order_by(MensajeConversacion.created_at.desc())
+            .first()
+        )
+        if not candidato:
+            return False
+        if en_unit_of_work(db):
+            # Dentro de un lote (procesar_lote): savepoint en vez de commit, así
+            # un wa_id que otro proceso ya guardó no tumba la transacción del lote
+            try:
+                with db.begin_nested():
+                    candidato.wa_id = wa_id
+            except IntegrityError:
+                pass
+            return True
+        candidato.wa_id = wa_id
+        try:
+            commit_or_flush(db)
+        except Exception:
+            # Otro proceso ya guardó este wa_id
+            db.rollback()
+        return True
+
     @staticmethod
     def add_system_event(
         db: Session,
@@ -298,13 +592,28 @@ class MessageService:
         if perfil_id is not None:
             mem_query = mem_query.filter(Memoria.perfil_id == perfil_id)
         mem_query.delete()
+        # Y el resumen acumulado (history_window)
+        from models import ResumenConversacion
+        resumen_query = db.query(ResumenConversacion).filter(ResumenConversacion.telefono == telefono)
+        if usuario_id is not None:
+            resumen_query = resumen_query.filter(ResumenConversacion.usuario_id == usuario_id)
+        resumen_query.delete()
+        if usuario_id is not None:
+            from lead_scoring import recontar_mensajes_usuario
+
+            recontar_mensajes_usuario(db, usuario_id, telefono)
         db.commit()
         return deleted
 
     @staticmethod
     def migrate_from_memoria(db: Session, telefono: str, usuario_id: int = None, perfil_id: int = None):
         """Migrar mensajes de la tabla Memoria (JSON blob) a mensajes individuales.
-        Se ejecuta la primera vez que se accede a una conversacion."""
+        Se ejecuta la primera vez que se accede a una conversacion.
+
+        No-op (sin queries) una vez que migrate_all_from_memoria marcó la
+        migración global como completa, y mientras esa migración está en curso."""
+        if memoria_migrada() or migracion_masiva_en_curso():
+            return
         if perfil_id is None and usuario_id is not None:
             try:
                 from api.routers.perfiles import get_perfil_activo_id
@@ -334,6 +643,7 @@ class MessageService:
         except (json.JSONDecodeError, TypeError):
             return
 
+        de_usuario = 0
         for msg in historial:
             rol = msg.get("role", "user")
             contenido = msg.get("content", "")
@@ -347,8 +657,101 @@ class MessageService:
                         perfil_id=perfil_id,
                     )
                 )
+                de_usuario += rol == "user"
 
+        _sumar_mensajes_usuario(db, usuario_id, telefono, de_usuario)
         db.commit()
         logger.info(
             f"Migrados {len(historial)} mensajes de Memoria a MensajeConversacion para {telefono}"
         )
+
+    @staticmethod
+    def migrate_all_from_memoria(db: Session, lote: int = 200) -> dict:
+        """Migración masiva de todos los blobs de Memoria a MensajeConversacion.
+
+        Recorre la tabla legacy por lotes (keyset sobre telefono), salta las
+        conversaciones que ya tienen mensajes en la tabla nueva (mismo criterio
+        que migrate_from_memoria) y al terminar marca el flag global. Idempotente:
+        se puede correr de nuevo sin duplicar.
+        """
+        from datetime import timedelta
+        from database import set_config
+
+        conversaciones = 0
+        mensajes = 0
+        ultimo = ""
+        perfiles_activos = {}
+
+        while True:
+            memorias = (
+                db.query(Memoria)
+                .filter(Memoria.telefono > ultimo)
+                .order_by(Memoria.telefono)
+                .limit(lote)
+                .all()
+            )
+            if not memorias:
+                break
+            ultimo = memorias[-1].telefono
+
+            ya_migradas = set(
+                db.query(MensajeConversacion.telefono, MensajeConversacion.usuario_id)
+                .filter(MensajeConversacion.telefono.in_([m.telefono for m in memorias]))
+                .distinct()
+                .all()
+            )
+
+            filas = []
+            for memoria in memorias:
+                if (memoria.telefono, memoria.usuario_id) in ya_migradas or not memoria.historial:
+                    continue
+                try:
+                    historial = json.loads(memoria.historial)
+                except (json.JSONDecodeError, TypeError):
+                    continue
+                historial = [m for m in historial if isinstance(m, dict) and m.get("content")]
+                if not historial:
+                    continue
+
+                perfil_id = memoria.perfil_id
+                if perfil_id is None:
+                    if memoria.usuario_id not in perfiles_activos:
+                        from api.routers.perfiles import get_perfil_activo_id
+
+                        try:
+                            perfiles_activos[memoria.usuario_id] = get_perfil_activo_id(db, memoria.usuario_id)
+                        except Exception:
+                            perfiles_activos[memoria.usuario_id] = None
+                    perfil_id = perfiles_activos[memoria.usuario_id]
+
+                # Timestamps crecientes que terminan en la última escritura del
+                # blob: conserva el orden y queda antes de cualquier mensaje nuevo.
+                fin = memoria.updated_at or memoria.created_at or datetime.utcnow()
+                inicio = fin - timedelta(seconds=len(historial))
+                for i, msg in enumerate(historial):
+                    filas.append(
+                        MensajeConversacion(
+                            telefono=memoria.telefono,
+                            rol=msg.get("role", "user"),
+                            contenido=msg["content"],
+                            usuario_id=memoria.usuario_id,
+                            perfil_id=perfil_id,
+                            created_at=inicio + timedelta(seconds=i),
+                        )
+                    )
+                _sumar_mensajes_usuario(
+                    db, memoria.usuario_id, memoria.telefono,
+                    sum(1 for m in historial if m.get("role", "user") == "user"),
+                )
+                conversaciones += 1
+
+            if filas:
+                db.add_all(filas)
+                db.commit()
+                mensajes += len(filas)
+            db.expunge_all()
+            logger.info(f"Migración Memoria: {conversaciones} conversaciones, {mensajes} mensajes (hasta {ultimo})")
+
+        set_config(MEMORIA_MIGRADA_KEY, "true", usuario_id=0, perfil_id=0)
+        logger.info(f"Migración Memoria completa: {conversaciones} conversaciones, {mensajes} mensajes")
+        return {"conversaciones": conversaciones, "mensajes": mensajes}
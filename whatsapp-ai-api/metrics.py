@@ -0,0 +1,242 @@
+"""
+Metrics - Instrumentación de latencia por etapa en formato Prometheus
+
+Registro en memoria del proceso (sin dependencias externas) con histogramas,
+contadores y gauges, expuesto en /metrics como texto Prometheus.
+
+Uso en el pipeline de mensajes:
+
+    crono = Cronometro(usuario_id)
+    with usar_cronometro(crono):
+        with etapa("clasificacion"):
+            ...
+    crono.tiempos_ms  # {"clasificacion": 12.3, ...} -> metadata_json del mensaje
+
+`etapa()` observa siempre el histograma `wtx_stage_seconds{stage, usuario_id}`
+y, si hay un cronómetro activo en el contexto, también acumula el tiempo ahí.
+El cronómetro vive en un ContextVar: al cruzar a un thread (run_in_executor) hay
+que pasarlo explícitamente y re-activarlo con usar_cronometro().
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registro = []
+_lock = threading.Lock()
+
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(nombres: Tuple[str, ...], valores: Tuple, extra: str = "") -> str:
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _fmt_num(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre: str, ayuda: str, labels: Tuple[str, ...] = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.labels = tuple(labels)
+        self._series: Dict[Tuple, object] = {}
+        _registro.append(self)
+
+    def _clave(self, labels: dict) -> Tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def render(self) -> str:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with _lock:
+            series = list(self._series.items())
+        for clave, valor in series:
+            lineas.extend(self._render_serie(clave, valor))
+        return "\n".join(lineas)
+
+    def _render_serie(self, clave, valor):
+        return [f"{self.nombre}{_fmt_labels(self.labels, clave)} {_fmt_num(valor)}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, cantidad: float = 1, **labels) -> None:
+        clave = self._clave(labels)
+        with _lock:
+            self._series[clave] = self._series.get(clave, 0) + cantidad
+
+
+class Gauge(_Metrica):
+    tipo = "gauge"
+
+    def set(self, valor: float, **labels) -> None:
+        with _lock:
+            self._series[self._clave(labels)] = valor
+
+    def inc(self, cantidad: float = 1, **labels) -> None:
+        clave = self._clave(labels)
+        with _lock:
+            self._series[clave] = self._series.get(clave, 0) + cantidad
+
+    def dec(self, cantidad: float = 1, **labels) -> None:
+        self.inc(-cantidad, **labels)
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(nombre, ayuda, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, valor: float, **labels) -> None:
+        clave = self._clave(labels)
+        with _lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = {"buckets": [0] * len(self.buckets), "suma": 0.0, "cuenta": 0}
+                self._series[clave] = serie
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie["buckets"][i] += 1
+            serie["suma"] += valor
+            serie["cuenta"] += 1
+
+    def _render_serie(self, clave, serie):
+        lineas = []
+        for limite, acumulado in zip(self.buckets, serie["buckets"]):
+            le = _fmt_labels(self.labels, clave, f'le="{_fmt_num(limite)}"')
+            lineas.append(f"{self.nombre}_bucket{le} {acumulado}")
+        le_inf = _fmt_labels(self.labels, clave, 'le="+Inf"')
+        lineas.append(f"{self.nombre}_bucket{le_inf} {serie['cuenta']}")
+        base = _fmt_labels(self.labels, clave)
+        lineas.append(f"{self.nombre}_sum{base} {_fmt_num(round(serie['suma'], 6))}")
+        lineas.append(f"{self.nombre}_count{base} {serie['cuenta']}")
+        return lineas
+
+
+def render_prometheus() -> str:
+    """Todas las métricas registradas en formato de exposición Prometheus."""
+    return "\n".join(m.render() for m in _registro) + "\n"
+
+
+def token_valido(provided: Optional[str]) -> bool:
+    """Si METRICS_TOKEN está configurado se exige (Bearer o ?token=)."""
+    import os
+    import secrets
+
+    metrics_token = os.getenv("METRICS_TOKEN", "")
+    if not metrics_token:
+        return True
+    return bool(provided) and secrets.compare_digest(provided, metrics_token)
+
+
+def servir_metricas(puerto: int) -> None:
+    """Exponer /metrics en un thread daemon (procesos sin FastAPI, p. ej. el
+    worker, donde corre el pipeline del agente en WEBHOOK_ASYNC_MODE)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/metrics":
+                self._responder(404, "not found\n")
+                return
+            provided = (parse_qs(url.query).get("token") or [""])[0] or (
+                self.headers.get("authorization", "").removeprefix("Bearer ").strip()
+            )
+            if not token_valido(provided):
+                self._responder(401, "unauthorized\n")
+                return
+            self._responder(200, render_prometheus())
+
+        def _responder(self, status: int, cuerpo: str):
+            datos = cuerpo.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(("0.0.0.0", puerto), _Handler)
+    threading.Thread(target=servidor.serve_forever, name="metrics", daemon=True).start()
+
+
+# ─── Métricas del pipeline de mensajes ───────────────────────────────────
+
+STAGE_SECONDS = Histograma(
+    "wtx_stage_seconds",
+    "Duracion por etapa del pipeline de mensajes entrantes",
+    ("stage", "usuario_id"),
+)
+MENSAJES_PROCESADOS = Contador(
+    "wtx_inbound_messages_total",
+    "Eventos de mensaje procesados por resultado",
+    ("status", "usuario_id"),
+)
+
+
+# ─── Cronómetro por turno ────────────────────────────────────────────────
+
+
+class Cronometro:
+    """Acumula los tiempos por etapa de un mensaje/turno del agente."""
+
+    def __init__(self, usuario_id: Optional[int] = None):
+        self.usuario_id = usuario_id
+        self.tiempos_ms: Dict[str, float] = {}
+
+    def registrar(self, nombre: str, segundos: float) -> None:
+        self.tiempos_ms[nombre] = round(self.tiempos_ms.get(nombre, 0.0) + segundos * 1000, 1)
+
+
+_cronometro_actual: contextvars.ContextVar = contextvars.ContextVar("cronometro_actual", default=None)
+
+
+def cronometro_actual() -> Optional[Cronometro]:
+    return _cronometro_actual.get()
+
+
+@contextmanager
+def usar_cronometro(crono: Optional[Cronometro]):
+    """Activar un cronómetro en el contexto actual (thread o task)."""
+    token = _cronometro_actual.set(crono)
+    try:
+        yield crono
+    finally:
+        _cronometro_actual.reset(token)
+
+
+@contextmanager
+def etapa(nombre: str, usuario_id: Optional[int] = None):
+    """Medir una etapa: histograma por tenant + cronómetro activo (si hay)."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        transcurrido = time.perf_counter() - inicio
+        crono = _cronometro_actual.get()
+        if usuario_id is None and crono is not None:
+            usuario_id = crono.usuario_id
+        STAGE_SECONDS.observe(transcurrido, stage=nombre, usuario_id=usuario_id if usuario_id is not None else "")
+        if crono is not None:
+            crono.registrar(nombre, transcurrido)
@@ -2,9 +2,11 @@ from sqlalchemy import (
     create_engine,
     Column,
     Integer,
+    BigInteger,
     String,
     Float,
     Boolean,
+    Date,
     DateTime,
     Text,
     ForeignKey,
@@ -14,6 +16,7 @@ from sqlalchemy import (
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
 from datetime import datetime
 import os
 import time
@@ -100,6 +103,45 @@ def get_db():
         db.close()
 
 
+# ─── Unit of work ────────────────────────────────────────────────────────
+# Los servicios cierran sus escrituras con commit_or_flush(db): fuera de un
+# unit_of_work hacen commit como siempre; dentro, solo flush (las filas quedan
+# visibles para la misma sesión, que corre con autoflush=False) y el commit
+# único lo hace unit_of_work al salir. Si algo falla, rollback de todo el bloque.
+
+_UOW_KEY = "unit_of_work"
+
+
+def en_unit_of_work(db) -> bool:
+    return bool(db.info.get(_UOW_KEY))
+
+
+def commit_or_flush(db) -> None:
+    if en_unit_of_work(db):
+        db.flush()
+    else:
+        db.commit()
+
+
+@contextmanager
+def unit_of_work(db):
+    """Agrupar las escrituras de los servicios en una sola transacción.
+
+    Anidable: un bloque interno se suma al externo y no commitea por su cuenta."""
+    if en_unit_of_work(db):
+        yield db
+        return
+    db.info[_UOW_KEY] = True
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.info.pop(_UOW_KEY, None)
+
+
 class Memoria(Base):
     __tablename__ = "memoria"
 
@@ -199,6 +241,9 @@ class Contacto(Base):
     primer_mensaje = Column(DateTime)
     ultimo_mensaje = Column(DateTime)
     total_mensajes = Column(Integer, default=0)
+    # Mensajes del contacto (rol user, sin eventos); lo mantiene MessageService
+    # al insertar y lo usa lead_scoring en vez de contar la conversación
+    mensajes_usuario = Column(Integer, default=0)
 
     estado = Column(String(20), default="activo")  # activo, inactivo, bloqueado
     tags = Column(Text)  # JSON array
@@ -260,6 +305,7 @@ class Contacto(Base):
             if self.ultimo_mensaje
             else None,
             "total_mensajes": self.total_mensajes,
+            "mensajes_usuario": self.mensajes_usuario or 0,
             "estado": self.estado,
             "tags": json.loads(self.tags) if self.tags else [],
             "notas": self.notas,
@@ -623,12 +669,17 @@ class MensajeConversacion(Base):
         String(50), nullable=True
     )  # NULL=mensaje normal, datos_guardados, cita_agendada, paso_avanzado, intervencion_humana
     metadata_json = Column(Text, nullable=True)  # JSON con datos extra del evento
+    wa_id = Column(String(128), nullable=True)  # id del mensaje en WhatsApp (idempotencia)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     __table_args__ = (
         Index("idx_msg_telefono_created", "telefono", "created_at"),
         Index("idx_msg_tipo_evento", "tipo_evento"),
         Index("idx_msg_usuario_telefono", "usuario_id", "telefono", "created_at"),
+        Index(
+            "uq_msg_usuario_wa_id", "usuario_id", "wa_id",
+            unique=True, postgresql_where=text("wa_id IS NOT NULL"),
+        ),
     )
 
     def to_dict(self):
@@ -647,5 +698,144 @@ class MensajeConversacion(Base):
             "contenido": self.contenido,
             "tipo_evento": self.tipo_evento,
             "metadata": meta,
+            "wa_id": self.wa_id,
             "created_at": self.created_at.isoformat() if self.created_at else None,
         }
+
+
+class ResumenConversacion(Base):
+    """Resumen acumulado de la parte vieja de una conversación (history_window).
+
+    Cubre los mensajes user/assistant con id <= hasta_mensaje_id; el agente
+    manda el resumen más los mensajes posteriores que entren en el presupuesto."""
+
+    __tablename__ = "resumenes_conversacion"
+
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=False)
+    perfil_id = Column(Integer, ForeignKey("perfiles.id", ondelete="CASCADE"), nullable=True, index=True)
+    telefono = Column(String(20), nullable=False)
+    resumen = Column(Text, nullable=False, default="")
+    hasta_mensaje_id = Column(Integer, nullable=False, default=0)
+    mensajes_resumidos = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("usuario_id", "telefono", name="uq_resumen_usuario_telefono"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "perfil_id": self.perfil_id,
+            "telefono": self.telefono,
+            "resumen": self.resumen,
+            "hasta_mensaje_id": self.hasta_mensaje_id,
+            "mensajes_resumidos": self.mensajes_resumidos,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+
+class EjemploIntencion(Base):
+    """Decisión del clasificador IA (mensaje normalizado -> skill) guardada
+    como ejemplo de entrenamiento del modelo local (local_intent_model)."""
+
+    __tablename__ = "ejemplos_intencion"
+
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=False)
+    perfil_id = Column(Integer, ForeignKey("perfiles.id", ondelete="CASCADE"), nullable=True)
+    mensaje = Column(String(300), nullable=False)
+    skill = Column(String(50), nullable=False)
+    confianza = Column(Float, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_ejemplos_intencion_perfil", "usuario_id", "perfil_id", "id"),
+    )
+
+
+class ModeloIntencion(Base):
+    """Modelo local de intención entrenado por perfil (JSON de local_intent_model)."""
+
+    __tablename__ = "modelos_intencion"
+
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=False)
+    perfil_id = Column(Integer, ForeignKey("perfiles.id", ondelete="CASCADE"), nullable=True)
+    modelo = Column(Text, nullable=False)
+    ejemplos = Column(Integer, default=0)
+    # Último EjemploIntencion incluido en el entrenamiento
+    hasta_ejemplo_id = Column(Integer, default=0)
+    exactitud = Column(Float, nullable=True)  # sobre ejemplos separados del entrenamiento
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("usuario_id", "perfil_id", name="uq_modelo_intencion_perfil"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "perfil_id": self.perfil_id,
+            "ejemplos": self.ejemplos,
+            "exactitud": self.exactitud,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+
+class UsoLLM(Base):
+    """Una llamada al LLM: tokens, modelo, latencia y sitio (llm_usage).
+
+    Se escribe en lotes desde un thread aparte y se agrega por día en
+    UsoLLMDiario; las filas viejas se borran tras agregarse."""
+
+    __tablename__ = "usos_llm"
+
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=True)
+    perfil_id = Column(Integer, ForeignKey("perfiles.id", ondelete="CASCADE"), nullable=True)
+    sitio = Column(String(30), nullable=False)
+    modelo = Column(String(50), nullable=False)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    cached_tokens = Column(Integer, default=0)
+    latencia_ms = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class UsoLLMDiario(Base):
+    """Rollup diario de UsoLLM por tenant, perfil, sitio y modelo (dashboard)."""
+
+    __tablename__ = "usos_llm_diarios"
+
+    id = Column(Integer, primary_key=True, index=True)
+    fecha = Column(Date, nullable=False, index=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id', ondelete='CASCADE'), nullable=True)
+    perfil_id = Column(Integer, ForeignKey("perfiles.id", ondelete="CASCADE"), nullable=True)
+    sitio = Column(String(30), nullable=False)
+    modelo = Column(String(50), nullable=False)
+    llamadas = Column(Integer, default=0)
+    prompt_tokens = Column(BigInteger, default=0)
+    completion_tokens = Column(BigInteger, default=0)
+    cached_tokens = Column(BigInteger, default=0)
+    latencia_ms_total = Column(BigInteger, default=0)
+    latencia_ms_max = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("ix_usos_llm_diarios_tenant", "usuario_id", "perfil_id", "fecha"),
+    )
+
+    def to_dict(self):
+        return {
+            "fecha": self.fecha.isoformat() if self.fecha else None,
+            "perfil_id": self.perfil_id,
+            "sitio": self.sitio,
+            "modelo": self.modelo,
+            "llamadas": self.llamadas,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "latencia_ms_promedio": round(self.latencia_ms_total / self.llamadas) if self.llamadas else 0,
+            "latencia_ms_max": self.latencia_ms_max,
+        }
@@ -0,0 +1,121 @@
+"""
+OpenAI Clients - Registro de clientes OpenAI reutilizables por API key
+
+Construir un `OpenAI(api_key=...)` por llamada crea un pool HTTP nuevo (y un
+handshake TLS) en cada salto al LLM; un solo mensaje entrante hacía tres o cuatro.
+Aquí se guarda un cliente por API key (cada tenant puede tener la suya) con un
+pool httpx keep-alive compartido por todas sus llamadas:
+
+  - obtener_cliente(api_key):        OpenAI síncrono (threads del agente, routers).
+  - obtener_cliente_async(api_key):  AsyncOpenAI para correr en el event loop.
+
+Los clientes async quedan atados al event loop que los creó (el pool de httpx
+no se puede compartir entre loops), así que se indexan por (api_key, loop).
+El registro es un LRU acotado: las keys rotadas o de tenants inactivos salen solas.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger(__name__)
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+# Cantidad máxima de API keys distintas con cliente vivo.
+OPENAI_MAX_CLIENTS = int(os.getenv("OPENAI_MAX_CLIENTS", "256"))
+
+_clientes: "OrderedDict[str, OpenAI]" = OrderedDict()
+_clientes_async: "OrderedDict[tuple, AsyncOpenAI]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _limites() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+    )
+
+
+def _recortar(registro: OrderedDict) -> list:
+    """Sacar los clientes menos usados por encima del límite (se cierran afuera del lock)."""
+    sobrantes = []
+    while len(registro) > OPENAI_MAX_CLIENTS:
+        _, cliente = registro.popitem(last=False)
+        sobrantes.append(cliente)
+    return sobrantes
+
+
+def obtener_cliente(api_key: str) -> OpenAI:
+    """Cliente OpenAI síncrono compartido para esta API key."""
+    if not api_key:
+        raise ValueError("No OpenAI API key configured")
+    with _lock:
+        cliente = _clientes.get(api_key)
+        if cliente is not None:
+            _clientes.move_to_end(api_key)
+            return cliente
+        cliente = OpenAI(
+            api_key=api_key,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            http_client=httpx.Client(limits=_limites(), timeout=OPENAI_TIMEOUT_SECONDS),
+        )
+        _clientes[api_key] = cliente
+        sobrantes = _recortar(_clientes)
+    for viejo in sobrantes:
+        try:
+            viejo.close()
+        except Exception:
+            pass
+    return cliente
+
+
+def obtener_cliente_async(api_key: str) -> AsyncOpenAI:
+    """Cliente AsyncOpenAI compartido para esta API key en el event loop actual."""
+    if not api_key:
+        raise ValueError("No OpenAI API key configured")
+    loop = asyncio.get_running_loop()
+    clave = (api_key, id(loop))
+    with _lock:
+        cliente = _clientes_async.get(clave)
+        if cliente is not None:
+            _clientes_async.move_to_end(clave)
+            return cliente
+        cliente = AsyncOpenAI(
+            api_key=api_key,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            http_client=httpx.AsyncClient(limits=_limites(), timeout=OPENAI_TIMEOUT_SECONDS),
+        )
+        _clientes_async[clave] = cliente
+        sobrantes = _recortar(_clientes_async)
+    for viejo in sobrantes:
+        try:
+            loop.create_task(viejo.close())
+        except Exception:
+            pass
+    return cliente
+
+
+async def cerrar_clientes() -> None:
+    """Cerrar todos los pools (shutdown de la app / worker)."""
+    with _lock:
+        sincronos = list(_clientes.values())
+        asincronos = list(_clientes_async.values())
+        _clientes.clear()
+        _clientes_async.clear()
+    for cliente in sincronos:
+        try:
+            cliente.close()
+        except Exception as e:
+            logger.debug(f"Error cerrando cliente OpenAI: {e}")
+    for cliente in asincronos:
+        try:
+            await cliente.close()
+        except Exception as e:
+            logger.debug(f"Error cerrando cliente AsyncOpenAI: {e}")
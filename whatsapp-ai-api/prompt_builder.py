@@ -5,11 +5,20 @@ Instead of one giant system prompt with ALL instructions (see agent.py build_sys
 we build a FOCUSED prompt that tells GPT exactly what happened and what to say.
 
 Structure:
+  ── static prefix (per tenant/profile, cached, byte-stable) ──
   [IDENTITY]        - Who you are (short, from config)
+  [KNOWLEDGE]       - Knowledge base of the profile
+  [RULES]           - Fixed behavior rules + custom instructions
+  ── per-contact / per-turn ──
   [CONTEXT]         - What you know about this client
   [SKILL RESULT]    - What just happened (from skill execution)
   [DIRECTIVE]       - What to say/do now (from funnel step + skill)
-  [RULES]           - Brief behavior rules
+  [TURN RULES]      - Rules that depend on this conversation
+
+The static prefix goes first and never changes between turns of the same
+profile, so the provider's automatic prompt caching applies to it. It is built
+once per (usuario_id, perfil_id) and invalidated by config/knowledge writes
+(invalidar_prefijo).
 
 This module does NOT import OpenAI or make API calls.
 It only builds the messages list; the actual OpenAI call happens in responder().
@@ -17,6 +26,9 @@ It only builds the messages list; the actual OpenAI call happens in responder().
 
 import json
 import logging
+import os
+import threading
+import time
 from database import get_config
 
 logger = logging.getLogger(__name__)
@@ -68,6 +80,116 @@ def build_identity(db, usuario_id: int, perfil_id: int = None) -> str:
     return "\n".join(parts)
 
 
+# ---------------------------------------------------------------------------
+# 1b. Static prefix (cached per profile)
+# ---------------------------------------------------------------------------
+
+STATIC_RULES = (
+    "Responde en espanol, conciso y natural.",
+    "No inventes informacion.",
+    "No uses markdown de imagenes ![](url).",
+)
+
+# Config keys that feed the static prefix; set_config on any of them invalidates it.
+PREFIX_CONFIG_KEYS = frozenset({
+    "agent_name",
+    "business_name",
+    "prompt_edit_mode",
+    "manual_prompt",
+    "prompt_sections",
+    "agent_products",
+    "custom_instructions",
+})
+
+# Coherencia entre procesos: igual que la tabla de ruteo (tenant.py), un
+# contador de versión por usuario en Redis (más uno global para usuario_id=0)
+# consultado como mucho cada PREFIX_VERSION_CHECK_SECONDS. Sin Redis, TTL.
+PREFIX_VERSION_KEY = "prompt:prefix:version:{}"
+PREFIX_VERSION_CHECK_SECONDS = float(os.getenv("PREFIX_VERSION_CHECK_SECONDS", "2"))
+PREFIX_TTL_SIN_REDIS = 60
+# Edad máxima aun con Redis: acota lo viejo que puede quedar el prefijo si la
+# config se escribe sin pasar por set_config (y sin subir la versión)
+PREFIX_MAX_AGE_SECONDS = float(os.getenv("PREFIX_MAX_AGE_SECONDS", "300"))
+
+_prefijos: dict = {}
+_prefijos_lock = threading.Lock()
+
+
+def _leer_version_prefijo(usuario_id: int):
+    try:
+        from redis_queue import get_redis
+
+        return tuple(get_redis().mget(PREFIX_VERSION_KEY.format(usuario_id), PREFIX_VERSION_KEY.format(0)))
+    except Exception:
+        return None
+
+
+def invalidar_prefijo(usuario_id: int = None) -> None:
+    """Descartar el prefijo cacheado del usuario (todos si usuario_id es 0/None)
+    en este proceso y avisar a los demás subiendo la versión en Redis."""
+    uid = usuario_id or 0
+    with _prefijos_lock:
+        for clave in list(_prefijos.keys()):
+            if uid == 0 or clave[0] == uid:
+                _prefijos.pop(clave, None)
+    try:
+        from redis_queue import get_redis
+
+        get_redis().incr(PREFIX_VERSION_KEY.format(uid))
+    except Exception as e:
+        logger.debug(f"No se pudo publicar invalidacion de prefijo: {e}")
+
+
+def build_static_prefix(db, usuario_id: int, perfil_id: int = None) -> str:
+    """Tenant-static part of the system prompt: identity, knowledge, fixed rules."""
+    from knowledge_service import KnowledgeService
+
+    identity = build_identity(db, usuario_id, perfil_id=perfil_id)
+    knowledge = KnowledgeService.get_context_for_agent(db, usuario_id)
+
+    rules = list(STATIC_RULES)
+    custom = get_config("custom_instructions", "", usuario_id=usuario_id, perfil_id=perfil_id)
+    if custom:
+        rules.append(custom)
+    rules_block = "Reglas:\n" + "\n".join(f"- {r}" for r in rules)
+
+    return "\n\n".join(part for part in [identity, knowledge, rules_block] if part)
+
+
+def get_static_prefix(db, usuario_id: int, perfil_id: int = None) -> str:
+    """Cached build_static_prefix for (usuario_id, perfil_id)."""
+    clave = (usuario_id, perfil_id)
+    ahora = time.monotonic()
+    entrada = _prefijos.get(clave)
+
+    if entrada is not None and ahora - entrada["cargado_ts"] >= PREFIX_MAX_AGE_SECONDS:
+        entrada = None  # se reconstruye aunque la versión no haya cambiado
+
+    if entrada is not None:
+        if ahora - entrada["chequeo_ts"] < PREFIX_VERSION_CHECK_SECONDS:
+            return entrada["texto"]
+        version = _leer_version_prefijo(usuario_id)
+        if version is not None:
+            if version == entrada["version"]:
+                entrada["chequeo_ts"] = ahora
+                return entrada["texto"]
+            # Otro proceso cambió la config: no reconstruir con su cache viejo
+            from database import invalidate_config_cache
+
+            for key in PREFIX_CONFIG_KEYS:
+                invalidate_config_cache(key)
+        elif ahora - entrada["cargado_ts"] < PREFIX_TTL_SIN_REDIS:
+            entrada["chequeo_ts"] = ahora
+            return entrada["texto"]
+    else:
+        version = _leer_version_prefijo(usuario_id)
+
+    texto = build_static_prefix(db, usuario_id, perfil_id=perfil_id)
+    with _prefijos_lock:
+        _prefijos[clave] = {"texto": texto, "version": version, "cargado_ts": ahora, "chequeo_ts": ahora}
+    return texto
+
+
 # ---------------------------------------------------------------------------
 # 2. Client context
 # ---------------------------------------------------------------------------
@@ -180,12 +302,8 @@ def build_skill_directive(skill_result: dict, context: dict) -> str:
 # ---------------------------------------------------------------------------
 
 def build_rules(context: dict) -> str:
-    """Brief behavior rules. Adapts based on skill result and disabled skills."""
-    rules = [
-        "Responde en espanol, conciso y natural.",
-        "No inventes informacion.",
-        "No uses markdown de imagenes ![](url).",
-    ]
+    """Per-conversation rules (the fixed ones live in the static prefix)."""
+    rules = []
 
     # Pending capture fields
     pending = context.get("pending_fields")
@@ -194,12 +312,9 @@ def build_rules(context: dict) -> str:
             f"Intenta obtener {', '.join(pending)} de forma natural en la conversacion."
         )
 
-    # Custom instructions from config
-    custom = context.get("custom_instructions")
-    if custom:
-        rules.append(custom)
-
-    return "Reglas:\n" + "\n".join(f"- {r}" for r in rules)
+    if not rules:
+        return ""
+    return "Reglas de esta conversacion:\n" + "\n".join(f"- {r}" for r in rules)
 
 
 # ---------------------------------------------------------------------------
@@ -216,8 +331,8 @@ def build_focused_prompt(db, context: dict, skill_result: dict) -> list:
         Must contain ``usuario_id`` and ``historial`` (list of message dicts).
         May contain: client_name, lead_score, lead_state, funnel_step,
         captured_data, pending_fields, message_count,
-        funnel_instruction, knowledge_context, custom_instructions,
-        skill_result.
+        funnel_instruction, skill_result. Identity, knowledge and custom
+        instructions come from the cached static prefix.
     skill_result : dict
         Output from a skill execution. Contains at least ``skill`` key.
 
@@ -229,7 +344,8 @@ def build_focused_prompt(db, context: dict, skill_result: dict) -> list:
     usuario_id = context["usuario_id"]
     perfil_id = context.get("perfil_id")
 
-    identity = build_identity(db, usuario_id, perfil_id=perfil_id)
+    # Byte-stable prefix first so provider prompt caching can reuse it
+    prefix = get_static_prefix(db, usuario_id, perfil_id=perfil_id)
     client_ctx = build_client_context(context)
     directive = build_skill_directive(skill_result, context)
 
@@ -242,17 +358,13 @@ def build_focused_prompt(db, context: dict, skill_result: dict) -> list:
             "Sigue esta directiva por encima de todo."
         )
 
-    # Knowledge context — always available for reference
-    knowledge = context.get("knowledge_context", "")
-
     # Store skill_result in context for build_rules
     context_with_skill = {**context, "skill_result": skill_result}
     rules = build_rules(context_with_skill)
 
     system_content = "\n\n".join(
         part for part in [
-            identity,
-            knowledge,
+            prefix,
             client_ctx,
             directive,
             funnel_inst,
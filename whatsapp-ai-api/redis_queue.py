@@ -4,6 +4,7 @@ Redis Queue - Sistema de cola para jobs en background
 import os
 import json
 import logging
+import time
 from datetime import datetime
 from typing import Optional, Dict, Any
 import redis
@@ -24,6 +25,73 @@ def get_redis() -> redis.Redis:
     return _redis_client
 
 
+# Cliente redis.asyncio por event loop (lock de conversación, coalescer)
+_redis_async: Dict[Any, Any] = {}
+_redis_async_caido_hasta = 0.0
+REDIS_REINTENTO_SECONDS = float(os.getenv("REDIS_REINTENTO_SECONDS", "30"))
+
+
+async def get_redis_async():
+    """Cliente redis.asyncio del event loop actual, reutilizado entre llamadas.
+
+    Se hace ping solo al crearlo. Retorna None si Redis no responde, y no se
+    reintenta conectar hasta pasados REDIS_REINTENTO_SECONDS."""
+    import asyncio
+    import redis.asyncio as aioredis
+
+    global _redis_async_caido_hasta
+    loop = asyncio.get_running_loop()
+    cliente = _redis_async.get(loop)
+    if cliente is not None:
+        return cliente
+    if time.monotonic() < _redis_async_caido_hasta:
+        return None
+
+    # Loops ya cerrados (tests, asyncio.run sucesivos) no se reusan
+    for viejo in [l for l in _redis_async if l.is_closed()]:
+        _redis_async.pop(viejo, None)
+    cliente = aioredis.from_url(REDIS_URL, decode_responses=True)
+    try:
+        await cliente.ping()
+    except Exception as e:
+        logger.warning(f"Redis no disponible: {e}")
+        _redis_async_caido_hasta = time.monotonic() + REDIS_REINTENTO_SECONDS
+        try:
+            await cliente.close()
+        except Exception:
+            pass
+        return None
+    _redis_async[loop] = cliente
+    return cliente
+
+
+# Locks con token: solo el dueño los libera (si el TTL venció y otra réplica
+# tomó el lock, un DEL incondicional le borraría el suyo)
+_LUA_LIBERAR_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def tomar_lock(llave: str, segundos: int) -> Optional[str]:
+    """SET NX EX con un token propio. Retorna el token, o None si está tomado."""
+    import uuid
+
+    token = uuid.uuid4().hex
+    return token if get_redis().set(llave, token, nx=True, ex=segundos) else None
+
+
+def liberar_lock(llave: str, token: str) -> bool:
+    """Liberar el lock solo si sigue siendo nuestro (compare-and-delete)."""
+    try:
+        return bool(get_redis().eval(_LUA_LIBERAR_LOCK, 1, llave, token))
+    except Exception as e:
+        logger.warning(f"Error liberando lock {llave}: {e}")
+        return False
+
+
 def encolar_job(job_id: int, tipo: str, datos: Dict[str, Any] = None) -> bool:
     """Encola un job para ser procesado por el worker"""
     try:
@@ -100,3 +168,140 @@ def health_check() -> bool:
     except Exception as e:
         logger.error(f"Redis health check failed: {e}")
         return False
+
+
+# ─── Cola durable de eventos entrantes (Redis Streams) ────────────────────
+# El webhook persiste el evento crudo del bridge y responde de inmediato; los
+# consumidores del worker (consumer group) corren el pipeline del agente.
+# Un evento solo se confirma (XACK) al terminar de procesarse, así que si un
+# consumidor muere a medias el evento queda pendiente y otro lo reclama.
+
+INBOUND_STREAM = "inbound_events"
+INBOUND_GROUP = "agent_workers"
+INBOUND_DEAD_LETTER = "inbound_events:dead"
+INBOUND_MAXLEN = int(os.getenv("INBOUND_STREAM_MAXLEN", "100000"))
+INBOUND_MAX_ENTREGAS = int(os.getenv("INBOUND_MAX_DELIVERIES", "3"))
+
+
+def asegurar_grupo_entrante() -> None:
+    """Crea el consumer group del stream de entrada si no existe"""
+    r = get_redis()
+    try:
+        r.xgroup_create(INBOUND_STREAM, INBOUND_GROUP, id="0", mkstream=True)
+        logger.info(f"Consumer group '{INBOUND_GROUP}' creado en '{INBOUND_STREAM}'")
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def encolar_evento_entrante(data: Dict[str, Any]) -> Optional[str]:
+    """Persiste un evento crudo del webhook en el stream. Retorna el id o None si falla."""
+    try:
+        r = get_redis()
+        event_id = r.xadd(
+            INBOUND_STREAM,
+            {
+                "data": json.dumps(data, ensure_ascii=False),
+                "recibido_at": datetime.utcnow().isoformat(),
+            },
+            maxlen=INBOUND_MAXLEN,
+            approximate=True,
+        )
+        return event_id
+    except Exception as e:
+        logger.error(f"Error encolando evento entrante: {e}")
+        return None
+
+
+def _decodificar_eventos(entries) -> list:
+    eventos = []
+    for event_id, fields in entries or []:
+        if not fields:
+            continue  # Entrada borrada por el trim del stream
+        try:
+            eventos.append((event_id, json.loads(fields.get("data", "{}"))))
+        except (json.JSONDecodeError, TypeError):
+            logger.error(f"Evento entrante {event_id} con JSON inválido, descartado")
+            confirmar_evento_entrante(event_id)
+    return eventos
+
+
+def leer_eventos_entrantes(consumidor: str, count: int = 10, block_ms: int = 5000) -> list:
+    """Lee eventos nuevos para este consumidor (bloquea hasta block_ms).
+    Retorna lista de (event_id, data)."""
+    try:
+        r = get_redis()
+        result = r.xreadgroup(
+            INBOUND_GROUP, consumidor, {INBOUND_STREAM: ">"}, count=count, block=block_ms
+        )
+        if not result:
+            return []
+        _, entries = result[0]
+        return _decodificar_eventos(entries)
+    except redis.ResponseError as e:
+        if "NOGROUP" in str(e):
+            asegurar_grupo_entrante()
+            return []
+        logger.error(f"Error leyendo eventos entrantes: {e}")
+        return []
+    except Exception as e:
+        logger.error(f"Error leyendo eventos entrantes: {e}")
+        return []
+
+
+def confirmar_evento_entrante(*event_ids: str) -> None:
+    """Confirma (XACK) y borra uno o más eventos ya procesados"""
+    if not event_ids:
+        return
+    try:
+        r = get_redis()
+        pipe = r.pipeline()
+        pipe.xack(INBOUND_STREAM, INBOUND_GROUP, *event_ids)
+        pipe.xdel(INBOUND_STREAM, *event_ids)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error confirmando eventos {', '.join(event_ids)}: {e}")
+
+
+def reclamar_eventos_huerfanos(consumidor: str, min_idle_ms: int = 60000, count: int = 10) -> list:
+    """Reclama eventos pendientes de consumidores caídos (XAUTOCLAIM).
+
+    Los eventos que ya superaron INBOUND_MAX_ENTREGAS se mueven al stream de
+    dead-letter para no reintentarlos en bucle."""
+    try:
+        r = get_redis()
+        result = r.xautoclaim(
+            INBOUND_STREAM, INBOUND_GROUP, consumidor, min_idle_time=min_idle_ms, count=count
+        )
+        entries = result[1] if result else []
+        if not entries:
+            return []
+
+        ids = [event_id for event_id, _ in entries]
+        entregas = {}
+        for p in r.xpending_range(INBOUND_STREAM, INBOUND_GROUP, min=ids[0], max=ids[-1], count=len(ids) * 2):
+            entregas[p["message_id"]] = p["times_delivered"]
+
+        vigentes = []
+        for event_id, fields in entries:
+            if entregas.get(event_id, 0) > INBOUND_MAX_ENTREGAS:
+                logger.error(f"Evento {event_id} superó {INBOUND_MAX_ENTREGAS} entregas, movido a dead-letter")
+                if fields:
+                    r.xadd(INBOUND_DEAD_LETTER, fields, maxlen=INBOUND_MAXLEN, approximate=True)
+                confirmar_evento_entrante(event_id)
+            else:
+                vigentes.append((event_id, fields))
+        return _decodificar_eventos(vigentes)
+    except Exception as e:
+        logger.error(f"Error reclamando eventos huérfanos: {e}")
+        return []
+
+
+def contar_eventos_entrantes_pendientes() -> int:
+    """Cuenta eventos en el stream aún sin confirmar"""
+    try:
+        r = get_redis()
+        return r.xlen(INBOUND_STREAM)
+    except Exception as e:
+        logger.error(f"Error contando eventos entrantes: {e}")
+        return 0
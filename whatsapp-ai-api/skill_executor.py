@@ -19,7 +19,6 @@ import time
 import unicodedata
 from typing import Any
 
-import httpx
 
 logger = logging.getLogger(__name__)
 
@@ -118,7 +117,7 @@ def skill_human_handoff(message: str, context: dict, db) -> dict:
     razon = context.get("razon", "Solicitud de atencion humana")
 
     try:
-        result_text = transferir_a_humano(telefono, razon, usuario_id=usuario_id)
+        result_text = transferir_a_humano(telefono, razon, usuario_id=usuario_id, db=db)
 
         MessageService.add_system_event(
             db,
@@ -153,7 +152,7 @@ def skill_data_capture(message: str, context: dict, db) -> dict:
     message for emails, phones, and names, then save whatever we find.
     """
     from capture_service import CaptureService
-    from lead_scoring import update_lead_score, update_lead_state
+    from lead_scoring import actualizar_lead
     from message_service import MessageService
 
     telefono = context["telefono"]
@@ -191,6 +190,7 @@ def skill_data_capture(message: str, context: dict, db) -> dict:
                     break
 
         events = []
+        saved = None
         if datos_extraidos:
             saved = CaptureService.save_captured_data(db, usuario_id, telefono, datos_extraidos)
             parts = [f"{k}: {v}" for k, v in datos_extraidos.items()]
@@ -204,14 +204,20 @@ def skill_data_capture(message: str, context: dict, db) -> dict:
                 usuario_id=usuario_id,
             )
             events.append({"type": "datos_guardados", "datos": datos_extraidos})
-            update_lead_score(db, telefono, usuario_id)
-            update_lead_state(db, telefono, usuario_id)
+            actualizar_lead(db, telefono, usuario_id)
 
         # ¿Datos mínimos completos? -> pasar a un humano (modelo de primer contacto)
-        obligatorios = [
-            f for f in CaptureService.get_fields(db, usuario_id) if f.get("obligatorio")
-        ]
-        pending = CaptureService.get_missing_fields(db, usuario_id, telefono)
+        snapshot = context.get("snapshot")
+        if snapshot is not None:
+            # Campos del snapshot del turno + lo que se acaba de guardar
+            capturados = saved if saved is not None else snapshot.datos_capturados
+            obligatorios = [f for f in snapshot.campos if f.get("obligatorio")]
+            pending = snapshot.campos_faltantes(capturados)
+        else:
+            obligatorios = [
+                f for f in CaptureService.get_fields(db, usuario_id) if f.get("obligatorio")
+            ]
+            pending = CaptureService.get_missing_fields(db, usuario_id, telefono)
         pending_names = [f["etiqueta"] for f in pending]
 
         if obligatorios and not pending:
@@ -219,7 +225,7 @@ def skill_data_capture(message: str, context: dict, db) -> dict:
             from agent import transferir_a_humano
 
             transferir_a_humano(
-                telefono, "Datos mínimos completos: lead calificado", usuario_id=usuario_id
+                telefono, "Datos mínimos completos: lead calificado", usuario_id=usuario_id, db=db
             )
             MessageService.add_system_event(
                 db,
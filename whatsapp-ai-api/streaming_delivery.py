@@ -0,0 +1,193 @@
+"""
+Streaming Delivery - Entrega progresiva de la respuesta del agente por WhatsApp
+
+Con `streaming_enabled` en el perfil, la completion se consume token a token y
+la respuesta sale en varios mensajes de WhatsApp a medida que se completan
+párrafos u oraciones: el contacto recibe la primera oración en lo que tarda en
+generarse, en vez de esperar la respuesta entera.
+
+  - DivisorFragmentos: corta el texto que va llegando en fragmentos enviables
+    (párrafos siempre; oraciones cuando el fragmento ya tiene un largo mínimo).
+  - EntregaProgresiva: envía cada fragmento, publica el texto parcial al
+    dashboard (evento WS "partial_message") y refresca el "escribiendo..."
+    mientras sigue la generación.
+
+El historial guarda la respuesta completa como un solo mensaje del asistente; los
+ecos de los fragmentos que devuelve el bridge se reconocen por su wa_id
+(es_fragmento_enviado) para no duplicarlos como mensajes del celular.
+"""
+
+import logging
+import re
+import time
+from typing import Dict, List
+
+from database import get_config
+
+logger = logging.getLogger(__name__)
+
+# Largo mínimo para cortar en fin de oración (los párrafos se cortan siempre).
+# El primer fragmento usa un mínimo menor: prima el tiempo al primer mensaje.
+MIN_CARACTERES_PRIMERO = 20
+MIN_CARACTERES = 120
+# Los ecos de WhatsApp llegan en segundos; el registro vive un poco más.
+_TTL_FRAGMENTO_SEGUNDOS = 300
+
+_FIN_PARRAFO = re.compile(r"\n\s*\n")
+# Fin de oración seguido de espacio y de algo que abre otra oración (evita
+# cortar en "1.5", "Sr. pérez" o URLs).
+_FIN_ORACION = re.compile(r"[.!?…][\"')\]]*\s+(?=[A-ZÁÉÍÓÚÑ¿¡\d*•\-\U0001F300-\U0001FAFF])")
+
+_fragmentos_locales: Dict[str, float] = {}
+
+
+def streaming_habilitado(usuario_id: int, perfil_id: int = None) -> bool:
+    return get_config("streaming_enabled", "false", usuario_id=usuario_id, perfil_id=perfil_id).lower() == "true"
+
+
+class DivisorFragmentos:
+    """Acumula deltas del stream y devuelve los fragmentos ya listos para enviar."""
+
+    def __init__(self, min_primero: int = MIN_CARACTERES_PRIMERO, min_resto: int = MIN_CARACTERES):
+        self.min_primero = min_primero
+        self.min_resto = min_resto
+        self._buffer = ""
+        self._emitidos = 0
+
+    def agregar(self, delta: str) -> List[str]:
+        self._buffer += delta or ""
+        listos = []
+        while True:
+            corte = self._buscar_corte()
+            if corte is None:
+                break
+            fragmento, self._buffer = self._buffer[:corte].strip(), self._buffer[corte:].lstrip()
+            if fragmento:
+                listos.append(fragmento)
+                self._emitidos += 1
+        return listos
+
+    def cerrar(self) -> List[str]:
+        resto, self._buffer = self._buffer.strip(), ""
+        if resto:
+            self._emitidos += 1
+            return [resto]
+        return []
+
+    def _buscar_corte(self):
+        minimo = self.min_primero if self._emitidos == 0 else self.min_resto
+        parrafo = _FIN_PARRAFO.search(self._buffer)
+        if parrafo and parrafo.start() > 0:
+            return parrafo.end()
+        # Último fin de oración que deja un fragmento de al menos `minimo`
+        corte = None
+        for m in _FIN_ORACION.finditer(self._buffer):
+            if m.end() >= minimo:
+                corte = m.end()
+                if self._emitidos == 0:
+                    break
+        return corte
+
+
+# ─── Registro de fragmentos enviados (para reconocer sus ecos) ───────────
+
+
+def _llave_fragmento(usuario_id: int, wa_id: str) -> str:
+    return f"stream:fragmento:{usuario_id}:{wa_id}"
+
+
+def registrar_fragmento_enviado(usuario_id: int, wa_id: str) -> None:
+    from message_service import normalizar_wa_id
+
+    wa_id = normalizar_wa_id(wa_id)
+    if not wa_id:
+        return
+    try:
+        from redis_queue import get_redis
+
+        get_redis().set(_llave_fragmento(usuario_id, wa_id), "1", ex=_TTL_FRAGMENTO_SEGUNDOS)
+        return
+    except Exception:
+        pass
+    ahora = time.monotonic()
+    for llave, expira in list(_fragmentos_locales.items()):
+        if expira < ahora:
+            _fragmentos_locales.pop(llave, None)
+    _fragmentos_locales[_llave_fragmento(usuario_id, wa_id)] = ahora + _TTL_FRAGMENTO_SEGUNDOS
+
+
+def es_fragmento_enviado(usuario_id: int, wa_id: str) -> bool:
+    """True si el wa_id es de un fragmento que mandó la entrega progresiva."""
+    from message_service import normalizar_wa_id
+
+    wa_id = normalizar_wa_id(wa_id)
+    if not wa_id:
+        return False
+    llave = _llave_fragmento(usuario_id, wa_id)
+    try:
+        from redis_queue import get_redis
+
+        if get_redis().exists(llave):
+            return True
+    except Exception:
+        pass
+    return _fragmentos_locales.get(llave, 0) > time.monotonic()
+
+
+# ─── Entrega ─────────────────────────────────────────────────────────────
+
+
+class EntregaProgresiva:
+    """Callback de agent.responder_async: se invoca con cada fragmento listo."""
+
+    def __init__(self, usuario_id: int, perfil_id: int, telefono: str, nombre: str = ""):
+        self.usuario_id = usuario_id
+        self.perfil_id = perfil_id
+        self.telefono = telefono
+        self.nombre = nombre
+        self.session = f"perfil_{perfil_id}" if perfil_id else "default"
+        self.enviados: List[str] = []
+        self.fallidos: List[str] = []
+        self.wa_ids: List[str] = []
+
+    async def __call__(self, fragmento: str, final: bool = False) -> None:
+        from whatsapp_service import whatsapp_service
+        from ws_manager import ws_manager
+        from metrics import etapa
+
+        if not whatsapp_service.is_configured():
+            return
+        with etapa("envio_fragmento", self.usuario_id):
+            result = await whatsapp_service.send_message(self.telefono, fragmento, session=self.session)
+        if not result.get("success"):
+            logger.error(f"Error enviando fragmento a {self.telefono}: {result.get('error')}")
+            self.fallidos.append(fragmento)
+            return
+
+        self.enviados.append(fragmento)
+        wa_id = (result.get("data") or {}).get("id")
+        if wa_id:
+            self.wa_ids.append(wa_id)
+            registrar_fragmento_enviado(self.usuario_id, wa_id)
+
+        await ws_manager.broadcast_to_perfil(
+            self.usuario_id,
+            self.perfil_id,
+            "partial_message",
+            {
+                "telefono": self.telefono,
+                "nombre": self.nombre,
+                "mensaje": "\n\n".join(self.enviados)[:2000],
+                "rol": "assistant",
+            },
+        )
+        if not final:
+            # Enviar un fragmento corta el "escribiendo..." del chat: renovarlo ya
+            whatsapp_service.send_typing_sin_esperar(self.telefono, session=self.session)
+
+    async def reintentar_fallidos(self) -> None:
+        """Un reintento, en un solo mensaje, de los fragmentos que no salieron."""
+        if not self.fallidos:
+            return
+        pendientes, self.fallidos = self.fallidos, []
+        await self("\n\n".join(pendientes), final=True)
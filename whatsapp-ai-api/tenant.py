@@ -2,19 +2,170 @@
 Tenant utilities for multi-tenancy support.
 Resolves which user owns a phone contact and provides user-scoped helpers.
 """
+import asyncio
 import logging
+import os
+import time
+from typing import Optional
 from sqlalchemy.orm import Session
 from models import Contacto, MensajeConversacion, Perfil
 
 logger = logging.getLogger(__name__)
 
 
-def resolver_perfil_por_session(session_name: str, db: Session):
+# ─── Tabla de ruteo en memoria ───────────────────────────────────────────
+#
+# perfil_id -> usuario_id y usuario_id -> perfil activo, cargadas de una vez.
+# Cada evento del webhook (incluido typing) rutea con un lookup en dict.
+# Coherencia entre procesos: perfiles.py llama invalidar_tabla_ruteo() al
+# crear/borrar/activar, que incrementa un contador de versión en Redis; en cada
+# proceso la task vigilar_tabla_ruteo (cliente async) lo consulta cada
+# ROUTING_VERSION_CHECK_SECONDS y recarga en un thread si cambió. El camino del
+# webhook nunca toca Redis; sin el vigilante (o sin Redis) se recarga por TTL.
+
+ROUTING_VERSION_KEY = "tenant:routing:version"
+ROUTING_VERSION_CHECK_SECONDS = float(os.getenv("ROUTING_VERSION_CHECK_SECONDS", "2"))
+ROUTING_TTL_SIN_REDIS = 60
+
+_perfil_a_usuario: dict = {}
+_perfil_activo_por_usuario: dict = {}
+_ruteo = {"cargada": False, "version": None, "cargada_ts": 0.0, "vigilada_ts": 0.0}
+_tareas: set = set()
+
+
+def cargar_tabla_ruteo(db: Session = None, version: str = None) -> None:
+    """(Re)cargar la tabla de ruteo completa con una sola consulta.
+
+    `version`: la versión de Redis que refleja esta carga (la pasa el vigilante)."""
+    from models import SessionLocal
+
+    cerrar = db is None
+    if db is None:
+        db = SessionLocal()
+    try:
+        filas = (
+            db.query(Perfil.id, Perfil.usuario_id, Perfil.es_activo)
+            .order_by(Perfil.created_at)
+            .all()
+        )
+    finally:
+        if cerrar:
+            db.close()
+
+    perfiles = {}
+    activos = {}
+    for perfil_id, usuario_id, es_activo in filas:
+        perfiles[perfil_id] = usuario_id
+        # Activo explícito, si no el primero creado (mismo criterio que get_perfil_activo_id)
+        if es_activo:
+            activos[usuario_id] = perfil_id
+        else:
+            activos.setdefault(usuario_id, perfil_id)
+
+    global _perfil_a_usuario, _perfil_activo_por_usuario
+    _perfil_a_usuario = perfiles
+    _perfil_activo_por_usuario = activos
+    _ruteo["cargada"] = True
+    _ruteo["cargada_ts"] = time.monotonic()
+    if version is not None:
+        _ruteo["version"] = version
+    logger.info(f"Tabla de ruteo cargada: {len(perfiles)} perfiles")
+
+
+async def vigilar_tabla_ruteo() -> None:
+    """Task de fondo (API y worker): recargar la tabla cuando otro proceso la invalidó."""
+    from redis_queue import get_redis_async
+
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            r = await get_redis_async()
+            if r is not None:
+                version = await r.get(ROUTING_VERSION_KEY)
+                _ruteo["vigilada_ts"] = time.monotonic()
+                if version != _ruteo["version"]:
+                    await loop.run_in_executor(None, cargar_tabla_ruteo, None, version)
+        except Exception as e:
+            logger.warning(f"Error consultando versión de ruteo: {e}")
+        await asyncio.sleep(ROUTING_VERSION_CHECK_SECONDS)
+
+
+async def _publicar_version_async() -> None:
+    from redis_queue import get_redis_async
+
+    try:
+        r = await get_redis_async()
+        if r is not None:
+            await r.incr(ROUTING_VERSION_KEY)
+            return
+    except Exception as e:
+        logger.warning(f"No se pudo publicar versión de ruteo: {e}")
+        return
+    logger.warning("No se pudo publicar versión de ruteo: Redis no disponible")
+
+
+def _publicar_version() -> None:
+    """INCR de la versión: async si hay event loop (no bloquear el handler)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        tarea = loop.create_task(_publicar_version_async())
+        _tareas.add(tarea)
+        tarea.add_done_callback(_tareas.discard)
+        return
+    try:
+        from redis_queue import get_redis
+
+        get_redis().incr(ROUTING_VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"No se pudo publicar versión de ruteo: {e}")
+
+
+def invalidar_tabla_ruteo(db: Session = None) -> None:
+    """Llamar tras crear/borrar/activar un perfil: recarga local y avisa al resto."""
+    _publicar_version()
+    try:
+        cargar_tabla_ruteo(db)
+    except Exception as e:
+        logger.warning(f"Error recargando tabla de ruteo: {e}")
+        _ruteo["cargada"] = False
+
+
+def _asegurar_tabla_ruteo() -> bool:
+    """Cargar la tabla si hace falta. Sin vigilante activo (o sin Redis) se
+    recarga cada ROUTING_TTL_SIN_REDIS segundos. No toca Redis."""
+    ahora = time.monotonic()
+    try:
+        if not _ruteo["cargada"]:
+            cargar_tabla_ruteo()
+            return True
+        vigilada = ahora - _ruteo["vigilada_ts"] < ROUTING_VERSION_CHECK_SECONDS * 3
+        if not vigilada and ahora - _ruteo["cargada_ts"] > ROUTING_TTL_SIN_REDIS:
+            cargar_tabla_ruteo()
+        return True
+    except Exception as e:
+        logger.warning(f"Tabla de ruteo no disponible: {e}")
+        return _ruteo["cargada"]
+
+
+def perfil_activo_cacheado(usuario_id: int) -> Optional[int]:
+    """Perfil activo del usuario desde la tabla de ruteo (None si no se conoce)."""
+    if usuario_id is None or not _asegurar_tabla_ruteo():
+        return None
+    return _perfil_activo_por_usuario.get(usuario_id)
+
+
+def resolver_perfil_por_session(session_name: str, db: Session = None):
     """Resolve (usuario_id, perfil_id) from the bridge session name "perfil_<id>".
 
     This is the authoritative routing: an incoming message arrived on the
     WhatsApp session of a specific profile, so it belongs to that profile and
     its owner. Returns (None, None) if the session name is not a valid profile.
+
+    Se resuelve desde la tabla de ruteo en memoria; solo un perfil que aún no
+    está en la tabla (creado en otro proceso hace instantes) consulta la DB.
     """
     if not session_name or not session_name.startswith("perfil_"):
         return None, None
@@ -22,10 +173,24 @@ def resolver_perfil_por_session(session_name: str, db: Session):
         perfil_id = int(session_name.split("_", 1)[1])
     except (ValueError, IndexError):
         return None, None
-    perfil = db.query(Perfil).filter(Perfil.id == perfil_id).first()
-    if not perfil:
-        return None, None
-    return perfil.usuario_id, perfil.id
+
+    if _asegurar_tabla_ruteo():
+        usuario_id = _perfil_a_usuario.get(perfil_id)
+        if usuario_id is not None:
+            return usuario_id, perfil_id
+
+    if db is None:
+        from models import SessionLocal
+
+        with SessionLocal() as _db:
+            perfil = _db.query(Perfil).filter(Perfil.id == perfil_id).first()
+            resultado = (perfil.usuario_id, perfil.id) if perfil else (None, None)
+    else:
+        perfil = db.query(Perfil).filter(Perfil.id == perfil_id).first()
+        resultado = (perfil.usuario_id, perfil.id) if perfil else (None, None)
+    if resultado[0] is not None:
+        _perfil_a_usuario[perfil_id] = resultado[0]
+    return resultado
 
 
 def resolver_usuario_por_telefono(telefono: str, db: Session) -> int:
@@ -0,0 +1,116 @@
+"""
+Test del pool del agente (agent_executor): round-robin por tenant y admisión.
+No necesita base de datos ni API key.
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_executor import AgentExecutor, AgenteSaturado
+
+
+def _turno(orden, nombre):
+    orden.append(nombre)
+    return nombre
+
+
+def test_round_robin():
+    """Un tenant con varios turnos en cola no acapara el único thread"""
+    print("\n=== TEST 1: Round-robin ===")
+
+    async def correr():
+        ex = AgentExecutor(max_workers=1, max_cola=10, max_por_tenant=10, modo="defer")
+        orden = []
+        tareas = [
+            asyncio.create_task(ex.ejecutar(usuario, _turno, orden, nombre))
+            for usuario, nombre in (("A", "a1"), ("A", "a2"), ("A", "a3"), ("B", "b1"))
+        ]
+        resultados = await asyncio.gather(*tareas)
+        assert resultados == ["a1", "a2", "a3", "b1"]
+        # b1 no espera a que A vacíe su cola
+        assert orden.index("b1") < orden.index("a3"), orden
+        assert ex.estado()["en_vuelo"] == 0 and ex.estado()["en_cola"] == 0
+        return orden
+
+    orden = asyncio.run(correr())
+    print(f"✅ Orden de ejecución: {orden}")
+    return True
+
+
+def test_limite_por_tenant():
+    """Sin esperar, el turno que excede el límite del tenant se rechaza"""
+    print("\n=== TEST 2: Límite por tenant ===")
+
+    async def correr():
+        ex = AgentExecutor(max_workers=4, max_cola=10, max_por_tenant=1, modo="defer")
+        orden = []
+        primero = asyncio.create_task(ex.ejecutar(1, _turno, orden, "uno"))
+        await asyncio.sleep(0)
+        assert ex.saturado(1) == "tenant"
+        try:
+            await ex.ejecutar(1, _turno, orden, "dos")
+            assert False, "debió lanzar AgenteSaturado"
+        except AgenteSaturado as e:
+            assert e.usuario_id == 1 and e.motivo == "tenant"
+        # Otro tenant sí entra
+        assert await ex.ejecutar(2, _turno, orden, "otro") == "otro"
+        await primero
+        assert ex.saturado(1) is None
+
+    asyncio.run(correr())
+    print("✅ Rechazo por tenant y liberación al terminar")
+    return True
+
+
+def test_cola_llena_y_modo_wait():
+    """Con la cola llena se rechaza; en modo 'wait' se encola igual"""
+    print("\n=== TEST 3: Cola llena / wait ===")
+
+    async def correr():
+        for modo in ("reject", "wait"):
+            ex = AgentExecutor(max_workers=1, max_cola=1, max_por_tenant=10, modo=modo)
+            orden = []
+            tareas = [asyncio.create_task(ex.ejecutar(u, _turno, orden, u)) for u in ("a", "b")]
+            await asyncio.sleep(0)
+            assert ex.saturado("c") == "cola"
+            if modo == "wait":
+                assert await ex.ejecutar("c", _turno, orden, "c") == "c"
+            else:
+                try:
+                    await ex.ejecutar("c", _turno, orden, "c")
+                    assert False, "debió lanzar AgenteSaturado"
+                except AgenteSaturado as e:
+                    assert e.motivo == "cola"
+            await asyncio.gather(*tareas)
+
+    asyncio.run(correr())
+    print("✅ 'reject' rechaza, 'wait' encola")
+    return True
+
+
+def test_modo_invalido():
+    """Un AGENT_OVERLOAD_MODE desconocido cae en 'defer'"""
+    print("\n=== TEST 4: Modo inválido ===")
+    ex = AgentExecutor(max_workers=1, max_cola=1, max_por_tenant=1, modo="cualquiera")
+    assert ex.modo == "defer"
+    print("✅ Modo por defecto: defer")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Round-robin", test_round_robin()),
+        ("Límite por tenant", test_limite_por_tenant()),
+        ("Cola llena / wait", test_cola_llena_y_modo_wait()),
+        ("Modo inválido", test_modo_invalido()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,85 @@
+"""
+Test de la ventana de historial acotada por tokens (history_window).
+No necesita base de datos ni API key.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_window import (
+    MENSAJES_RECIENTES,
+    armar_ventana,
+    estimar_tokens,
+    mensaje_resumen,
+    necesita_resumen,
+)
+
+
+def _msg(i, largo=40):
+    rol = "user" if i % 2 == 0 else "assistant"
+    return {"role": rol, "content": f"{i:03d} " + "x" * largo}
+
+
+def test_ventana_entra_en_presupuesto():
+    """Se toman los mensajes más nuevos que entran, en orden cronológico"""
+    print("\n=== TEST 1: Presupuesto ===")
+    mensajes = [_msg(i) for i in range(20)]
+    costo = estimar_tokens(mensajes[0]["content"])
+    ventana = armar_ventana(mensajes, presupuesto=costo * 5)
+    assert ventana == mensajes[-5:]
+    # Todo entra: sin recortes
+    assert armar_ventana(mensajes, presupuesto=10_000) == mensajes
+    print(f"✅ {len(ventana)} mensajes en {costo * 5} tokens")
+    return True
+
+
+def test_ultimo_mensaje_siempre():
+    """El último mensaje va aunque solo él supere el presupuesto"""
+    print("\n=== TEST 2: Último mensaje ===")
+    mensajes = [_msg(0), _msg(1, largo=4000)]
+    assert armar_ventana(mensajes, presupuesto=10) == mensajes[-1:]
+    assert armar_ventana([], presupuesto=10) == []
+    print("✅ Último mensaje incluido")
+    return True
+
+
+def test_resumen_primero_y_descontado():
+    """El resumen va primero y su costo sale del mismo presupuesto"""
+    print("\n=== TEST 3: Resumen ===")
+    mensajes = [_msg(i) for i in range(20)]
+    resumen = "El cliente pidio 3 remeras talle M y pregunto por envio."
+    costo_msg = estimar_tokens(mensajes[0]["content"])
+    costo_resumen = estimar_tokens(mensaje_resumen(resumen)["content"])
+    ventana = armar_ventana(mensajes, presupuesto=costo_resumen + costo_msg * 3, resumen=resumen)
+    assert ventana[0] == mensaje_resumen(resumen)
+    assert ventana[1:] == mensajes[-3:]
+    print("✅ Resumen + 3 mensajes")
+    return True
+
+
+def test_necesita_resumen():
+    """Se resume cuando hay `cada` mensajes además de los recientes"""
+    print("\n=== TEST 4: Necesita resumen ===")
+    assert not necesita_resumen(MENSAJES_RECIENTES + 9, cada=10)
+    assert necesita_resumen(MENSAJES_RECIENTES + 10, cada=10)
+    assert not necesita_resumen(0, cada=1)
+    print("✅ Umbral correcto")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Presupuesto", test_ventana_entra_en_presupuesto()),
+        ("Último mensaje", test_ultimo_mensaje_siempre()),
+        ("Resumen", test_resumen_primero_y_descontado()),
+        ("Necesita resumen", test_necesita_resumen()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
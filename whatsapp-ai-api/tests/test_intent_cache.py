@@ -0,0 +1,108 @@
+"""
+Test del caché de clasificación de intención (intent_cache), solo nivel local.
+No necesita base de datos, Redis ni API key.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["INTENT_CACHE_REDIS"] = "false"
+
+import intent_cache
+from intent_cache import cacheable, clave, guardar, limpiar, obtener
+
+DECISION = {"skill": "faq", "trigger": None}
+
+
+def _clave(mensaje="hola", usuario_id=1, perfil_id=None, skills=("faq", "ventas"), intenciones=(), huella="-"):
+    return clave(usuario_id, perfil_id, mensaje, skills, intenciones, huella)
+
+
+def test_clave():
+    """La clave separa tenants/perfiles y cambia con skills, triggers y contexto"""
+    print("\n=== TEST 1: Clave ===")
+    base = _clave()
+    assert base == _clave(mensaje="hola ") == _clave(skills=("ventas", "faq"))
+    assert base.startswith("intent:1:0:")
+    distintas = {
+        _clave(usuario_id=2),
+        _clave(perfil_id=7),
+        _clave(mensaje="chau"),
+        _clave(skills=("faq",)),
+        _clave(skills=None),
+        _clave(intenciones=("pagar",)),
+        _clave(huella="pendientes"),
+    }
+    assert base not in distintas and len(distintas) == 7
+    assert cacheable("hola") and not cacheable("") and not cacheable("x" * 500)
+    print("✅ Claves distintas por cada dimensión")
+    return True
+
+
+def test_hit_y_copia():
+    """Un hit devuelve una copia: modificarla no ensucia el caché"""
+    print("\n=== TEST 2: Hit ===")
+    limpiar()
+    llave = _clave()
+    assert obtener(llave, 1) is None
+    guardar(llave, DECISION)
+    decision = obtener(llave, 1)
+    assert decision == DECISION
+    decision["skill"] = "otra"
+    assert obtener(llave, 1) == DECISION
+    print("✅ Hit local sin aliasing")
+    return True
+
+
+def test_ttl():
+    """Una entrada vencida cuenta como miss y se descarta"""
+    print("\n=== TEST 3: TTL ===")
+    limpiar()
+    ttl = intent_cache.INTENT_CACHE_TTL_SECONDS
+    intent_cache.INTENT_CACHE_TTL_SECONDS = -1
+    try:
+        guardar(_clave(), DECISION)
+    finally:
+        intent_cache.INTENT_CACHE_TTL_SECONDS = ttl
+    assert obtener(_clave(), 1) is None
+    assert _clave() not in intent_cache._entradas
+    print("✅ Entrada vencida descartada")
+    return True
+
+
+def test_lru():
+    """Al pasar el tope se descarta la menos usada recientemente"""
+    print("\n=== TEST 4: LRU ===")
+    limpiar()
+    tope = intent_cache.INTENT_CACHE_SIZE
+    intent_cache.INTENT_CACHE_SIZE = 2
+    try:
+        a, b, c = _clave("a"), _clave("b"), _clave("c")
+        guardar(a, DECISION)
+        guardar(b, DECISION)
+        assert obtener(a, 1) is not None  # 'a' pasa a ser la más reciente
+        guardar(c, DECISION)
+        assert obtener(b, 1) is None
+        assert obtener(a, 1) is not None and obtener(c, 1) is not None
+    finally:
+        intent_cache.INTENT_CACHE_SIZE = tope
+        limpiar()
+    print("✅ Se descartó la menos reciente")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Clave", test_clave()),
+        ("Hit", test_hit_y_copia()),
+        ("TTL", test_ttl()),
+        ("LRU", test_lru()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,90 @@
+"""
+Test del KeywordMatcher: límites de palabra, acentos, frases y prioridades.
+No necesita base de datos ni API key.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keyword_matcher import KeywordMatcher, normalizar
+
+
+def _etiquetas(matcher, texto):
+    return [c.etiqueta for c in matcher.buscar(normalizar(texto))]
+
+
+def test_limites_de_palabra():
+    """Una keyword no coincide dentro de otra palabra"""
+    print("\n=== TEST 1: Límites de palabra ===")
+    m = KeywordMatcher([("asesor", "handoff", 0)])
+    assert _etiquetas(m, "Quiero un asesor") == ["handoff"]
+    assert _etiquetas(m, "Asesor, por favor!") == ["handoff"]
+    assert _etiquetas(m, "Busco asesoria legal") == []
+    print("✅ 'asesor' no coincide en 'asesoria'")
+    return True
+
+
+def test_acentos_y_espacios():
+    """Acentos y blancos repetidos no impiden la coincidencia"""
+    print("\n=== TEST 2: Acentos y espacios ===")
+    m = KeywordMatcher([("devolución", "queja", 0), ("hablar con humano", "handoff", 0)])
+    assert _etiquetas(m, "Quiero una DEVOLUCION") == ["queja"]
+    assert _etiquetas(m, "necesito hablar   con  humano") == ["handoff"]
+    print("✅ Normalización de acentos y blancos")
+    return True
+
+
+def test_frases_no_sueltas():
+    """Una frase solo coincide con sus palabras juntas y en orden"""
+    print("\n=== TEST 3: Frases ===")
+    m = KeywordMatcher([("persona real", "handoff", 0)])
+    assert _etiquetas(m, "eres una persona real?") == ["handoff"]
+    assert _etiquetas(m, "la persona dijo que es real") == []
+    print("✅ Frases no coinciden por palabras sueltas")
+    return True
+
+
+def test_superpuestas_y_prioridad():
+    """Coincidencias superpuestas se encuentran todas, ordenadas por prioridad"""
+    print("\n=== TEST 4: Superpuestas y prioridad ===")
+    m = KeywordMatcher([
+        ("quiero hablar con", "skill", 5),
+        ("hablar con alguien", "trigger", 1),
+        ("no sirve", "frustracion", 2),
+        ("no sirves", "complejidad", 3),
+    ])
+    assert _etiquetas(m, "quiero hablar con alguien") == ["trigger", "skill"]
+    assert _etiquetas(m, "no sirves para nada") == ["complejidad"]
+    assert _etiquetas(m, "esto no sirve") == ["frustracion"]
+    print("✅ Superpuestas encontradas y prioridad respetada")
+    return True
+
+
+def test_varias_etiquetas():
+    """La misma keyword puede tener varias etiquetas"""
+    print("\n=== TEST 5: Varias etiquetas ===")
+    m = KeywordMatcher([("asesor", "skill", 9), ("Asesor", "trigger", 1), ("", "vacia", 0)])
+    assert len(m) == 1
+    assert _etiquetas(m, "un asesor") == ["trigger", "skill"]
+    assert KeywordMatcher([]).buscar("hola") == []
+    print("✅ Etiquetas múltiples y matcher vacío")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Límites de palabra", test_limites_de_palabra()),
+        ("Acentos y espacios", test_acentos_y_espacios()),
+        ("Frases", test_frases_no_sueltas()),
+        ("Superpuestas y prioridad", test_superpuestas_y_prioridad()),
+        ("Varias etiquetas", test_varias_etiquetas()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,146 @@
+"""
+Test de llm_resilience: circuit breaker, hedging y orden de respaldo.
+No necesita base de datos ni API key (cliente OpenAI falso).
+"""
+import sys
+import os
+import asyncio
+import time
+from types import ModuleType, SimpleNamespace
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_resilience
+from llm_resilience import CircuitBreaker, LLMNoDisponible, _con_hedge, completar, completar_async
+
+# Sin ledger de uso: el test no escribe en la base
+llm_resilience._anotar_uso = lambda *args, **kwargs: None
+llm_resilience._anotar_hedge = lambda *args, **kwargs: None
+
+
+class ClienteFalso:
+    """chat.completions.create según el modelo: 'caido' falla, 'lento' tarda."""
+
+    def __init__(self, demoras=None):
+        self.llamadas = []
+        self.demoras = list(demoras or [])
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._crear))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _responder(self, params):
+        self.llamadas.append(params["model"])
+        if params["model"] == "caido":
+            raise asyncio.TimeoutError()
+        return SimpleNamespace(model=params["model"], n=len(self.llamadas), usage=None)
+
+    def _crear(self, **params):
+        if self.demoras:
+            return self._crear_async(params, self.demoras.pop(0))
+        return self._responder(params)
+
+    async def _crear_async(self, params, demora):
+        await asyncio.sleep(demora)
+        return self._responder(params)
+
+
+def _usar_cliente(cliente):
+    falso = ModuleType("openai_clients")
+    falso.obtener_cliente = lambda api_key: cliente
+    falso.obtener_cliente_async = lambda api_key: cliente
+    sys.modules["openai_clients"] = falso
+
+
+def test_breaker():
+    """Abre tras N fallos, deja pasar una sola prueba y se cierra con un éxito"""
+    print("\n=== TEST 1: Circuit breaker ===")
+    breaker = CircuitBreaker()
+    for _ in range(llm_resilience.LLM_BREAKER_FALLOS):
+        assert breaker.permite()
+        breaker.fallo()
+    assert not breaker.permite()
+    breaker.abierto_hasta = time.monotonic() - 1  # pasó el enfriamiento
+    assert breaker.permite()
+    assert not breaker.permite()  # una sola petición de prueba
+    breaker.exito()
+    assert breaker.permite() and breaker.fallos == 0
+    print("✅ Cerrado -> abierto -> medio abierto -> cerrado")
+    return True
+
+
+def test_hedge():
+    """Si la primera tarda, la segunda gana y se informa la duplicada"""
+    print("\n=== TEST 2: Hedging ===")
+    params = {"model": "principal"}
+
+    async def correr():
+        lento = ClienteFalso(demoras=[1.0, 0.0])
+        respuesta, duplicadas = await _con_hedge(lento, "hedge_test", params, limite=0.4, hedge=True)
+        assert respuesta.n == 1 and duplicadas == 1 and lento.llamadas == ["principal"]
+
+        rapido = ClienteFalso(demoras=[0.0])
+        respuesta, duplicadas = await _con_hedge(rapido, "hedge_test", params, limite=0.4, hedge=True)
+        assert duplicadas == 0 and rapido.llamadas == ["principal"]
+
+        try:
+            await _con_hedge(ClienteFalso(demoras=[1.0]), "hedge_test", params, limite=0.2, hedge=False)
+            assert False, "debió vencer el deadline"
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(correr())
+    print("✅ Hedge solo cuando hace falta, deadline respetado")
+    return True
+
+
+def test_respaldo():
+    """Principal caído: responde el respaldo; con el breaker abierto ni se intenta"""
+    print("\n=== TEST 3: Respaldo ===")
+    cliente = ClienteFalso()
+    _usar_cliente(cliente)
+    for _ in range(llm_resilience.LLM_BREAKER_FALLOS):
+        respuesta = completar("respaldo_test", api_key="k-respaldo", fallback_model="respaldo", model="caido")
+        assert respuesta.model == "respaldo"
+    cliente.llamadas.clear()
+    respuesta = completar("respaldo_test", api_key="k-respaldo", fallback_model="respaldo", model="caido")
+    assert respuesta.model == "respaldo" and cliente.llamadas == ["respaldo"]
+
+    try:
+        completar("respaldo_test", api_key="k-sin-respaldo", fallback_model="caido", model="caido")
+        assert False, "debió lanzar LLMNoDisponible"
+    except LLMNoDisponible:
+        pass
+    print("✅ Orden principal -> respaldo, breaker salta el caído")
+    return True
+
+
+def test_respaldo_async():
+    """Mismo orden en completar_async (sin hedging)"""
+    print("\n=== TEST 4: Respaldo async ===")
+    cliente = ClienteFalso(demoras=[0.0, 0.0])
+    _usar_cliente(cliente)
+    llm_resilience.LLM_HEDGING = False
+    respuesta = asyncio.run(
+        completar_async("respaldo_async_test", api_key="k-async", fallback_model="respaldo", model="caido")
+    )
+    assert respuesta.model == "respaldo" and cliente.llamadas == ["caido", "respaldo"]
+    print("✅ Respaldo async")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Circuit breaker", test_breaker()),
+        ("Hedging", test_hedge()),
+        ("Respaldo", test_respaldo()),
+        ("Respaldo async", test_respaldo_async()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
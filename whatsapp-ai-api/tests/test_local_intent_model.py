@@ -0,0 +1,90 @@
+"""
+Test del modelo local de intención (Naive Bayes de local_intent_model).
+No necesita base de datos ni API key.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_intent_model import ClasificadorNB, evaluar
+
+EJEMPLOS = [
+    ("hola", "free_chat"),
+    ("hola buenas tardes", "free_chat"),
+    ("buenos dias", "free_chat"),
+    ("gracias", "free_chat"),
+    ("muchas gracias", "free_chat"),
+    ("ok gracias", "free_chat"),
+    ("a que hora abren", "faq"),
+    ("a que hora cierran", "faq"),
+    ("aceptan tarjeta", "faq"),
+    ("aceptan transferencia", "faq"),
+    ("tienen envio a domicilio", "faq"),
+    ("hacen envios", "faq"),
+]
+
+
+def test_predice_lo_aprendido():
+    """Predice la clase de mensajes vistos y de variantes con typos"""
+    print("\n=== TEST 1: Predicción ===")
+    modelo = ClasificadorNB.entrenar(EJEMPLOS)
+    assert modelo.predecir("hola")[0] == "free_chat"
+    assert modelo.predecir("holaa buenas")[0] == "free_chat"
+    assert modelo.predecir("a que hora abren el sabado")[0] == "faq"
+    skill, probabilidad = modelo.predecir("aceptan tarjeta?")
+    assert skill == "faq" and 0.5 < probabilidad <= 1.0
+    print("✅ Predicciones correctas")
+    return True
+
+
+def test_texto_desconocido():
+    """Sin ninguna característica conocida no hay predicción"""
+    print("\n=== TEST 2: Texto desconocido ===")
+    modelo = ClasificadorNB.entrenar(EJEMPLOS)
+    assert modelo.predecir("zzz") is None
+    assert modelo.predecir("") is None
+    assert ClasificadorNB().predecir("hola") is None
+    print("✅ Sin predicción para texto desconocido o modelo vacío")
+    return True
+
+
+def test_serializacion():
+    """El modelo sobrevive un viaje por JSON"""
+    print("\n=== TEST 3: Serialización ===")
+    modelo = ClasificadorNB.entrenar(EJEMPLOS)
+    copia = ClasificadorNB.from_json(modelo.to_json())
+    for texto in ("hola", "hacen envios a domicilio", "gracias"):
+        assert copia.predecir(texto) == modelo.predecir(texto)
+    print("✅ Mismas predicciones tras JSON")
+    return True
+
+
+def test_evaluacion():
+    """La exactitud se mide sobre ejemplos separados del entrenamiento"""
+    print("\n=== TEST 4: Evaluación ===")
+    exactitud = evaluar(EJEMPLOS * 3, cada=4)
+    assert exactitud is not None and 0.0 <= exactitud <= 1.0
+    assert evaluar([]) is None
+    # Repetidos: el ejemplo de prueba no puede estar también en entrenamiento
+    repetidos = [("hola", "free_chat"), ("palabra rara", "faq")] * 5
+    assert evaluar(repetidos, cada=3) == 0.0
+    print(f"✅ Exactitud: {exactitud:.0%}")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Predicción", test_predice_lo_aprendido()),
+        ("Texto desconocido", test_texto_desconocido()),
+        ("Serialización", test_serializacion()),
+        ("Evaluación", test_evaluacion()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
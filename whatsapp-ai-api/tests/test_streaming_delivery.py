@@ -0,0 +1,84 @@
+"""
+Test del divisor de fragmentos de la entrega progresiva (streaming_delivery).
+No necesita base de datos ni API key.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming_delivery import DivisorFragmentos
+
+RESPUESTA = (
+    "Hola Juan! Gracias por escribir. Te cuento que el envío cuesta 1.5 dólares "
+    "y lo coordina el Sr. pérez.\n\n"
+    "Aceptamos tarjeta y transferencia. ¿Querés que te pase los datos?"
+)
+
+
+def _dividir(texto, paso):
+    divisor = DivisorFragmentos(min_primero=20, min_resto=40)
+    fragmentos = []
+    for i in range(0, len(texto), paso):
+        fragmentos += divisor.agregar(texto[i:i + paso])
+    return fragmentos + divisor.cerrar()
+
+
+def test_primer_fragmento_temprano():
+    """El primer fragmento sale en la primera oración que supera el mínimo"""
+    print("\n=== TEST 1: Primer fragmento ===")
+    divisor = DivisorFragmentos(min_primero=20, min_resto=40)
+    assert divisor.agregar("Hola Juan! ") == []
+    assert divisor.agregar("Gracias por escribir. Te") == ["Hola Juan! Gracias por escribir."]
+    assert divisor.cerrar() == ["Te"]
+    assert divisor.cerrar() == []
+    print("✅ Corta al superar el mínimo del primer fragmento")
+    return True
+
+
+def test_no_corta_abreviaturas_ni_decimales():
+    """'1.5' y 'Sr. pérez' no son fin de oración"""
+    print("\n=== TEST 2: Abreviaturas y decimales ===")
+    divisor = DivisorFragmentos(min_primero=1, min_resto=1)
+    assert divisor.agregar("Cuesta 1.5 dólares y lo lleva el Sr. pérez hoy") == []
+    assert divisor.cerrar() == ["Cuesta 1.5 dólares y lo lleva el Sr. pérez hoy"]
+    print("✅ Sin cortes falsos")
+    return True
+
+
+def test_parrafo_corta_siempre():
+    """Un párrafo se corta aunque sea más corto que el mínimo"""
+    print("\n=== TEST 3: Párrafos ===")
+    divisor = DivisorFragmentos(min_primero=100, min_resto=100)
+    assert divisor.agregar("Uno.\n\nDos.\n\n") == ["Uno.", "Dos."]
+    assert divisor.cerrar() == []
+    print("✅ Párrafos cortados")
+    return True
+
+
+def test_no_pierde_texto():
+    """Con cualquier tamaño de delta, los fragmentos reconstruyen la respuesta"""
+    print("\n=== TEST 4: Deltas ===")
+    for paso in (1, 3, 7, 50, len(RESPUESTA)):
+        fragmentos = _dividir(RESPUESTA, paso)
+        assert len(fragmentos) > 1 and all(fragmentos), (paso, fragmentos)
+        assert " ".join(fragmentos).split() == RESPUESTA.split(), paso
+    print("✅ Sin texto perdido ni fragmentos vacíos")
+    return True
+
+
+def run_all_tests():
+    results = [
+        ("Primer fragmento", test_primer_fragmento_temprano()),
+        ("Abreviaturas y decimales", test_no_corta_abreviaturas_ni_decimales()),
+        ("Párrafos", test_parrafo_corta_siempre()),
+        ("Deltas", test_no_pierde_texto()),
+    ]
+    for name, passed in results:
+        status = "✅ PASS" if passed else "❌ FAIL"
+        print(f"  {status}: {name}")
+    return all(p for _, p in results)
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -1,20 +1,59 @@
 """
 WhatsApp Service - Integración con WAHA API
+
+Todas las llamadas al bridge comparten un httpx.AsyncClient con pool
+keep-alive por event loop (antes cada envío abría un cliente y una conexión
+nuevos). El indicador "escribiendo..." se manda sin esperar la respuesta del
+bridge y se renueva solo mientras el agente genera (ver `escribiendo`).
 """
 
+import asyncio
 import os
 import httpx
 import logging
+from contextlib import asynccontextmanager
 
 logger = logging.getLogger(__name__)
 
+BRIDGE_MAX_CONNECTIONS = int(os.getenv("BRIDGE_MAX_CONNECTIONS", "50"))
+BRIDGE_KEEPALIVE_CONNECTIONS = int(os.getenv("BRIDGE_KEEPALIVE_CONNECTIONS", "10"))
+# Cada cuánto se renueva "escribiendo..." (el bridge lo corta tras `duration`)
+TYPING_REFRESH_SECONDS = float(os.getenv("TYPING_REFRESH_SECONDS", "3.5"))
+
 
 class WhatsAppService:
     """Servicio para enviar mensajes via WAHA"""
 
     def __init__(self):
+        # El pool de httpx queda atado al loop que lo creó: uno por loop
+        self._clientes: dict = {}
+        self._tareas: set = set()
         self.reload_config()
 
+    def _cliente(self) -> httpx.AsyncClient:
+        """Cliente HTTP compartido del event loop actual."""
+        loop = asyncio.get_running_loop()
+        cliente = self._clientes.get(loop)
+        if cliente is None or cliente.is_closed:
+            # Loops ya cerrados (tests, asyncio.run sucesivos) no se reusan
+            for viejo in [l for l in self._clientes if l.is_closed()]:
+                self._clientes.pop(viejo, None)
+            cliente = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(
+                    max_connections=BRIDGE_MAX_CONNECTIONS,
+                    max_keepalive_connections=BRIDGE_KEEPALIVE_CONNECTIONS,
+                ),
+            )
+            self._clientes[loop] = cliente
+        return cliente
+
+    async def cerrar(self) -> None:
+        """Cerrar el pool del loop actual (shutdown de la app)."""
+        cliente = self._clientes.pop(asyncio.get_running_loop(), None)
+        if cliente is not None:
+            await cliente.aclose()
+
     def reload_config(self):
         """Cargar configuración desde variables de entorno"""
         self.api_url = os.getenv("WHATSAPP_API_URL", "").rstrip("/")
@@ -49,26 +88,84 @@ class WhatsAppService:
             phone = f"{phone}@c.us"
 
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                url = f"{self.api_url}/api/sendText"
-                payload = {"chatId": phone, "text": message, "session": session}
-                if quoted_message_id:
-                    payload["quotedMessageId"] = quoted_message_id
-
-                response = await client.post(
-                    url, json=payload, headers=self._get_headers()
-                )
+            client = self._cliente()
+            url = f"{self.api_url}/api/sendText"
+            payload = {"chatId": phone, "text": message, "session": session}
+            if quoted_message_id:
+                payload["quotedMessageId"] = quoted_message_id
+
+            response = await client.post(
+                url, json=payload, headers=self._get_headers(), timeout=30.0
+            )
 
-                if response.status_code in [200, 201]:
-                    return {"success": True, "data": response.json()}
-                else:
-                    logger.error(f"Error enviando mensaje: {response.text}")
-                    return {"success": False, "error": response.text}
+            if response.status_code in [200, 201]:
+                return {"success": True, "data": response.json()}
+            else:
+                logger.error(f"Error enviando mensaje: {response.text}")
+                return {"success": False, "error": response.text}
 
         except Exception as e:
             logger.error(f"Error enviando mensaje: {e}")
             return {"success": False, "error": str(e)}
 
+    async def send_typing(self, phone: str, duration: int = 4, session: str = "default") -> dict:
+        """Indicador 'escribiendo...' en el chat (el bridge lo corta solo tras `duration` s)."""
+        self.reload_config()
+
+        if not self.is_configured():
+            return {"success": False, "error": "WhatsApp no configurado"}
+
+        phone = (
+            phone.replace("+", "").replace(" ", "").replace("-", "").replace("@lid", "")
+        )
+        if not phone.endswith("@c.us") and not phone.endswith("@s.whatsapp.net"):
+            phone = f"{phone}@c.us"
+
+        try:
+            client = self._cliente()
+            response = await client.post(
+                f"{self.api_url}/api/sendTyping",
+                json={"chatId": phone, "duration": duration, "session": session},
+                headers=self._get_headers(),
+                timeout=5.0,
+            )
+            return {"success": response.status_code in [200, 201]}
+        except Exception as e:
+            logger.debug(f"Error enviando typing: {e}")
+            return {"success": False, "error": str(e)}
+
+    def send_typing_sin_esperar(self, phone: str, session: str = "default") -> None:
+        """send_typing en background: el turno no espera el ida y vuelta al bridge."""
+        if not self.is_configured():
+            return
+        task = asyncio.get_running_loop().create_task(
+            self.send_typing(phone, duration=int(TYPING_REFRESH_SECONDS) + 1, session=session)
+        )
+        self._tareas.add(task)
+        task.add_done_callback(self._tareas.discard)
+
+    @asynccontextmanager
+    async def escribiendo(self, phone: str, session: str = "default"):
+        """Mantener "escribiendo..." mientras dura el bloque.
+
+        Se renueva cada TYPING_REFRESH_SECONDS desde una tarea aparte (nunca
+        en el camino crítico) y se cancela al salir, antes de enviar la
+        respuesta."""
+        if not self.is_configured():
+            yield
+            return
+
+        async def _renovar():
+            while True:
+                self.send_typing_sin_esperar(phone, session=session)
+                await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+        task = asyncio.get_running_loop().create_task(_renovar())
+        try:
+            yield
+        finally:
+            task.cancel()
+
     async def send_image(self, phone: str, image_url: str, caption: str = "", session: str = "default", view_once: bool = True, quoted_message_id: str = None) -> dict:
         """Enviar imagen via el bridge (sesión por perfil)
 
@@ -86,25 +183,25 @@ class WhatsAppService:
             phone = f"{phone}@c.us"
 
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                url = f"{self.api_url}/api/sendImage"
-                payload = {
-                    "chatId": phone,
-                    "url": image_url,
-                    "caption": caption,
-                    "session": session,
-                    "viewOnce": view_once,
-                }
-                if quoted_message_id:
-                    payload["quotedMessageId"] = quoted_message_id
-                response = await client.post(
-                    url, json=payload, headers=self._get_headers()
-                )
-                if response.status_code in [200, 201]:
-                    return {"success": True, "data": response.json()}
-                else:
-                    logger.error(f"Error enviando imagen: {response.text}")
-                    return {"success": False, "error": response.text}
+            client = self._cliente()
+            url = f"{self.api_url}/api/sendImage"
+            payload = {
+                "chatId": phone,
+                "url": image_url,
+                "caption": caption,
+                "session": session,
+                "viewOnce": view_once,
+            }
+            if quoted_message_id:
+                payload["quotedMessageId"] = quoted_message_id
+            response = await client.post(
+                url, json=payload, headers=self._get_headers(), timeout=30.0
+            )
+            if response.status_code in [200, 201]:
+                return {"success": True, "data": response.json()}
+            else:
+                logger.error(f"Error enviando imagen: {response.text}")
+                return {"success": False, "error": response.text}
         except Exception as e:
             logger.error(f"Error enviando imagen: {e}")
             return {"success": False, "error": str(e)}
@@ -121,16 +218,16 @@ class WhatsAppService:
             }
 
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                url = f"{self.api_url}/api/contacts/all?session={session}"
-                response = await client.get(url, headers=self._get_headers())
-
-                if response.status_code == 200:
-                    data = response.json()
-                    contacts = self._normalize_contacts(data)
-                    return {"success": True, "contacts": contacts}
-                else:
-                    return {"success": False, "error": response.text, "contacts": []}
+            client = self._cliente()
+            url = f"{self.api_url}/api/contacts/all?session={session}"
+            response = await client.get(url, headers=self._get_headers(), timeout=60.0)
+
+            if response.status_code == 200:
+                data = response.json()
+                contacts = self._normalize_contacts(data)
+                return {"success": True, "contacts": contacts}
+            else:
+                return {"success": False, "error": response.text, "contacts": []}
 
         except Exception as e:
             logger.error(f"Error obteniendo contactos: {e}")
@@ -215,24 +312,24 @@ class WhatsAppService:
             return {"connected": False, "status": "not_configured"}
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                url = f"{self.api_url}/api/sessions/{session}"
-                response = await client.get(url, headers=self._get_headers())
-
-                if response.status_code == 200:
-                    data = response.json()
-                    session_status = data.get("status", "UNKNOWN")
-                    connected = session_status in (
-                        "WORKING",
-                        "SCAN_QR_CODE",
-                        "STARTING",
-                    )
-                    return {"connected": connected, "status": session_status}
-                else:
-                    return {
-                        "connected": False,
-                        "status": f"api_error_{response.status_code}",
-                    }
+            client = self._cliente()
+            url = f"{self.api_url}/api/sessions/{session}"
+            response = await client.get(url, headers=self._get_headers(), timeout=10.0)
+
+            if response.status_code == 200:
+                data = response.json()
+                session_status = data.get("status", "UNKNOWN")
+                connected = session_status in (
+                    "WORKING",
+                    "SCAN_QR_CODE",
+                    "STARTING",
+                )
+                return {"connected": connected, "status": session_status}
+            else:
+                return {
+                    "connected": False,
+                    "status": f"api_error_{response.status_code}",
+                }
 
         except httpx.TimeoutException:
             logger.error("WhatsApp API connection timeout")
@@ -252,21 +349,21 @@ class WhatsAppService:
         phone_clean = phone.replace("+", "").replace(" ", "").replace("-", "")
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                url = f"{self.api_url}/api/contacts/check-exists"
-                params = {"phone": phone_clean, "session": session}
-                response = await client.get(
-                    url, headers=self._get_headers(), params=params
-                )
+            client = self._cliente()
+            url = f"{self.api_url}/api/contacts/check-exists"
+            params = {"phone": phone_clean, "session": session}
+            response = await client.get(
+                url, headers=self._get_headers(), timeout=10.0, params=params
+            )
 
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "exists": data.get("numberExists", False),
-                        "chatId": data.get("chatId") or data.get("jid"),
-                    }
-                else:
-                    return {"exists": False, "error": response.text}
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "exists": data.get("numberExists", False),
+                    "chatId": data.get("chatId") or data.get("jid"),
+                }
+            else:
+                return {"exists": False, "error": response.text}
 
         except Exception as e:
             logger.error(f"Error verificando número {phone}: {e}")
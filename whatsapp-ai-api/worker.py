@@ -4,11 +4,21 @@ Se ejecuta como servicio separado del API
 """
 import asyncio
 import logging
+import os
 import signal
+import socket
 import sys
 from datetime import datetime
 
-from redis_queue import obtener_siguiente_job_bloqueante, health_check, encolar_job
+from redis_queue import (
+    obtener_siguiente_job_bloqueante,
+    health_check,
+    encolar_job,
+    asegurar_grupo_entrante,
+    leer_eventos_entrantes,
+    confirmar_evento_entrante,
+    reclamar_eventos_huerfanos,
+)
 from job_engine import JOB_PROCESSORS
 from models import SessionLocal, BackgroundJob
 
@@ -20,6 +30,18 @@ logger = logging.getLogger(__name__)
 
 running = True
 
+# Consumidores de la cola durable de eventos entrantes (webhook asíncrono).
+# 0 desactiva el procesamiento de mensajes en este worker.
+INBOUND_CONSUMERS = int(os.getenv("INBOUND_CONSUMERS", "4"))
+INBOUND_RECLAIM_IDLE_MS = int(os.getenv("INBOUND_RECLAIM_IDLE_MS", "60000"))
+# Puerto de /metrics del worker (0 = deshabilitado): en WEBHOOK_ASYNC_MODE el
+# pipeline del agente corre aquí y sus métricas no pasan por la API
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+# Espera tras tomar el lock de la migración legacy (migraciones por conversación en vuelo)
+MIGRACION_GRACIA_SECONDS = 2.0
+# Cada cuánto se agrega el libro de uso del LLM (llm_usage) por día
+LLM_USAGE_ROLLUP_SECONDS = int(os.getenv("LLM_USAGE_ROLLUP_SECONDS", "3600"))
+
 
 def signal_handler(signum, frame):
     """Maneja señales de terminación para graceful shutdown"""
@@ -90,10 +112,12 @@ async def procesar_job(job_data: dict):
 async def worker_loop():
     """Loop principal del worker"""
     logger.info("Worker iniciado, esperando jobs...")
+    loop = asyncio.get_event_loop()
     
     while running:
         try:
-            job_data = obtener_siguiente_job_bloqueante(timeout=5)
+            # BLPOP en thread: no bloquear a los consumidores de eventos
+            job_data = await loop.run_in_executor(None, obtener_siguiente_job_bloqueante, 5)
             
             if job_data:
                 await procesar_job(job_data)
@@ -105,6 +129,173 @@ async def worker_loop():
     logger.info("Worker detenido")
 
 
+async def procesar_evento_entrante(event_id: str, data: dict):
+    """Corre el pipeline del agente para un evento de la cola y lo confirma.
+    Si falla NO se confirma: queda pendiente y se reintenta via XAUTOCLAIM.
+
+    Con debounce el turno de la ráfaga corre en background (esperar_rafaga=False):
+    el consumidor no queda bloqueado durante toda la ventana. Esos eventos
+    ("buffered") los confirma el líder de la ráfaga cuando termina el turno."""
+    from api.routers.webhook import procesar_evento
+
+    try:
+        result = await procesar_evento(data, esperar_rafaga=False, evento_id=event_id)
+        if result.get("status") != "buffered":
+            confirmar_evento_entrante(event_id)
+        logger.info(f"Evento {event_id} procesado: {result.get('status')}")
+    except Exception as e:
+        logger.error(f"Error procesando evento {event_id}: {e}", exc_info=True)
+
+
+async def inbound_consumer_loop(nombre: str):
+    """Consumidor de la cola de eventos entrantes (un consumer del group)"""
+    logger.info(f"Consumidor de eventos '{nombre}' iniciado")
+    loop = asyncio.get_event_loop()
+    ciclos = 0
+
+    while running:
+        try:
+            # Cada 12 ciclos (~1 min sin tráfico), reclamar eventos de consumidores caídos
+            ciclos += 1
+            if ciclos % 12 == 0:
+                for event_id, data in await loop.run_in_executor(
+                    None, reclamar_eventos_huerfanos, nombre, INBOUND_RECLAIM_IDLE_MS
+                ):
+                    logger.warning(f"Reprocesando evento huérfano {event_id}")
+                    await procesar_evento_entrante(event_id, data)
+
+            eventos = await loop.run_in_executor(None, leer_eventos_entrantes, nombre, 1, 5000)
+            for event_id, data in eventos:
+                await procesar_evento_entrante(event_id, data)
+
+        except Exception as e:
+            logger.error(f"Error en consumidor {nombre}: {e}")
+            await asyncio.sleep(1)
+
+    logger.info(f"Consumidor de eventos '{nombre}' detenido")
+
+
+def rollup_uso_llm():
+    """Rollup diario del uso del LLM + limpieza del libro. Con lock en Redis:
+    el rollup borra y reinserta el día, dos réplicas a la vez duplicarían filas."""
+    from llm_usage import rollup_reciente
+    from redis_queue import tomar_lock, liberar_lock
+
+    token = tomar_lock("worker:rollup_uso_llm:lock", 600)
+    if token is None:
+        return
+    db = SessionLocal()
+    try:
+        logger.info(f"Rollup de uso del LLM: {rollup_reciente(db)}")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error en rollup de uso del LLM: {e}", exc_info=True)
+    finally:
+        db.close()
+        liberar_lock("worker:rollup_uso_llm:lock", token)
+
+
+async def rollup_uso_loop():
+    """Corre rollup_uso_llm cada LLM_USAGE_ROLLUP_SECONDS"""
+    loop = asyncio.get_event_loop()
+    while running:
+        try:
+            await loop.run_in_executor(None, rollup_uso_llm)
+        except Exception as e:
+            logger.error(f"Error en loop de rollup: {e}")
+        # Dormir en pasos cortos para respetar el shutdown
+        for _ in range(max(1, LLM_USAGE_ROLLUP_SECONDS // 5)):
+            if not running:
+                break
+            await asyncio.sleep(5)
+
+
+async def main_loop():
+    """Corre el loop de jobs y los consumidores de eventos entrantes en paralelo"""
+    tasks = [worker_loop(), rollup_uso_loop()]
+
+    # Migración legacy única, en un thread para no demorar a los consumidores
+    migracion = asyncio.get_event_loop().run_in_executor(None, migrar_memoria_legacy)
+    migracion.add_done_callback(_resultado_migracion)
+
+    if INBOUND_CONSUMERS > 0:
+        from ws_manager import ws_manager
+
+        # El worker no tiene WebSockets: los eventos del dashboard van por Redis
+        ws_manager.habilitar_relay()
+        # Los consumidores ya acotan la concurrencia: aquí los turnos esperan
+        # su lugar en el pool en vez de diferirse otra vez a la cola.
+        from agent_executor import agent_executor
+        agent_executor.modo = "wait"
+        asegurar_grupo_entrante()
+        from tenant import cargar_tabla_ruteo, vigilar_tabla_ruteo
+        try:
+            cargar_tabla_ruteo()
+        except Exception as e:
+            logger.warning(f"No se pudo cargar la tabla de ruteo: {e}")
+        asyncio.create_task(vigilar_tabla_ruteo())
+        base = f"{socket.gethostname()}-{os.getpid()}"
+        tasks += [inbound_consumer_loop(f"{base}-{i}") for i in range(INBOUND_CONSUMERS)]
+        logger.info(f"{INBOUND_CONSUMERS} consumidores de eventos entrantes")
+
+    await asyncio.gather(*tasks)
+
+    # Turnos de ráfagas que siguen en su ventana de debounce
+    from api.routers.webhook import _tareas_background
+
+    if _tareas_background:
+        logger.info(f"Esperando {len(_tareas_background)} turnos en background...")
+        await asyncio.wait(list(_tareas_background), timeout=30)
+
+
+def _resultado_migracion(futuro) -> None:
+    """Loguear errores de la migración legacy (corre en el executor, nadie la espera)."""
+    if not futuro.cancelled() and futuro.exception() is not None:
+        logger.error("Migración de Memoria legacy falló", exc_info=futuro.exception())
+
+
+def migrar_memoria_legacy():
+    """Migración única de los blobs de Memoria a mensajes individuales.
+
+    Con un lock en Redis para que varias réplicas del worker no la corran a la
+    vez. Al terminar se marca el flag global y la API deja de consultar la
+    tabla legacy en cada mensaje."""
+    import time
+    from message_service import MessageService, memoria_migrada, MIGRACION_MASIVA_LOCK
+    from redis_queue import tomar_lock, liberar_lock
+
+    if memoria_migrada():
+        return
+    token = tomar_lock(MIGRACION_MASIVA_LOCK, 3600)
+    if token is None:
+        logger.info("Migración de Memoria en curso en otra réplica")
+        return
+    db = SessionLocal()
+    try:
+        # Con el lock tomado la API ya no empieza migraciones por conversación;
+        # margen para que terminen las que estaban en curso
+        time.sleep(MIGRACION_GRACIA_SECONDS)
+        resultado = MessageService.migrate_all_from_memoria(db)
+        logger.info(f"Memoria legacy migrada: {resultado}")
+    except Exception as e:
+        logger.error(f"Error migrando Memoria legacy: {e}", exc_info=True)
+    finally:
+        db.close()
+        liberar_lock(MIGRACION_MASIVA_LOCK, token)
+
+
+def recalcular_leads_cli(args: list):
+    from lead_scoring import recalcular_leads
+
+    usuario_id = int(args[0]) if args and args[0].isdigit() else None
+    db = SessionLocal()
+    try:
+        resultado = recalcular_leads(db, usuario_id=usuario_id)
+        logger.info(f"Recalculo de leads: {resultado}")
+    finally:
+        db.close()
+
+
 def recuperar_jobs_huerfanos():
     """Re-encola jobs que quedaron en 'procesando' (huérfanos por restart)"""
     db = SessionLocal()
@@ -135,11 +326,36 @@ def main():
         sys.exit(1)
     
     logger.info("Conexión a Redis OK")
-    
+
+    # python worker.py --migrar-memoria: solo correr la migración legacy y salir
+    if "--migrar-memoria" in sys.argv:
+        migrar_memoria_legacy()
+        return
+
+    # python worker.py --recalcular-leads [usuario_id]: rehacer contadores y
+    # lead scores en lote (p. ej. tras cambiar las reglas de scoring) y salir
+    if "--recalcular-leads" in sys.argv:
+        recalcular_leads_cli(sys.argv[sys.argv.index("--recalcular-leads") + 1:])
+        return
+
+    # python worker.py --rollup-uso-llm: agregar el uso del LLM de los últimos días y salir
+    if "--rollup-uso-llm" in sys.argv:
+        rollup_uso_llm()
+        return
+
     recuperar_jobs_huerfanos()
+
+    if WORKER_METRICS_PORT:
+        from metrics import servir_metricas
+
+        try:
+            servir_metricas(WORKER_METRICS_PORT)
+            logger.info(f"Métricas del worker en :{WORKER_METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.warning(f"No se pudo exponer /metrics en :{WORKER_METRICS_PORT}: {e}")
     
     try:
-        asyncio.run(worker_loop())
+        asyncio.run(main_loop())
     except KeyboardInterrupt:
         logger.info("Worker interrumpido por usuario")
     
@@ -14,6 +14,10 @@ logger = logging.getLogger(__name__)
 HEARTBEAT_INTERVAL = 30  # seconds between pings
 HEARTBEAT_TIMEOUT = 10   # seconds to wait for pong
 
+# Relay entre procesos: el worker no tiene WebSockets conectados, así que
+# publica sus eventos en este canal de Redis y la API los reenvía localmente.
+WS_RELAY_CHANNEL = "ws_events"
+
 
 class ConnectionManager:
     """Gestiona conexiones WebSocket activas, indexadas por (usuario, perfil).
@@ -29,6 +33,77 @@ class ConnectionManager:
         self._ws_to_key: dict[WebSocket, tuple] = {}
         # WebSocket -> asyncio.Task (heartbeat tasks)
         self._heartbeat_tasks: dict[WebSocket, asyncio.Task] = {}
+        # True en procesos sin clientes (worker): los eventos se publican en Redis
+        self._relay_publish = False
+
+    def habilitar_relay(self):
+        """Publicar los broadcasts en Redis en vez de enviarlos localmente.
+        Usar en procesos que no aceptan WebSockets (worker)."""
+        self._relay_publish = True
+
+    def _publicar_relay(self, scope: str, event: str, data: dict, usuario_id: int = None, perfil_id: int = None):
+        try:
+            from redis_queue import get_redis
+
+            get_redis().publish(
+                WS_RELAY_CHANNEL,
+                json.dumps(
+                    {
+                        "scope": scope,
+                        "usuario_id": usuario_id,
+                        "perfil_id": perfil_id,
+                        "event": event,
+                        "data": data,
+                    },
+                    ensure_ascii=False,
+                    default=str,
+                ),
+            )
+        except Exception as e:
+            logger.warning(f"WS relay publish failed: {e}")
+
+    async def escuchar_relay(self):
+        """Reenviar a los clientes locales los eventos publicados por otros procesos.
+        Corre como task de fondo en la API; reintenta si Redis se cae."""
+        import redis.asyncio as aioredis
+        from redis_queue import REDIS_URL
+
+        while True:
+            client = None
+            try:
+                client = aioredis.from_url(REDIS_URL, decode_responses=True)
+                pubsub = client.pubsub()
+                await pubsub.subscribe(WS_RELAY_CHANNEL)
+                logger.info("WS relay listener subscribed")
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    try:
+                        payload = json.loads(msg["data"])
+                    except (ValueError, TypeError):
+                        continue
+                    scope = payload.get("scope")
+                    if scope == "perfil":
+                        await self._send_many(
+                            self.active_connections.get((payload.get("usuario_id"), payload.get("perfil_id"))),
+                            payload.get("event"),
+                            payload.get("data") or {},
+                        )
+                    elif scope == "user":
+                        await self._broadcast_to_user_local(payload.get("usuario_id"), payload.get("event"), payload.get("data") or {})
+                    elif scope == "all":
+                        await self._broadcast_to_all_local(payload.get("event"), payload.get("data") or {})
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"WS relay listener error: {e}, retrying in 5s")
+                await asyncio.sleep(5)
+            finally:
+                if client is not None:
+                    try:
+                        await client.close()
+                    except Exception:
+                        pass
 
     @property
     def total_connections(self) -> int:
@@ -78,17 +153,32 @@ class ConnectionManager:
 
     async def broadcast_to_perfil(self, usuario_id: int, perfil_id: int, event: str, data: dict):
         """Send event only to connections of a specific user+profile"""
+        if self._relay_publish:
+            self._publicar_relay("perfil", event, data, usuario_id=usuario_id, perfil_id=perfil_id)
+            return
         await self._send_many(self.active_connections.get((usuario_id, perfil_id)), event, data)
 
     async def broadcast_to_user(self, usuario_id: int, event: str, data: dict):
         """Send event to ALL of a user's connections (every profile). For
         user-level events (e.g. agent on/off). Chat events should use
         broadcast_to_perfil to stay scoped to one number."""
+        if self._relay_publish:
+            self._publicar_relay("user", event, data, usuario_id=usuario_id)
+            return
+        await self._broadcast_to_user_local(usuario_id, event, data)
+
+    async def _broadcast_to_user_local(self, usuario_id: int, event: str, data: dict):
         conns = [c for (uid, _pid), cs in self.active_connections.items() if uid == usuario_id for c in cs]
         await self._send_many(conns, event, data)
 
     async def broadcast_to_all(self, event: str, data: dict):
         """Send event to ALL connected clients (system-wide)"""
+        if self._relay_publish:
+            self._publicar_relay("all", event, data)
+            return
+        await self._broadcast_to_all_local(event, data)
+
+    async def _broadcast_to_all_local(self, event: str, data: dict):
         if not self.active_connections:
             return
 
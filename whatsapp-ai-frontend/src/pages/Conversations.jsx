@@ -79,7 +79,8 @@ export default function Conversations() {
       }
       loadConversations()
     }
-    if (event === 'typing') {
+    // Respuesta en streaming: el agente sigue escribiendo entre fragmentos
+    if (event === 'typing' || event === 'partial_message') {
       setTyping(data.telefono)
       if (typingTimeout.current) clearTimeout(typingTimeout.current)
       typingTimeout.current = setTimeout(() => setTyping(null), 5000)
@@ -1,15 +1,29 @@
 const MAX_RETRIES = 3;
 const RETRY_DELAY_MS = 1000;
+// 429 = la API está saturada pero viva (AGENT_OVERLOAD_MODE=reject): esos
+// reintentos tienen su propio presupuesto, mucho más largo, para no perder
+// el mensaje entrante durante una saturación sostenida.
+const MAX_OVERLOAD_RETRIES = parseInt(process.env.WEBHOOK_OVERLOAD_RETRIES || "120", 10);
+// Entregas en vuelo a la vez. Con un slot libre cada evento sale solo y de
+// inmediato; si están todos ocupados los eventos se acumulan y el siguiente
+// slot los manda juntos a <webhook>/batch (hasta WEBHOOK_BATCH_MAX por lote).
+// WEBHOOK_BATCH_MAX=1 desactiva los lotes.
+const MAX_INFLIGHT = parseInt(process.env.WEBHOOK_MAX_INFLIGHT || "16", 10);
+const BATCH_MAX = parseInt(process.env.WEBHOOK_BATCH_MAX || "50", 10);
 
 export class WebhookForwarder {
   constructor(logger, token = "") {
     this.logger = logger;
     this.webhookUrl = null;
     this.token = token;
+    this.queue = [];
+    this.inflight = 0;
+    this.batchSupported = BATCH_MAX > 1;
   }
 
   setUrl(url) {
     this.webhookUrl = url;
+    this.batchSupported = BATCH_MAX > 1;
     this.logger.info({ url }, "Webhook URL configured");
   }
 
@@ -17,40 +31,86 @@ export class WebhookForwarder {
     return this.webhookUrl;
   }
 
-  async forward(payload) {
+  forward(payload) {
     if (!this.webhookUrl) {
       this.logger.warn("No webhook URL configured, dropping message");
       return;
     }
+    this.queue.push(payload);
+    this._pump();
+  }
 
+  _pump() {
+    while (this.inflight < MAX_INFLIGHT && this.queue.length > 0) {
+      const batch = this.queue.splice(0, this.batchSupported ? BATCH_MAX : 1);
+      this.inflight++;
+      this._deliver(batch)
+        .catch((err) => this.logger.error({ err: err.message }, "Webhook delivery crashed"))
+        .finally(() => {
+          this.inflight--;
+          this._pump();
+        });
+    }
+  }
+
+  async _deliver(batch) {
+    if (batch.length > 1 && this.batchSupported) {
+      const batchUrl = `${this.webhookUrl.replace(/\/+$/, "")}/batch`;
+      const result = await this._post(batchUrl, { events: batch }, { events: batch.length });
+      if (result !== "unsupported") return;
+      // API sin endpoint de lotes (URL personalizada, versión vieja): uno por uno
+      this.logger.warn({ url: batchUrl }, "Webhook batch endpoint not available, sending events one by one");
+      this.batchSupported = false;
+    }
+    for (const payload of batch) {
+      await this._post(this.webhookUrl, payload, { from: payload?.payload?.from });
+    }
+  }
+
+  /**
+   * POST con reintentos. Retorna "ok", "unsupported" (404/405: la URL no
+   * existe) o "failed" tras agotar los reintentos.
+   */
+  async _post(url, body, logContext) {
+    let overloaded = 0;
     for (let attempt = 1; attempt <= MAX_RETRIES; attempt++) {
       try {
         const headers = { "Content-Type": "application/json" };
         if (this.token) {
           headers["X-Webhook-Token"] = this.token;
         }
-        const response = await fetch(this.webhookUrl, {
+        const response = await fetch(url, {
           method: "POST",
           headers,
-          body: JSON.stringify(payload),
+          body: JSON.stringify(body),
           signal: AbortSignal.timeout(10000),
         });
 
         if (response.ok) {
-          this.logger.info(
-            { status: response.status, from: payload?.payload?.from },
-            "Webhook delivered"
-          );
-          return;
+          this.logger.info({ status: response.status, ...logContext }, "Webhook delivered");
+          return "ok";
         }
 
         this.logger.warn(
-          { status: response.status, attempt },
+          { status: response.status, attempt, ...logContext },
           "Webhook returned non-OK status"
         );
+
+        if (response.status === 404 || response.status === 405) {
+          return "unsupported";
+        }
+
+        // 429: respetar Retry-After y reintentar sin gastar los reintentos por error
+        if (response.status === 429 && overloaded < MAX_OVERLOAD_RETRIES) {
+          overloaded++;
+          attempt--;
+          const retryAfter = Number(response.headers.get("retry-after")) || 5;
+          await new Promise((r) => setTimeout(r, Math.min(retryAfter, 30) * 1000));
+          continue;
+        }
       } catch (err) {
         this.logger.error(
-          { err: err.message, attempt },
+          { err: err.message, attempt, ...logContext },
           "Webhook delivery failed"
         );
       }
@@ -61,8 +121,9 @@ export class WebhookForwarder {
     }
 
     this.logger.error(
-      { url: this.webhookUrl, from: payload?.payload?.from },
+      { url, overloaded, ...logContext },
       "Webhook delivery exhausted all retries"
     );
+    return "failed";
   }
 }